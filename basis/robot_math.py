@@ -27,6 +27,10 @@ _AXES2TUPLE = {
     'rzxz': (2, 0, 1, 1), 'rxyz': (2, 1, 0, 1), 'rzyz': (2, 1, 1, 1)}
 _TUPLE2AXES = dict((v, k) for k, v in _AXES2TUPLE.items())
 
+# signs of the diagonal elements in 4w^2-1, 4x^2-1, 4y^2-1, 4z^2-1, see quaternions_from_rotmats
+_QUATERNION_DIAG_SIGNS = np.array([[1, 1, 1], [1, -1, -1], [-1, 1, -1], [-1, -1, 1]])
+_QUATERNION_PRODUCT_IDS = np.array([[6, 0, 1, 2], [0, 6, 3, 4], [1, 3, 6, 5], [2, 4, 5, 6]])
+
 # helper
 def radians(degree_val):
     return np.radians(degree_val)
@@ -52,6 +56,26 @@ def rotmat_from_axangle(axis, angle):
                      [2.0 * (bd + ac), 2.0 * (cd - ab), aa + dd - bb - cc]])
 
 
+def rotmats_from_axangles(axes, angles):
+    """
+    the vectorized counterpart of rotmat_from_axangle, the arguments are broadcast against each other
+    :param axes: ...x3 nparray
+    :param angles: ... nparray, angles in radian
+    :return: ...x3x3 nparray
+    """
+    axes = np.asarray(axes, dtype=float)
+    axes = axes / np.linalg.norm(axes, axis=-1, keepdims=True)
+    angles = np.asarray(angles, dtype=float)
+    a = np.cos(angles / 2.0)
+    bcd = -axes * np.sin(angles / 2.0)[..., np.newaxis]
+    a, b, c, d = np.broadcast_arrays(a, bcd[..., 0], bcd[..., 1], bcd[..., 2])
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
+    return np.stack([np.stack([aa + bb - cc - dd, 2.0 * (bc + ad), 2.0 * (bd - ac)], axis=-1),
+                     np.stack([2.0 * (bc - ad), aa + cc - bb - dd, 2.0 * (cd + ab)], axis=-1),
+                     np.stack([2.0 * (bd + ac), 2.0 * (cd - ab), aa + dd - bb - cc], axis=-1)], axis=-2)
+
+
 def rotmat_from_quaternion(quaternion):
     """
     convert a quaterion to rotmat
@@ -77,6 +101,31 @@ def rotmat_to_quaternion(rotmat):
     pass
 
 
+def quaternions_from_rotmats(rotmats):
+    """
+    convert many rotmats to quaternions at once, vectorized Shepperd's method:
+    the largest of |w|, |x|, |y|, |z| is computed from the diagonal, the others from the off-diagonal elements
+    :param rotmats: Nx3x3 nparray
+    :return: Nx4 nparray, each row is [w, x, y, z] with w >= 0
+    """
+    rotmats = np.asarray(rotmats)
+    nrotmats = len(rotmats)
+    diags = np.diagonal(rotmats, axis1=1, axis2=2)
+    magnitudes = .5 * np.sqrt(np.maximum(1 + diags.dot(_QUATERNION_DIAG_SIGNS.T), 0))
+    largest_ids = np.argmax(magnitudes, axis=1)
+    # 4wx, 4wy, 4wz, 4xy, 4xz, 4yz, and a placeholder for the largest one
+    products = np.zeros((nrotmats, 7))
+    products[:, :6] = (rotmats[:, [2, 0, 1, 0, 0, 1], [1, 2, 0, 1, 2, 2]] +
+                       rotmats[:, [1, 2, 0, 1, 2, 2], [2, 0, 1, 0, 0, 1]] * [-1, -1, -1, 1, 1, 1])
+    row_ids = np.arange(nrotmats)
+    largest_values = magnitudes[row_ids, largest_ids]
+    quaternions = (products[row_ids[:, np.newaxis], _QUATERNION_PRODUCT_IDS[largest_ids]] /
+                   (4 * largest_values[:, np.newaxis]))
+    quaternions[row_ids, largest_ids] = largest_values
+    quaternions[quaternions[:, 0] < 0] *= -1
+    return quaternions
+
+
 def rotmat_from_normal(surfacenormal):
     '''
     Compute the rotation matrix of a 3D mesh using a surface normal
@@ -539,6 +588,29 @@ def deltaw_between_rotmat(rotmati, rotmatj):
     return deltaw
 
 
+def deltaw_between_rotmats(rotmatis, rotmatjs):
+    """
+    batched version of deltaw_between_rotmat
+    :param rotmatis: Nx3x3 nparray
+    :param rotmatjs: Nx3x3 nparray
+    :return: Nx3 nparray
+    """
+    deltarots = np.matmul(rotmatjs, rotmatis.transpose(0, 2, 1))
+    tempvecs = np.stack([deltarots[:, 2, 1] - deltarots[:, 1, 2],
+                         deltarots[:, 0, 2] - deltarots[:, 2, 0],
+                         deltarots[:, 1, 0] - deltarots[:, 0, 1]], axis=1)
+    tempveclengths = np.linalg.norm(tempvecs, axis=1)
+    deltaws = np.zeros_like(tempvecs)
+    selection = tempveclengths > 1e-6
+    lengths = tempveclengths[selection]
+    traces = np.trace(deltarots[selection], axis1=1, axis2=2)
+    deltaws[selection] = (np.arctan2(lengths, traces - 1.0) / lengths)[:, None] * tempvecs[selection]
+    diags = np.diagonal(deltarots, axis1=1, axis2=2)
+    selection = np.logical_and(~selection, ~np.all(diags > 0, axis=1))
+    deltaws[selection] = np.pi / 2 * (diags[selection] + 1)
+    return deltaws
+
+
 def cosine_between_vector(v1, v2):
     l1, v1_u = unit_vector(v1, toggle_length=True)
     l2, v2_u = unit_vector(v2, toggle_length=True)
@@ -762,6 +834,59 @@ def get_aabb(pointsarray):
     return [center, np.array([[xmin, xmax], [ymin, ymax], [zmin, zmax]])]
 
 
+def transform_aabbs(aabbs, poss, rotmats):
+    """
+    the axis aligned bounds of boxes given in their local frames, after moving the frames to poss and rotmats
+    :param aabbs: ...x2x3 nparray, [min, max] in the local frames
+    :param poss: ...x3 nparray
+    :param rotmats: ...x3x3 nparray
+    :return: ...x2x3 nparray, [min, max]
+    """
+    aabbs = np.asarray(aabbs)
+    centers = (aabbs[..., 0, :] + aabbs[..., 1, :]) / 2
+    half_extents = (aabbs[..., 1, :] - aabbs[..., 0, :]) / 2
+    gl_centers = np.einsum('...ij,...j->...i', rotmats, centers) + poss
+    gl_half_extents = np.einsum('...ij,...j->...i', np.abs(rotmats), half_extents)
+    return np.stack([gl_centers - gl_half_extents, gl_centers + gl_half_extents], axis=-2)
+
+
+def is_obb_overlapped(centers0, rotmats0, half_extents0, centers1, rotmats1, half_extents1):
+    """
+    separating axis test of oriented boxes, the arguments are broadcast against each other
+    :param centers0: ...x3 nparray, the centers in the global frame
+    :param rotmats0: ...x3x3 nparray, the columns are the axes of the boxes
+    :param half_extents0: ...x3 nparray
+    :param centers1:
+    :param rotmats1:
+    :param half_extents1:
+    :return: ... bool nparray, True if the boxes overlap or touch
+    """
+    # the second boxes described in the frames of the first ones
+    rotmats = np.matmul(np.swapaxes(rotmats0, -1, -2), rotmats1)
+    abs_rotmats = np.abs(rotmats) + 1e-9  # counter the cross products of nearly parallel axes
+    translations = np.einsum('...ji,...j->...i', rotmats0, centers1 - centers0)
+    half_extents0 = np.asarray(half_extents0)
+    half_extents1 = np.asarray(half_extents1)
+    # the axes of the first boxes
+    is_separated = np.any(np.abs(translations) >
+                          half_extents0 + np.einsum('...ij,...j->...i', abs_rotmats, half_extents1), axis=-1)
+    # the axes of the second boxes
+    is_separated |= np.any(np.abs(np.einsum('...ij,...i->...j', rotmats, translations)) >
+                           np.einsum('...ij,...i->...j', abs_rotmats, half_extents0) + half_extents1, axis=-1)
+    # the cross products of the axes
+    for i in range(3):
+        i1, i2 = (i + 1) % 3, (i + 2) % 3
+        for j in range(3):
+            j1, j2 = (j + 1) % 3, (j + 2) % 3
+            radius0 = half_extents0[..., i1] * abs_rotmats[..., i2, j] + \
+                      half_extents0[..., i2] * abs_rotmats[..., i1, j]
+            radius1 = half_extents1[..., j1] * abs_rotmats[..., i, j2] + \
+                      half_extents1[..., j2] * abs_rotmats[..., i, j1]
+            distance = np.abs(translations[..., i2] * rotmats[..., i1, j] - translations[..., i1] * rotmats[..., i2, j])
+            is_separated |= distance > radius0 + radius1
+    return ~is_separated
+
+
 def compute_pca(nparray):
     """
     :param nparray: nxd array, d is the dimension
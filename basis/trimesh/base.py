@@ -26,6 +26,7 @@ from . import units
 
 from .io.export import export_mesh
 from .ray.ray_mesh import RayMeshIntersector, contains_points
+from .ray.ray_bvh import bvh_from_triangles
 from .voxel import Voxel
 from .points import transform_points
 from .constants import log, _log_time, tol
@@ -419,6 +420,20 @@ class Trimesh(object):
         tree = triangles.bounds_tree(self.triangles)
         return tree
 
+    @property
+    def triangles_bvh(self):
+        """
+        A bounding volume hierarchy of the faces of the mesh, stored in flat arrays.
+        Unlike triangles_tree, it does not need Rtree.
+        :return bvh: dict, see ray.ray_bvh.bvh_from_triangles
+        """
+        cached = self._cache['triangles_bvh']
+        if cached is not None:
+            return cached
+        bvh = bvh_from_triangles(self.triangles)
+        self._cache['triangles_bvh'] = bvh
+        return bvh
+
     @property
     def edges(self):
         """
@@ -0,0 +1,154 @@
+'''
+Broad phase ray- triangle intersection using a bounding volume hierarchy
+stored in flat arrays, so that many rays can traverse it at once
+'''
+import numpy as np
+
+from ..constants import tol
+from .ray_triangle_cpu import rays_triangles_pairs
+
+
+def bvh_from_triangles(triangles, leaf_size=8):
+    '''
+    Build a bounding volume hierarchy for a set of triangles.
+    Nodes are split at the median triangle centroid along the
+    longest axis of the centroids in the node.
+
+    Arguments
+    ---------
+    triangles: (n, 3, 3) float array of triangle vertices
+    leaf_size: int, maximum number of triangles in a leaf
+
+    Returns
+    ---------
+    bvh: dict of flat arrays, with k the number of nodes and node 0 the root
+        'bounds':   (k, 2, 3) float, AABB (min, max) of each node
+        'children': (k, 2) int, left and right child, -1 for leaves
+        'start':    (k) int, first index in 'order' of the triangles of a leaf
+        'count':    (k) int, number of triangles of a leaf, 0 for inner nodes
+        'order':    (n) int, triangle indexes grouped by leaf
+    '''
+    triangles = np.asanyarray(triangles, dtype=np.float64)
+    tri_min = triangles.min(axis=1)
+    tri_max = triangles.max(axis=1)
+    centroids = triangles.mean(axis=1)
+    order = np.arange(len(triangles))
+    bounds = []
+    children = []
+    start = []
+    count = []
+    # (node index, start, end) of the nodes still to be built
+    stack = [(0, 0, len(triangles))]
+    bounds.append(None)
+    children.append([-1, -1])
+    start.append(0)
+    count.append(0)
+    while len(stack) > 0:
+        node, node_start, node_end = stack.pop()
+        node_tris = order[node_start:node_end]
+        bounds[node] = [tri_min[node_tris].min(axis=0) - tol.merge,
+                        tri_max[node_tris].max(axis=0) + tol.merge]
+        if node_end - node_start <= leaf_size:
+            start[node] = node_start
+            count[node] = node_end - node_start
+            continue
+        node_centroids = centroids[node_tris]
+        axis = np.ptp(node_centroids, axis=0).argmax()
+        half = (node_end - node_start) // 2
+        order[node_start:node_end] = node_tris[np.argpartition(node_centroids[:, axis], half)]
+        for child_start, child_end in [(node_start, node_start + half), (node_start + half, node_end)]:
+            bounds.append(None)
+            children.append([-1, -1])
+            start.append(0)
+            count.append(0)
+            stack.append((len(bounds) - 1, child_start, child_end))
+        children[node] = [len(bounds) - 2, len(bounds) - 1]
+    bvh = {'bounds': np.array(bounds, dtype=np.float64).reshape((-1, 2, 3)),
+           'children': np.array(children, dtype=np.int64),
+           'start': np.array(start, dtype=np.int64),
+           'count': np.array(count, dtype=np.int64),
+           'order': order}
+    return bvh
+
+
+def rays_triangles_bvh(triangles,
+                       rays,
+                       bvh,
+                       return_any=False,
+                       chunk_size=4096):
+    '''
+    Intersect a set of rays and triangles, traversing the
+    hierarchy with all the rays of a chunk at once and testing
+    the (ray, triangle) candidate pairs of the reached leaves
+    in batches.
+
+    Arguments
+    ---------
+    triangles:  (n, 3, 3) float array of triangle vertices
+    rays:       (m, 2, 3) float array of ray start, ray directions
+    bvh:        dict, from bvh_from_triangles(triangles)
+    return_any: bool, exit early if any ray hits any triangle
+                and change output of function to bool
+    chunk_size: int, number of rays traversing the hierarchy together
+
+    Returns
+    ---------
+    if return_any:
+        hit:       bool, whether the set of rays hit any triangle
+    else:
+        ray_index: (p) int, ray of each intersection
+        tri_index: (p) int, triangle of each intersection
+        t:         (p) float, location = ray start + t * ray direction
+    '''
+    rays = np.asanyarray(rays, dtype=np.float64)
+    ray_index = []
+    tri_index = []
+    ray_t = []
+    for chunk_start in range(0, len(rays), chunk_size):
+        origins = rays[chunk_start:chunk_start + chunk_size, 0, :]
+        directions = rays[chunk_start:chunk_start + chunk_size, 1, :]
+        # zero direction components are replaced by a tiny value for the slab test
+        safe_directions = np.where(np.abs(directions) < tol.zero,
+                                   np.where(directions < 0, -tol.zero, tol.zero),
+                                   directions)
+        inv_directions = 1.0 / safe_directions
+        # (ray, node) pairs to be tested, starting from the root
+        pair_rays = np.arange(len(origins))
+        pair_nodes = np.zeros(len(origins), dtype=np.int64)
+        while len(pair_rays) > 0:
+            node_bounds = bvh['bounds'][pair_nodes]
+            pair_origins = origins[pair_rays]
+            pair_inv_directions = inv_directions[pair_rays]
+            t_a = (node_bounds[:, 0, :] - pair_origins) * pair_inv_directions
+            t_b = (node_bounds[:, 1, :] - pair_origins) * pair_inv_directions
+            t_near = np.minimum(t_a, t_b).max(axis=1)
+            t_far = np.maximum(t_a, t_b).min(axis=1)
+            reached = t_far >= np.maximum(t_near, 0)
+            pair_rays = pair_rays[reached]
+            pair_nodes = pair_nodes[reached]
+            # leaves give (ray, triangle) candidates
+            is_leaf = bvh['count'][pair_nodes] > 0
+            leaf_rays = pair_rays[is_leaf]
+            leaf_nodes = pair_nodes[is_leaf]
+            leaf_counts = bvh['count'][leaf_nodes]
+            candidate_rays = np.repeat(leaf_rays, leaf_counts)
+            offsets = np.arange(leaf_counts.sum()) - np.repeat(np.cumsum(leaf_counts) - leaf_counts, leaf_counts)
+            candidate_tris = bvh['order'][np.repeat(bvh['start'][leaf_nodes], leaf_counts) + offsets]
+            hit, t = rays_triangles_pairs(triangles[candidate_tris],
+                                          origins[candidate_rays],
+                                          directions[candidate_rays])
+            if return_any:
+                if hit.any(): return True
+            else:
+                ray_index.append(candidate_rays[hit] + chunk_start)
+                tri_index.append(candidate_tris[hit])
+                ray_t.append(t[hit])
+            # inner nodes pass the rays on to both children
+            inner_rays = pair_rays[~is_leaf]
+            pair_nodes = bvh['children'][pair_nodes[~is_leaf]].reshape(-1)
+            pair_rays = np.repeat(inner_rays, 2)
+
+    if return_any: return False
+    if len(ray_index) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate(ray_index), np.concatenate(tri_index), np.concatenate(ray_t)
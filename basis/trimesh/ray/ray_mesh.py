@@ -3,13 +3,15 @@ import numpy as np
 from ..util import Cache, unitize
 from ..grouping import unique_rows
 from ..intersections import plane_lines
-from .ray_triangle_cpu import rays_triangles_id
+from .ray_bvh import rays_triangles_bvh
 
 
 class RayMeshIntersector:
     '''
     An object to query a mesh for ray intersections. 
-    Precomputes an r-tree for each triangle on the mesh.
+    Uses the bounding volume hierarchy cached on the mesh
+    (mesh.triangles_bvh), the r-tree (requires Rtree) is only
+    built if tree is accessed.
     '''
 
     def __init__(self, mesh):
@@ -37,12 +39,15 @@ class RayMeshIntersector:
         hits: (n) sequence of triangle indexes which hit the ray
         '''
         rays = np.array(rays, dtype=float)
-        candidates = ray_triangle_candidates(rays=rays,
-                                             tree=self.tree)
-        hits = rays_triangles_id(triangles=self.mesh.triangles,
-                                 rays=rays,
-                                 ray_candidates=candidates,
-                                 return_any=return_any)
+        if return_any:
+            return rays_triangles_bvh(triangles=self.mesh.triangles,
+                                      rays=rays,
+                                      bvh=self.mesh.triangles_bvh,
+                                      return_any=True)
+        ray_index, tri_index, t = rays_triangles_bvh(triangles=self.mesh.triangles,
+                                                     rays=rays,
+                                                     bvh=self.mesh.triangles_bvh)
+        hits = group_by_ray(ray_index, tri_index, len(rays))
         return hits
 
     def intersects_location(self, rays, return_id=False):
@@ -62,12 +67,15 @@ class RayMeshIntersector:
         hits:      (n) list of face ids 
         '''
         rays = np.array(rays, dtype=float)
-        hits = self.intersects_id(rays)
-        locations = ray_triangle_locations(triangles=self.mesh.triangles,
-                                           rays=rays,
-                                           intersections=hits,
-                                           tri_normals=self.mesh.face_normals)
+        ray_index, tri_index, t = rays_triangles_bvh(triangles=self.mesh.triangles,
+                                                     rays=rays,
+                                                     bvh=self.mesh.triangles_bvh)
+        points = rays[ray_index, 0, :] + rays[ray_index, 1, :] * t.reshape((-1, 1))
+        # an on- edge hit is found for both triangles, keep one location per ray
+        unique = unique_rows(np.column_stack((ray_index, points)))[0]
+        locations = group_by_ray(ray_index[unique], points[unique], len(rays))
         if return_id:
+            hits = group_by_ray(ray_index, tri_index, len(rays))
             return locations, hits
         return locations
 
@@ -83,8 +91,12 @@ class RayMeshIntersector:
         ---------
         hits_any: (n) boolean array of whether or not each ray hit any triangle
         '''
-        hits = self.intersects_id(rays)
-        hits_any = np.array([len(i) > 0 for i in hits])
+        rays = np.array(rays, dtype=float)
+        ray_index = rays_triangles_bvh(triangles=self.mesh.triangles,
+                                       rays=rays,
+                                       bvh=self.mesh.triangles_bvh)[0]
+        hits_any = np.zeros(len(rays), dtype=bool)
+        hits_any[ray_index] = True
         return hits_any
 
     def intersects_any(self, rays):
@@ -105,6 +117,30 @@ class RayMeshIntersector:
         return hit
 
 
+def group_by_ray(ray_index, values, ray_count):
+    '''
+    Split per- intersection values into one group per ray.
+
+    Arguments
+    ---------
+    ray_index: (p) int, ray of each intersection
+    values:    (p, *) values of each intersection
+    ray_count: int, number of rays
+
+    Returns
+    ---------
+    groups: (ray_count) object array, groups[i] holds the values of ray i
+    '''
+    order = np.argsort(ray_index, kind='stable')
+    splits = np.searchsorted(ray_index[order], np.arange(1, ray_count))
+    groups = np.empty(ray_count, dtype=object)
+    if ray_count == 0:
+        return groups
+    for i, group in enumerate(np.split(values[order], splits)):
+        groups[i] = group
+    return groups
+
+
 def ray_triangle_candidates(rays, tree):
     '''
     Do broad- phase search for triangles that the rays
@@ -108,3 +108,46 @@ def ray_triangles(triangles,
     candidates[candidates] = t > tol.zero
 
     return candidates
+
+
+def rays_triangles_pairs(triangles,
+                         ray_origins,
+                         ray_directions):
+    '''
+    Intersection of ray i and triangle i for every i.
+
+    Moller-Trumbore intersection algorithm, with the same
+    tolerances as ray_triangles.
+
+    Arguments
+    ---------
+    triangles:      (p, 3, 3) float array of triangle vertices
+    ray_origins:    (p, 3) float array of ray origins
+    ray_directions: (p, 3) float array of ray directions
+
+    Returns
+    ---------
+    hit: (p) bool, whether ray i hits triangle i
+    t:   (p) float, location = ray origin + t * ray direction,
+         only meaningful where hit is True
+    '''
+    vert0 = triangles[:, 0, :]
+    edge0 = triangles[:, 1, :] - vert0
+    edge1 = triangles[:, 2, :] - vert0
+
+    P = np.cross(ray_directions, edge1)
+    det = diagonal_dot(edge0, P)
+    hit = np.abs(det) >= tol.zero
+    inv_det = np.zeros(len(det))
+    inv_det[hit] = 1.0 / det[hit]
+
+    T = ray_origins - vert0
+    u = diagonal_dot(T, P) * inv_det
+    Q = np.cross(T, edge0)
+    v = diagonal_dot(ray_directions, Q) * inv_det
+    t = diagonal_dot(edge1, Q) * inv_det
+
+    hit &= np.logical_not(np.logical_or(u < -tol.zero, u > (1 + tol.zero)))
+    hit &= np.logical_not(np.logical_or(v < -tol.zero, u + v > (1 + tol.zero)))
+    hit &= t > tol.zero
+    return hit, t
@@ -0,0 +1,197 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+
+# one record of an info list, see define_grasp and define_pushing
+GRASP_DTYPE = np.dtype([('jaw_width', np.float64),
+                        ('jaw_center_pos', np.float64, (3,)),
+                        ('jaw_center_rotmat', np.float64, (3, 3)),
+                        ('hnd_pos', np.float64, (3,)),
+                        ('hnd_rotmat', np.float64, (3, 3))])
+PUSH_DTYPE = np.dtype([('tip_pos', np.float64, (3,)),
+                       ('tip_rotmat', np.float64, (3, 3)),
+                       ('hnd_pos', np.float64, (3,)),
+                       ('hnd_rotmat', np.float64, (3, 3))])
+DTYPES = {'grasp': GRASP_DTYPE, 'push': PUSH_DTYPE}
+
+
+class GraspStore(object):
+    """
+    A directory of grasps (or pushes) of many objects
+    The records of an object are kept in a raw binary file of GRASP_DTYPE (PUSH_DTYPE), one column per entry of the
+    info lists, and an index.json maps the names of the objects to their files and numbers of records.
+    Reading an object memory-maps its file only; writing or appending an object touches its file and the index only.
+    The index is replaced atomically, records beyond the count of the index (e.g. of an interrupted append) are
+    ignored and overwritten by the next append.
+    """
+
+    def __init__(self, directory, kind='grasp'):
+        """
+        :param directory: created if it does not exist
+        :param kind: 'grasp' or 'push', the kind of an existing store is read from its index
+        """
+        if kind not in DTYPES:
+            raise ValueError("Kind must be grasp or push!")
+        self.directory = directory
+        self._index_path = os.path.join(directory, 'index.json')
+        if os.path.isfile(self._index_path):
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+            self.kind = index['kind']
+            self._objects = index['objects']
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.kind = kind
+            self._objects = {}
+            self._save_index()
+        self.dtype = DTYPES[self.kind]
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, objcm_name):
+        return objcm_name in self._objects
+
+    def names(self):
+        return list(self._objects.keys())
+
+    def count(self, objcm_name):
+        """
+        :return: number of records of the object
+        """
+        return self._objects[objcm_name]['count']
+
+    def _save_index(self):
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'kind': self.kind, 'objects': self._objects}, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _to_records(self, info_list):
+        records = np.zeros(len(info_list), dtype=self.dtype)
+        if len(info_list) > 0:
+            for i, field in enumerate(self.dtype.names):
+                records[field] = np.array([info[i] for info in info_list])
+        return records
+
+    def write(self, objcm_name, info_list, append=False):
+        """
+        :param objcm_name:
+        :param info_list: [[jaw_width, gl_jaw_center_pos, gl_jaw_center_rotmat, hnd_pos, hnd_rotmat], ...] or
+                          [[gl_tip_pos, gl_tip_rotmat, hnd_pos, hnd_rotmat], ...] for pushes
+        :param append: add the records after the existing ones of objcm_name, replace them otherwise
+        :return:
+        """
+        records = self._to_records(info_list)
+        if append and objcm_name in self._objects:
+            entry = self._objects[objcm_name]
+            with open(os.path.join(self.directory, entry['file']), 'r+b') as f:
+                f.seek(entry['count'] * self.dtype.itemsize)
+                f.write(records.tobytes())
+                f.truncate()
+            entry['count'] += len(records)
+            self._save_index()
+            return
+        old_entry = self._write_file(objcm_name, records)
+        self._save_index()
+        if old_entry is not None:
+            os.remove(os.path.join(self.directory, old_entry['file']))
+
+    def _write_file(self, objcm_name, records):
+        """
+        write the records to a new file and point the index (not saved) to it, the old file is swapped in by
+        the index and must be removed after the index is saved
+        :return: the old entry of the index, None if objcm_name is new
+        """
+        file_name = f"{hashlib.md5(objcm_name.encode()).hexdigest()}_{os.urandom(4).hex()}.bin"
+        with open(os.path.join(self.directory, file_name), 'wb') as f:
+            f.write(records.tobytes())
+        old_entry = self._objects.get(objcm_name)
+        self._objects[objcm_name] = {'file': file_name, 'count': len(records)}
+        return old_entry
+
+    def load_array(self, objcm_name):
+        """
+        :param objcm_name:
+        :return: read-only memmap of self.dtype, e.g. load_array(name)['hnd_pos'] is a Nx3 column
+        """
+        if objcm_name not in self._objects:
+            raise ValueError("File or data not found!")
+        entry = self._objects[objcm_name]
+        if entry['count'] == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(os.path.join(self.directory, entry['file']), dtype=self.dtype, mode='r',
+                         shape=(entry['count'],))
+
+    def load(self, objcm_name):
+        """
+        :param objcm_name:
+        :return: the info list, see write
+        """
+        records = self.load_array(objcm_name)
+        columns = [np.array(records[field]) for field in self.dtype.names]
+        return [[float(column[i]) if column.ndim == 1 else column[i] for column in columns]
+                for i in range(len(records))]
+
+    def delete(self, objcm_name):
+        entry = self._objects.pop(objcm_name)
+        self._save_index()
+        os.remove(os.path.join(self.directory, entry['file']))
+
+
+def migrate_pickle_file(pickle_path, directory, kind='grasp'):
+    """
+    copy the objects of a pickle file of write_pickle_file into a GraspStore, existing objects are replaced
+    :param pickle_path:
+    :param directory: see GraspStore
+    :param kind: 'grasp' or 'push'
+    :return: the GraspStore
+    """
+    with open(pickle_path, 'rb') as f:
+        data = pickle.load(f)
+    store = GraspStore(directory, kind=kind)
+    # the index is saved once
+    old_entries = [store._write_file(objcm_name, store._to_records(info_list)) for objcm_name, info_list in
+                   data.items()]
+    store._save_index()
+    for old_entry in old_entries:
+        if old_entry is not None:
+            os.remove(os.path.join(directory, old_entry['file']))
+    return store
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import shutil
+    import tempfile
+
+    if len(sys.argv) == 4:
+        # python grasp_store.py preannotated_grasps.pickle preannotated_grasps grasp
+        store = migrate_pickle_file(sys.argv[1], sys.argv[2], kind=sys.argv[3])
+        print(f"{len(store)} objects migrated to {sys.argv[2]}")
+        sys.exit()
+    # many objects, the pickle file vs the store
+    directory = tempfile.mkdtemp()
+    rotmat = np.eye(3)
+    data = {f"object{i}": [[.05, np.random.rand(3), rotmat, np.random.rand(3), rotmat] for _ in range(200)]
+            for i in range(1000)}
+    pickle_path = os.path.join(directory, 'preannotated_grasps.pickle')
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(data, f)
+    tic = time.time()
+    store = migrate_pickle_file(pickle_path, os.path.join(directory, 'preannotated_grasps'))
+    print(f"migrate {len(store)} objects: {time.time() - tic:.2f}s")
+    tic = time.time()
+    with open(pickle_path, 'rb') as f:
+        grasp_info_list = pickle.load(f)['object500']
+    print(f"pickle, load one object: {time.time() - tic:.4f}s")
+    tic = time.time()
+    grasp_info_list = GraspStore(os.path.join(directory, 'preannotated_grasps')).load('object500')
+    print(f"store, load one object: {time.time() - tic:.4f}s")
+    tic = time.time()
+    store.write('object500', grasp_info_list[:10], append=True)
+    print(f"store, append to one object: {time.time() - tic:.4f}s, {store.count('object500')} grasps")
+    shutil.rmtree(directory)
@@ -1,7 +1,9 @@
+import os
 import math
 import pickle
 import numpy as np
 import basis.robot_math as rm
+import grasping.annotation.grasp_store as gs
 
 
 def define_grasp(hnd_s,
@@ -114,6 +116,54 @@ def define_grasp_with_rotation(hnd_s,
     return grasp_info_list
 
 
+def define_grasp_with_rotation_batch(hnd_s,
+                                     objcm,
+                                     gl_jaw_center_pos,
+                                     gl_jaw_center_z,
+                                     gl_jaw_center_y,
+                                     jaw_width,
+                                     gl_rotation_ax,
+                                     rotation_interval=math.radians(60),
+                                     rotation_range=(math.radians(-180), math.radians(180)),
+                                     toggle_flip=True):
+    """
+    the vectorized counterpart of define_grasp_with_rotation, returns the same grasps in the same order
+    the jaw is moved to jaw_width once, the jaw center frames and the hand poses of all rotations (and flips) are
+    computed as stacked arrays, and filtered by hnd_s.is_mesh_collided_batch; hnd_s keeps its pose
+    :param hnd_s:
+    :param objcm:
+    :param gl_jaw_center_pos:
+    :param gl_jaw_center_z: hand approaching direction
+    :param gl_jaw_center_y: normal direction of thumb's contact surface
+    :param jaw_width:
+    :param gl_rotation_ax:
+    :param rotation_interval:
+    :param rotation_range:
+    :param toggle_flip:
+    :return: a list [[jaw_width, gl_jaw_center_pos, gl_jaw_center_rotmat, pos, rotmat], ...]
+    """
+    rotmats = rm.rotmats_from_axangles(gl_rotation_ax,
+                                       np.arange(rotation_range[0], rotation_range[1], rotation_interval))
+    gl_jaw_center_zs = rotmats.dot(gl_jaw_center_z)
+    gl_jaw_center_ys = rotmats.dot(gl_jaw_center_y)
+    if toggle_flip:
+        gl_jaw_center_zs = np.concatenate([gl_jaw_center_zs, gl_jaw_center_zs])
+        gl_jaw_center_ys = np.concatenate([gl_jaw_center_ys, rotmats.dot(-np.asarray(gl_jaw_center_y))])
+    # see GripperInterface.grip_at_with_jczy
+    gl_jaw_center_rotmats = np.empty((len(gl_jaw_center_zs), 3, 3))
+    gl_jaw_center_rotmats[:, :, 2] = gl_jaw_center_zs / np.linalg.norm(gl_jaw_center_zs, axis=1, keepdims=True)
+    gl_jaw_center_rotmats[:, :, 1] = gl_jaw_center_ys / np.linalg.norm(gl_jaw_center_ys, axis=1, keepdims=True)
+    gl_jaw_center_rotmats[:, :, 0] = np.cross(gl_jaw_center_rotmats[:, :, 1], gl_jaw_center_rotmats[:, :, 2])
+    # jaw_to first, the jaw center of some grippers (e.g. robotiq140) depends on the jaw width
+    hnd_s.jaw_to(jaw_width)
+    eef_root_poss, eef_root_rotmats = hnd_s.get_eef_root_poses_batch(np.tile(gl_jaw_center_pos,
+                                                                             (len(gl_jaw_center_rotmats), 1)),
+                                                                     gl_jaw_center_rotmats)
+    is_collided_array = hnd_s.is_mesh_collided_batch(eef_root_poss, eef_root_rotmats, [objcm])
+    return [[jaw_width, gl_jaw_center_pos, gl_jaw_center_rotmats[i], eef_root_poss[i], eef_root_rotmats[i]]
+            for i in np.flatnonzero(~is_collided_array)]
+
+
 def define_pushing(hnd_s,
                    objcm,
                    gl_surface_pos,
@@ -160,7 +210,13 @@ def define_pushing(hnd_s,
     return push_info_list
 
 
-def write_pickle_file(objcm_name, grasp_info_list, root=None, file_name='preannotated_grasps.pickle', append=False):
+def write_pickle_file(objcm_name,
+                      grasp_info_list,
+                      root=None,
+                      file_name='preannotated_grasps.pickle',
+                      append=False,
+                      toggle_store=False,
+                      kind='grasp'):
     """
     if model_name was saved, replace the old grasp info.
     if model_name was never saved, additionally save it.
@@ -168,6 +224,9 @@ def write_pickle_file(objcm_name, grasp_info_list, root=None, file_name='preanno
     :param grasp_info_list:
     :param root:
     :param file_name:
+    :param toggle_store: save to the GraspStore in the directory named file_name without extension instead,
+                         only the records of objcm_name are written
+    :param kind: 'grasp' or 'push', the kind of a new GraspStore
     :return:
     author: chenhao, revised by weiwei
     date: 20200104
@@ -176,6 +235,10 @@ def write_pickle_file(objcm_name, grasp_info_list, root=None, file_name='preanno
         directory = "./"
     else:
         directory = root + "/"
+    if toggle_store:
+        store = gs.GraspStore(directory + os.path.splitext(file_name)[0], kind=kind)
+        store.write(objcm_name, grasp_info_list, append=append)
+        return
     try:
         data = pickle.load(open(directory + file_name, 'rb'))
     except:
@@ -190,11 +253,13 @@ def write_pickle_file(objcm_name, grasp_info_list, root=None, file_name='preanno
     pickle.dump(data, open(directory + file_name, 'wb'))
 
 
-def load_pickle_file(objcm_name, root=None, file_name='preannotated_grasps.pickle'):
+def load_pickle_file(objcm_name, root=None, file_name='preannotated_grasps.pickle', toggle_store=False):
     """
     :param objcm_name:
     :param root:
     :param file_name:
+    :param toggle_store: load from the GraspStore in the directory named file_name without extension instead,
+                         only the records of objcm_name are read
     :return:
     author: chenhao, revised by weiwei
     date: 20200105
@@ -203,6 +268,11 @@ def load_pickle_file(objcm_name, root=None, file_name='preannotated_grasps.pickl
         directory = "./"
     else:
         directory = root + "/"
+    if toggle_store:
+        store_directory = directory + os.path.splitext(file_name)[0]
+        if not os.path.isfile(os.path.join(store_directory, 'index.json')):
+            raise ValueError("File or data not found!")
+        return gs.GraspStore(store_directory).load(objcm_name)
     try:
         data = pickle.load(open(directory + file_name, 'rb'))
         for k, v in data.items():
@@ -217,13 +287,31 @@ if __name__ == '__main__':
     import os
     import basis
     import robot_sim.end_effectors.gripper.xarm_gripper.xarm_gripper as xag
+    import robot_sim.end_effectors.gripper.robotiq140.robotiq140 as rtq140
     import modeling.collision_model as cm
     import visualization.panda.world as wd
 
     base = wd.World(cam_pos=[.5, .5, .3], lookat_pos=[0, 0, 0])
-    gripper_s = xag.XArmGripper(enable_cc=True)
     objpath = os.path.join(basis.__path__[0], 'objects', 'block.stl')
     objcm = cm.CollisionModel(objpath)
+    # the loop vs the batch, the jaw center of robotiq140 depends on the jaw width
+    gripper_s = rtq140.Robotiq140(enable_cc=True)
+    grasp_args = dict(gl_jaw_center_pos=np.array([0, 0, 0]),
+                      gl_jaw_center_z=np.array([1, 0, 0]),
+                      gl_jaw_center_y=np.array([0, 1, 0]),
+                      jaw_width=.03,
+                      gl_rotation_ax=np.array([0, 0, 1]))
+    gripper_s.jaw_to(gripper_s.jaw_range[1])
+    grasp_info_list = define_grasp_with_rotation(gripper_s, objcm, **grasp_args)
+    gripper_s.jaw_to(gripper_s.jaw_range[1])
+    batch_grasp_info_list = define_grasp_with_rotation_batch(gripper_s, objcm, **grasp_args)
+    is_same = len(grasp_info_list) == len(batch_grasp_info_list) and \
+              all(np.allclose(value, batch_value)
+                  for grasp_info, batch_grasp_info in zip(grasp_info_list, batch_grasp_info_list)
+                  for value, batch_value in zip(grasp_info, batch_grasp_info))
+    print(f"robotiq140, loop: {len(grasp_info_list)} grasps, batch: {len(batch_grasp_info_list)} grasps, "
+          f"same: {is_same}")
+    gripper_s = xag.XArmGripper(enable_cc=True)
     objcm.attach_to(base)
     objcm.show_localframe()
     grasp_info_list = define_grasp_with_rotation(gripper_s,
@@ -1,4 +1,6 @@
 import math
+import functools
+import concurrent.futures as cf
 import numpy as np
 import basis.robot_math as rm
 import grasping.annotation.utils as gu
@@ -44,6 +46,118 @@ def plan_contact_pairs(objcm,
     return contact_pairs
 
 
+def plan_contact_pairs_batch(objcm,
+                             max_samples=100,
+                             min_dist_between_sampled_contact_points=.005,
+                             angle_between_contact_normals=math.radians(160),
+                             toggle_sampled_points=False):
+    """
+    the vectorized counterpart of plan_contact_pairs, returns the same contact pairs in the same order
+    the rays of all samples are cast in one objcm.ray_hit_batch, the normals of all hits and the neighborhoods of
+    all opposing hits are tested with array ops; only the suppression of the samples near the accepted hits is
+    kept sequential, as it decides which samples shoot
+    :param angle_between_contact_normals:
+    :param toggle_sampled_points
+    :return: [[contact_p0, contact_p1], ...]
+    """
+    contact_points, contact_normals = objcm.sample_surface(nsample=max_samples,
+                                                           radius=min_dist_between_sampled_contact_points / 2,
+                                                           toggle_option='normals')
+    contact_points = np.asarray(contact_points)
+    contact_normals = np.asarray(contact_normals)
+    contact_pairs = []
+    rays = np.stack([contact_points - contact_normals * .001, contact_points - contact_normals * 100], axis=1)
+    ray_ids, hit_points, hit_normals, _ = objcm.ray_hit_batch(rays, option="all")
+    is_opposed = np.einsum('ij,ij->i', contact_normals[ray_ids], hit_normals) < -math.cos(angle_between_contact_normals)
+    ray_ids = ray_ids[is_opposed]
+    hit_points = hit_points[is_opposed]
+    hit_normals = hit_normals[is_opposed]
+    if len(ray_ids) > 0:
+        # the samples near each hit whose normals are within the angle of its normal
+        tree = cKDTree(contact_points)
+        near_points_indices = tree.query_ball_point(hit_points, min_dist_between_sampled_contact_points)
+        near_counts = np.array([len(indices) for indices in near_points_indices], dtype=int)
+        near_ids = np.concatenate([np.asarray(indices, dtype=int) for indices in near_points_indices])
+        near_hit_ids = np.repeat(np.arange(len(hit_points)), near_counts)
+        is_near = np.einsum('ij,ij->i', contact_normals[near_ids], hit_normals[near_hit_ids]) > \
+                  math.cos(angle_between_contact_normals)
+        near_ids_list = np.split(near_ids[is_near], np.cumsum(np.bincount(near_hit_ids[is_near],
+                                                                          minlength=len(hit_points)))[:-1])
+    # the hits of a sample are consecutive, ray_hit_batch returns them in the order of the rays
+    hit_starts = np.searchsorted(ray_ids, np.arange(len(contact_points)))
+    hit_ends = np.searchsorted(ray_ids, np.arange(len(contact_points)), side='right')
+    near_history = np.zeros(len(contact_points), dtype=bool)
+    for i in range(len(contact_points)):
+        if near_history[i]:  # if the point was previous near to some points, ignore
+            continue
+        for k in range(hit_starts[i], hit_ends[i]):
+            near_history[near_ids_list[k]] = True
+            contact_pairs.append([[contact_points[i], contact_normals[i]], [hit_points[k], hit_normals[k]]])
+    if toggle_sampled_points:
+        return contact_pairs, contact_points
+    return contact_pairs
+
+
+def _plan_grasps_at_contact_pair(hnd_s,
+                                 objcm,
+                                 contact_pair,
+                                 openning_direction,
+                                 rotation_interval,
+                                 contact_offset):
+    """
+    the collision-free grasps of one contact pair, see plan_grasps
+    :return: a list [[jaw_width, gl_jaw_center_pos, pos, rotmat], ...]
+    """
+    contact_p0, contact_n0 = contact_pair[0]
+    contact_p1, contact_n1 = contact_pair[1]
+    contact_center = (contact_p0 + contact_p1) / 2
+    jaw_width = np.linalg.norm(contact_p0 - contact_p1) + contact_offset * 2
+    if jaw_width > hnd_s.jaw_range[1]:
+        return []
+    if openning_direction == 'loc_x':
+        jaw_center_x = contact_n0
+        jaw_center_z = rm.orthogonal_vector(contact_n0)
+        jaw_center_y = np.cross(jaw_center_z, jaw_center_x)
+    elif openning_direction == 'loc_y':
+        jaw_center_y = contact_n0
+        jaw_center_z = rm.orthogonal_vector(contact_n0)
+    else:
+        raise ValueError("Openning direction must be loc_x or loc_y!")
+    return gu.define_grasp_with_rotation_batch(hnd_s,
+                                               objcm,
+                                               gl_jaw_center_pos=contact_center,
+                                               gl_jaw_center_z=jaw_center_z,
+                                               gl_jaw_center_y=jaw_center_y,
+                                               jaw_width=jaw_width,
+                                               gl_rotation_ax=contact_n0,
+                                               rotation_interval=rotation_interval,
+                                               toggle_flip=True)
+
+
+# the gripper and object of a worker process, set once by _init_worker
+_worker_hnd_s = None
+_worker_objcm = None
+
+
+def _init_worker(hnd_factory, objtrm, cdmesh_type, pos, rotmat):
+    global _worker_hnd_s, _worker_objcm
+    import modeling.collision_model as cm
+    _worker_hnd_s = hnd_factory()
+    # objtrm is already scaled, the rebuilt model has the same cdmesh as the original one
+    _worker_objcm = cm.CollisionModel(objtrm, cdmesh_type=cdmesh_type)
+    _worker_objcm.set_pos(pos)
+    _worker_objcm.set_rotmat(rotmat)
+
+
+def _plan_grasps_at_contact_pairs(contact_pairs, openning_direction, rotation_interval, contact_offset):
+    return [_plan_grasps_at_contact_pair(_worker_hnd_s,
+                                         _worker_objcm,
+                                         contact_pair,
+                                         openning_direction,
+                                         rotation_interval,
+                                         contact_offset) for contact_pair in contact_pairs]
+
+
 def plan_grasps(hnd_s,
                 objcm,
                 angle_between_contact_normals=math.radians(160),
@@ -51,7 +165,11 @@ def plan_grasps(hnd_s,
                 rotation_interval=math.radians(22.5),
                 max_samples=100,
                 min_dist_between_sampled_contact_points=.005,
-                contact_offset=.002):
+                contact_offset=.002,
+                nworkers=1,
+                hnd_factory=None,
+                chunk_size=4,
+                progress_callback=None):
     """
 
     :param objcm:
@@ -62,69 +180,111 @@ def plan_grasps(hnd_s,
     :param max_samples:
     :param min_dist_between_sampled_contact_points:
     :param contact_offset: offset at the cotnact to avoid being closely in touch with object surfaces
-    :return: a list [[jaw_width, gl_jaw_center_pos, pos, rotmat], ...]
+    :param nworkers: number of processes, the contact pairs are planned in this process if 1, os.cpu_count() if None
+    :param hnd_factory: a picklable callable that returns a gripper like hnd_s, built once by each worker,
+                        e.g. functools.partial(robotiq85.Robotiq85, cdmesh_type='convex_hull');
+                        the class of hnd_s with its cdmesh_type is used if None
+    :param chunk_size: number of contact pairs in a task of a worker
+    :param progress_callback: callable(ndone, ncontact_pairs), called after each contact pair (each chunk
+                              if nworkers > 1)
+    :return: a list [[jaw_width, gl_jaw_center_pos, pos, rotmat], ...], in the order of the contact pairs
     """
-    contact_pairs = plan_contact_pairs(objcm,
-                                       max_samples=max_samples,
-                                       min_dist_between_sampled_contact_points=min_dist_between_sampled_contact_points,
-                                       angle_between_contact_normals=angle_between_contact_normals)
+    contact_pairs = plan_contact_pairs_batch(
+        objcm,
+        max_samples=max_samples,
+        min_dist_between_sampled_contact_points=min_dist_between_sampled_contact_points,
+        angle_between_contact_normals=angle_between_contact_normals)
     grasp_info_list = []
-    import modeling.geometric_model as gm
-    for i, cp in enumerate(contact_pairs):
-        print(f"{i} of {len(contact_pairs)} done!")
-        contact_p0, contact_n0 = cp[0]
-        contact_p1, contact_n1 = cp[1]
-        contact_center = (contact_p0 + contact_p1) / 2
-        jaw_width = np.linalg.norm(contact_p0 - contact_p1) + contact_offset * 2
-        if jaw_width > hnd_s.jaw_range[1]:
-            continue
-        if openning_direction == 'loc_x':
-            jaw_center_x = contact_n0
-            jaw_center_z = rm.orthogonal_vector(contact_n0)
-            jaw_center_y = np.cross(jaw_center_z, jaw_center_x)
-        elif openning_direction == 'loc_y':
-            jaw_center_y = contact_n0
-            jaw_center_z = rm.orthogonal_vector(contact_n0)
-        else:
-            raise ValueError("Openning direction must be loc_x or loc_y!")
-        grasp_info_list += gu.define_grasp_with_rotation(hnd_s,
-                                                         objcm,
-                                                         gl_jaw_center_pos=contact_center,
-                                                         gl_jaw_center_z=jaw_center_z,
-                                                         gl_jaw_center_y=jaw_center_y,
-                                                         jaw_width=jaw_width,
-                                                         gl_rotation_ax=contact_n0,
-                                                         rotation_interval=rotation_interval,
-                                                         toggle_flip=True)
+    if nworkers == 1:
+        for i, contact_pair in enumerate(contact_pairs):
+            grasp_info_list += _plan_grasps_at_contact_pair(hnd_s,
+                                                            objcm,
+                                                            contact_pair,
+                                                            openning_direction,
+                                                            rotation_interval,
+                                                            contact_offset)
+            if progress_callback is not None:
+                progress_callback(i + 1, len(contact_pairs))
+        return grasp_info_list
+    if hnd_factory is None:
+        hnd_factory = functools.partial(type(hnd_s), cdmesh_type=hnd_s.cdmesh_type)
+    with cf.ProcessPoolExecutor(max_workers=nworkers,
+                                initializer=_init_worker,
+                                initargs=(hnd_factory, objcm.objtrm, objcm.cdmesh_type, objcm.get_pos(),
+                                          objcm.get_rotmat())) as executor:
+        # the chunks are collected in the order they are submitted, the result does not depend on the workers
+        futures = [executor.submit(_plan_grasps_at_contact_pairs,
+                                   contact_pairs[start:start + chunk_size],
+                                   openning_direction,
+                                   rotation_interval,
+                                   contact_offset) for start in range(0, len(contact_pairs), chunk_size)]
+        for i, future in enumerate(futures):
+            for pair_grasp_info_list in future.result():
+                grasp_info_list += pair_grasp_info_list
+            if progress_callback is not None:
+                progress_callback(min((i + 1) * chunk_size, len(contact_pairs)), len(contact_pairs))
     return grasp_info_list
 
 
-def write_pickle_file(objcm_name, grasp_info_list, root=None, file_name='preannotated_grasps.pickle', append=False):
+def write_pickle_file(objcm_name,
+                      grasp_info_list,
+                      root=None,
+                      file_name='preannotated_grasps.pickle',
+                      append=False,
+                      toggle_store=False):
     if root is None:
         root = './'
-    gu.write_pickle_file(objcm_name, grasp_info_list, root=root, file_name=file_name, append=append)
+    gu.write_pickle_file(objcm_name,
+                         grasp_info_list,
+                         root=root,
+                         file_name=file_name,
+                         append=append,
+                         toggle_store=toggle_store,
+                         kind='grasp')
 
 
-def load_pickle_file(objcm_name, root=None, file_name='preannotated_grasps.pickle'):
+def load_pickle_file(objcm_name, root=None, file_name='preannotated_grasps.pickle', toggle_store=False):
     if root is None:
         root = './'
-    return gu.load_pickle_file(objcm_name, root=root, file_name=file_name)
+    return gu.load_pickle_file(objcm_name, root=root, file_name=file_name, toggle_store=toggle_store)
 
 
 if __name__ == '__main__':
     import os
+    import time
     import basis
-    import robot_sim.end_effectors.gripper.xarm_gripper.xarm_gripper as xag
+    import robot_sim.end_effectors.gripper.robotiq85.robotiq85 as rtq85
     import modeling.collision_model as cm
     import visualization.panda.world as wd
 
+    # contact pairs, the loop vs the batch
+    bunnycm = cm.CollisionModel(os.path.join(basis.__path__[0], 'objects', 'bunnysim.stl'))
+    for max_samples, min_dist in [(100, .005), (1000, .005), (5000, .001)]:
+        np.random.seed(0)
+        tic = time.time()
+        contact_pairs = plan_contact_pairs(bunnycm, max_samples, min_dist)
+        toc = time.time() - tic
+        np.random.seed(0)
+        tic = time.time()
+        batch_contact_pairs = plan_contact_pairs_batch(bunnycm, max_samples, min_dist)
+        print(f"bunnysim, {max_samples} samples: {len(contact_pairs)} contact pairs, loop {toc:.4f}s, "
+              f"{len(batch_contact_pairs)} contact pairs, batch {time.time() - tic:.4f}s")
     base = wd.World(cam_pos=[.5, .5, .3], lookat_pos=[0, 0, 0])
-    gripper_s = xag.XArmGripper(enable_cc=True)
+    gripper_s = rtq85.Robotiq85(enable_cc=True)
     objpath = os.path.join(basis.__path__[0], 'objects', 'block.stl')
     objcm = cm.CollisionModel(objpath)
     objcm.attach_to(base)
     objcm.show_localframe()
-    grasp_info_list = plan_grasps(gripper_s, objcm, min_dist_between_sampled_contact_points=.02)
+    np.random.seed(0)
+    tic = time.time()
+    grasp_info_list = plan_grasps(gripper_s, objcm, min_dist_between_sampled_contact_points=.02,
+                                  progress_callback=lambda ndone, ntotal: print(f"{ndone} of {ntotal} done!"))
+    print(f"serial: {len(grasp_info_list)} grasps, {time.time() - tic:.2f}s")
+    np.random.seed(0)
+    tic = time.time()
+    parallel_grasp_info_list = plan_grasps(gripper_s, objcm, min_dist_between_sampled_contact_points=.02,
+                                           nworkers=None)
+    print(f"{os.cpu_count()} workers: {len(parallel_grasp_info_list)} grasps, {time.time() - tic:.2f}s")
     for grasp_info in grasp_info_list:
         jaw_width, gl_jaw_center_pos, gl_jaw_center_rotmat, hnd_pos, hnd_rotmat = grasp_info
         gic = gripper_s.copy()
@@ -44,16 +44,27 @@ def plan_pushing(hnd_s,
     return push_info_list
 
 
-def write_pickle_file(objcm_name, push_info_list, root=None, file_name='preannotated_push.pickle', append=False):
+def write_pickle_file(objcm_name,
+                      push_info_list,
+                      root=None,
+                      file_name='preannotated_push.pickle',
+                      append=False,
+                      toggle_store=False):
     if root is None:
         root = './'
-    gu.write_pickle_file(objcm_name, push_info_list, root=root, file_name=file_name, append=append)
+    gu.write_pickle_file(objcm_name,
+                         push_info_list,
+                         root=root,
+                         file_name=file_name,
+                         append=append,
+                         toggle_store=toggle_store,
+                         kind='push')
 
 
-def load_pickle_file(objcm_name, root=None, file_name='preannotated_push.pickle'):
+def load_pickle_file(objcm_name, root=None, file_name='preannotated_push.pickle', toggle_store=False):
     if root is None:
         root = './'
-    return gu.load_pickle_file(objcm_name, root=root, file_name=file_name)
+    return gu.load_pickle_file(objcm_name, root=root, file_name=file_name, toggle_store=toggle_store)
 
 
 if __name__ == '__main__':
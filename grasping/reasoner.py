@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def get_collisionfree_graspids(hnd, grasp_info_list, goal_info, obstacle_list):
     """
     :param hnd:
@@ -47,5 +50,69 @@ def get_common_collisionfree_graspids(hnd, grasp_info_list, goal_info_list, obst
     final_avilable_graspids = previously_available_graspids
     return final_avilable_graspids, intermediate_available_graspids
 
+
+def get_collisionfree_graspids_batch(hnd, grasp_info_list, goal_info, obstacle_list):
+    """
+    the batched counterpart of get_collisionfree_graspids, see get_common_collisionfree_graspids_batch
+    :param hnd:
+    :param grasp_info_list:
+    :param goal_info: [goal_pos, goal_rotmat]
+    :param obstacle_list
+    :return:
+    """
+    return get_common_collisionfree_graspids_batch(hnd, grasp_info_list, [goal_info], obstacle_list)[0]
+
+
+def get_common_collisionfree_graspids_batch(hnd, grasp_info_list, goal_info_list, obstacle_list):
+    """
+    the batched counterpart of get_common_collisionfree_graspids, returns the same ids
+    the hand poses of all grasps at all goals are computed in one pass; the jaw is moved once for each jaw width and
+    the grasps of a jaw width are checked together by hnd.is_mesh_collided_batch, which rejects the poses whose
+    bounds do not overlap the obstacles before any mesh check; a grasp is only checked at a goal if it is free at
+    the previous goals, and goals with the same pose are checked once
+    the hand is left at the last jaw width and keeps its pose
+    :param hnd:
+    :param grasp_info_list: [[jaw_width, ..., loc_hnd_pos, loc_hnd_rotmat], ...]
+    :param goal_info_list: [[goal_pos, goal_rotmat], ...]
+    :param obstacle_list
+    :return:
+    """
+    if len(grasp_info_list) == 0:
+        return [], [[] for _ in goal_info_list]
+    jaw_widths = np.array([grasp_info[0] for grasp_info in grasp_info_list])
+    loc_hnd_poss = np.array([grasp_info[-2] for grasp_info in grasp_info_list])
+    loc_hnd_rotmats = np.array([grasp_info[-1] for grasp_info in grasp_info_list])
+    goal_poss = np.array([goal_info[0] for goal_info in goal_info_list]).reshape(-1, 3)
+    goal_rotmats = np.array([goal_info[1] for goal_info in goal_info_list]).reshape(-1, 3, 3)
+    # GxN hand poses
+    gl_hnd_poss = np.einsum('gij,nj->gni', goal_rotmats, loc_hnd_poss) + goal_poss[:, np.newaxis]
+    gl_hnd_rotmats = np.einsum('gij,njk->gnik', goal_rotmats, loc_hnd_rotmats)
+    # the first goal with the same pose
+    goal_id_dict = {}
+    first_goal_ids = [goal_id_dict.setdefault(goal_poss[i].tobytes() + goal_rotmats[i].tobytes(), i)
+                      for i in range(len(goal_info_list))]
+    is_available = np.zeros((len(goal_info_list), len(grasp_info_list)), dtype=bool)
+    for jaw_width in np.unique(jaw_widths):
+        graspids = np.flatnonzero(jaw_widths == jaw_width)
+        hnd.jaw_to(jaw_width)
+        is_alive = np.ones(len(graspids), dtype=bool)
+        is_free_dict = {}  # {first goal id: is_free of graspids}
+        for goal_id, first_goal_id in enumerate(first_goal_ids):
+            if first_goal_id not in is_free_dict:
+                is_free = np.zeros(len(graspids), dtype=bool)
+                alive_ids = np.flatnonzero(is_alive)
+                is_free[alive_ids] = ~hnd.is_mesh_collided_batch(gl_hnd_poss[goal_id, graspids[alive_ids]],
+                                                                 gl_hnd_rotmats[goal_id, graspids[alive_ids]],
+                                                                 obstacle_list)
+                is_free_dict[first_goal_id] = is_free
+            is_alive &= is_free_dict[first_goal_id]
+            is_available[goal_id, graspids] = is_alive
+    intermediate_available_graspids = [np.flatnonzero(is_available_at_goal).tolist() for is_available_at_goal in
+                                       is_available]
+    final_avilable_graspids = intermediate_available_graspids[-1] if len(goal_info_list) > 0 else \
+        list(range(len(grasp_info_list)))
+    return final_avilable_graspids, intermediate_available_graspids
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -36,15 +36,18 @@ def copy_cdmesh(obj_ot_geom):
 #     bulletplnode.addShape(bulletplshape)
 #     return bulletplnode
 
-def is_collided(obj_ode_trimesh0, obj_ode_trimesh1):
+def is_collided(obj_ode_trimesh0, obj_ode_trimesh1, toggle_contacts=True):
     """
     check if two odetrimesh are collided
     :param obj_ode_trimesh00: an instance of OdeTriMeshGeom
     :param obj_ode_trimesh1: an instance of OdeTriMeshGeom
+    :param toggle_contacts: return bool only if False, ode stops at the first contact and no points are extracted
     :return:
     author: weiwei
     date: 20210118, 20211215
     """
+    if not toggle_contacts:
+        return OdeUtil.collide(obj_ode_trimesh0, obj_ode_trimesh1, max_contacts=1).getNumContacts() > 0
     contact_entry = OdeUtil.collide(obj_ode_trimesh0, obj_ode_trimesh1, max_contacts=10)
     contact_points = [da.pdv3_to_npv3(point) for point in contact_entry.getContactPoints()]
     return (True, contact_points) if len(contact_points) > 0 else (False, contact_points)
@@ -100,6 +103,56 @@ def rayhit_all(pfrom, pto, objcm):
     hit_normals = [da.pdv3_to_npv3(hit_entry.getContactGeom(i).getNormal()) for i in range(hit_entry.getNumContacts())]
     return hit_points, hit_normals
 
+def rayhit_batch(rays, obj_ode_trimesh, option="closest"):
+    """
+    cast many rays against a posed OdeTriMeshGeom, the geom is reused for all rays
+    :param rays: Nx2x3 nparray, rays[i] = [point_from, point_to]
+    :param obj_ode_trimesh: an instance of OdeTriMeshGeom
+    :param option: "closest" or "all"
+    :return: "closest": hit_points Nx3, hit_normals Nx3 (nan for missed rays), face_ids 1xN (-1 for missed rays);
+             "all": ray_ids 1xK (the ray of each hit), hit_points Kx3, hit_normals Kx3, face_ids 1xK
+    """
+    rays = np.asarray(rays, dtype=float).reshape(-1, 2, 3)
+    directions = rays[:, 1] - rays[:, 0]
+    lengths = np.linalg.norm(directions, axis=1)
+    directions[lengths > 0] /= lengths[lengths > 0, np.newaxis]
+    ray = OdeRayGeom(length=1)
+    ray.setClosestHit(option == "closest")
+    ray_ids = []
+    hit_points = []
+    hit_normals = []
+    face_ids = []
+    for i, (pfrom, direction, length) in enumerate(zip(rays[:, 0].tolist(), directions.tolist(), lengths.tolist())):
+        if length == 0:
+            continue
+        ray.set(pfrom[0], pfrom[1], pfrom[2], direction[0], direction[1], direction[2])
+        ray.setLength(length)
+        hit_entry = OdeUtil.collide(ray, obj_ode_trimesh, max_contacts=150)
+        for j in range(hit_entry.getNumContacts()):
+            contact_geom = hit_entry.getContactGeom(j)
+            ray_ids.append(i)
+            hit_points.append(list(contact_geom.getPos()))
+            hit_normals.append(list(contact_geom.getNormal()))
+            face_ids.append(contact_geom.getSide2())
+    ray_ids = np.array(ray_ids, dtype=int)
+    hit_points = np.array(hit_points, dtype=float).reshape(-1, 3)
+    hit_normals = np.array(hit_normals, dtype=float).reshape(-1, 3)
+    face_ids = np.array(face_ids, dtype=int)
+    if option == "all":
+        return ray_ids, hit_points, hit_normals, face_ids
+    # keep the hit closest to point_from of each ray
+    closest_hit_points = np.full((len(rays), 3), np.nan)
+    closest_hit_normals = np.full((len(rays), 3), np.nan)
+    closest_face_ids = np.full(len(rays), -1, dtype=int)
+    dists = np.linalg.norm(hit_points - rays[ray_ids, 0], axis=1)
+    order = np.lexsort((dists, ray_ids))
+    hit_ray_ids, first_ids = np.unique(ray_ids[order], return_index=True)
+    selection = order[first_ids]
+    closest_hit_points[hit_ray_ids] = hit_points[selection]
+    closest_hit_normals[hit_ray_ids] = hit_normals[selection]
+    closest_face_ids[hit_ray_ids] = face_ids[selection]
+    return closest_hit_points, closest_hit_normals, closest_face_ids
+
 
 if __name__ == '__main__':
     import os, math, basis
@@ -0,0 +1,152 @@
+import os
+import hashlib
+import numpy as np
+import basis.trimesh as trm
+
+# the sphere trees of mesh files are saved here by load_sphere_tree if no cache_dir is given
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".wrs", "sphere_trees")
+
+
+def gen_sphere_tree(vertices, faces, max_radius=.01):
+    """
+    generate a hierarchy of spheres covering the surface of a mesh
+    the triangles are split until each of them fits into a sphere of max_radius, and then grouped top-down by
+    splitting at the median centroid along the longest axis; a node stops being split once the vertices of its
+    triangles fit into max_radius. Every sphere contains its triangles and the spheres of its children,
+    so a pruned node never hides an overlap of the leaves
+    :param vertices: nx3 nparray
+    :param faces: mx3 int nparray
+    :param max_radius: upper bound of the radii of the leaves
+    :return: a dictionary of flat arrays, node 0 is the root, k is the number of nodes
+             'centers': kx3 nparray, 'radii': 1xk nparray, 'children': kx2 int nparray, -1 for leaves
+    """
+    triangles = np.asarray(vertices, dtype=float)[np.asarray(faces, dtype=int)]
+    # the vertices of a triangle are within 2/3 of its longest edge from the centroid
+    max_edge_length = 1.5 * max_radius
+    while True:
+        edge_lengths = np.linalg.norm(triangles[:, [1, 2, 0]] - triangles, axis=2).max(axis=1)
+        is_large = edge_lengths > max_edge_length
+        if not is_large.any():
+            break
+        large_triangles = triangles[is_large]
+        mids = (large_triangles + large_triangles[:, [1, 2, 0]]) / 2  # mid01, mid12, mid20
+        triangles = np.concatenate([triangles[~is_large],
+                                    np.stack([large_triangles[:, 0], mids[:, 0], mids[:, 2]], axis=1),
+                                    np.stack([mids[:, 0], large_triangles[:, 1], mids[:, 1]], axis=1),
+                                    np.stack([mids[:, 2], mids[:, 1], large_triangles[:, 2]], axis=1),
+                                    mids])
+    centroids = triangles.mean(axis=1)
+    order = np.arange(len(triangles))
+    centers = []
+    radii = []
+    children = []
+    parents = []
+    # (node id, start, end) of the nodes still to be built
+    stack = [(0, 0, len(triangles))]
+    centers.append(None)
+    radii.append(None)
+    children.append([-1, -1])
+    parents.append(-1)
+    while len(stack) > 0:
+        node, node_start, node_end = stack.pop()
+        node_vertices = triangles[order[node_start:node_end]].reshape(-1, 3)
+        centers[node] = node_vertices.mean(axis=0)
+        radii[node] = np.linalg.norm(node_vertices - centers[node], axis=1).max()
+        if radii[node] <= max_radius or node_end - node_start == 1:
+            continue
+        node_centroids = centroids[order[node_start:node_end]]
+        axis = np.ptp(node_centroids, axis=0).argmax()
+        half = (node_end - node_start) // 2
+        order[node_start:node_end] = order[node_start:node_end][np.argpartition(node_centroids[:, axis], half)]
+        for child_start, child_end in [(node_start, node_start + half), (node_start + half, node_end)]:
+            centers.append(None)
+            radii.append(None)
+            children.append([-1, -1])
+            parents.append(node)
+            stack.append((len(centers) - 1, child_start, child_end))
+        children[node] = [len(centers) - 2, len(centers) - 1]
+    centers = np.array(centers, dtype=float).reshape(-1, 3)
+    radii = np.array(radii, dtype=float)
+    # children are created after their parents, grow the parents bottom-up to enclose the spheres of their children
+    for node in range(len(centers) - 1, 0, -1):
+        parent = parents[node]
+        radii[parent] = max(radii[parent], np.linalg.norm(centers[node] - centers[parent]) + radii[node])
+    return {'centers': centers, 'radii': radii, 'children': np.array(children, dtype=int)}
+
+
+def load_sphere_tree(objpath, max_radius=.01, cache_dir=None):
+    """
+    the sphere tree of a mesh file, generated once and saved under the md5 of the file and max_radius
+    :param objpath: path of the mesh file
+    :param max_radius: see gen_sphere_tree
+    :param cache_dir: DEFAULT_CACHE_DIR if None
+    :return: see gen_sphere_tree, in the frame of the file
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    with open(objpath, 'rb') as f:
+        file_md5 = hashlib.md5(f.read()).hexdigest()
+    file_name = os.path.join(cache_dir, f"{file_md5}_{max_radius:.6g}.npz")
+    if os.path.isfile(file_name):
+        with np.load(file_name) as data:
+            return {key: data[key] for key in data.files}
+    objtrm = trm.load(objpath)
+    sphere_tree = gen_sphere_tree(objtrm.vertices, objtrm.faces, max_radius=max_radius)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(file_name, **sphere_tree)
+    return sphere_tree
+
+
+def sphere_sphere_distances(centers0, radii0, centers1, radii1):
+    """
+    signed distances between spheres, negative if they overlap, the arguments are broadcast against each other
+    :param centers0: ...x3 nparray
+    :param radii0: ... nparray
+    :param centers1: ...x3 nparray
+    :param radii1: ... nparray
+    :return: ... nparray
+    """
+    differences = np.asarray(centers0) - centers1
+    return np.sqrt(np.einsum('...i,...i->...', differences, differences)) - radii0 - radii1
+
+
+def sphere_box_distances(centers, radii, box_centers, box_rotmats, box_half_extents):
+    """
+    signed distances between spheres and oriented boxes, negative if they overlap,
+    the arguments are broadcast against each other
+    :param centers: ...x3 nparray
+    :param radii: ... nparray
+    :param box_centers: ...x3 nparray
+    :param box_rotmats: ...x3x3 nparray, the columns are the axes of the boxes
+    :param box_half_extents: ...x3 nparray
+    :return: ... nparray
+    """
+    # matmul and the explicit reductions over the last axis of 3 are much faster than einsum, norm and max here
+    loc_centers = np.matmul((np.asarray(centers) - box_centers)[..., np.newaxis, :], box_rotmats)[..., 0, :]
+    offsets = np.abs(loc_centers) - box_half_extents
+    outside_offsets = np.maximum(offsets, 0)
+    outside_distances = np.sqrt(np.einsum('...i,...i->...', outside_offsets, outside_offsets))
+    inside_distances = np.minimum(np.maximum(np.maximum(offsets[..., 0], offsets[..., 1]), offsets[..., 2]), 0)
+    return outside_distances + inside_distances - radii
+
+
+if __name__ == '__main__':
+    import time
+    import basis
+    import modeling.geometric_model as gm
+    import visualization.panda.world as wd
+
+    base = wd.World(cam_pos=[.3, .3, .3], lookat_pos=[0, 0, 0])
+    objpath = os.path.join(basis.__path__[0], 'objects', 'bunnysim.stl')
+    tic = time.time()
+    sphere_tree = load_sphere_tree(objpath, max_radius=.005)
+    print("load or generate", time.time() - tic)
+    tic = time.time()
+    sphere_tree = load_sphere_tree(objpath, max_radius=.005)
+    print("load", time.time() - tic)
+    is_leaf = sphere_tree['children'][:, 0] == -1
+    print(f"{len(sphere_tree['radii'])} nodes, {is_leaf.sum()} leaves")
+    gm.GeometricModel(objpath).attach_to(base)
+    for center, radius in zip(sphere_tree['centers'][is_leaf], sphere_tree['radii'][is_leaf]):
+        gm.gen_sphere(center, radius, rgba=[0, .7, 1, .2]).attach_to(base)
+    base.run()
@@ -0,0 +1,188 @@
+import collections
+import numpy as np
+import basis.robot_math as rm
+
+
+class CollisionEnvironment(object):
+    """
+    A uniform grid over the world-space bounds of static collision models, built once and reused across queries
+    CollisionChecker.is_collided(obstacle_list=...), CollisionModel.is_mcdwith, and EEInterface.is_mesh_collided
+    accept an environment in place of a list and only consider the models near the bounds of the query.
+    The bounds of a model cover both its cd primitive and its cdmesh. They are recomputed by update after the
+    model is moved; remove and add the model again after its shape, scale, or cd primitive is changed.
+    """
+
+    def __init__(self, objcm_list=[], cell_size=None, max_cells_per_objcm=512):
+        """
+        :param objcm_list:
+        :param cell_size: edge length of the grid cells, the median size of the initial models is used if None
+        :param max_cells_per_objcm: models spanning more cells (e.g. floors and walls) are kept out of the grid
+                                    and tested by every query
+        """
+        self.max_cells_per_objcm = max_cells_per_objcm
+        self._keys = {}  # id(objcm) -> key, keys keep the insertion order
+        self._infos = {}  # key -> [objcm, local_aabb, gl_aabb, cell range or None if oversized]
+        self._cells = collections.defaultdict(set)  # (i, j, k) -> keys of the models overlapping the cell
+        self._oversized_keys = set()
+        self._next_key = 0
+        self.cell_size = cell_size
+        if self.cell_size is None and len(objcm_list) > 0:
+            local_aabbs = np.array([self._get_local_aabb(objcm) for objcm in objcm_list])
+            self.cell_size = max(np.median((local_aabbs[:, 1] - local_aabbs[:, 0]).max(axis=1)), 1e-3)
+        for objcm in objcm_list:
+            self.add(objcm)
+
+    def __len__(self):
+        return len(self._infos)
+
+    def __contains__(self, objcm):
+        return id(objcm) in self._keys
+
+    def __iter__(self):
+        return iter(self.objcm_list)
+
+    @property
+    def objcm_list(self):
+        return [self._infos[key][0] for key in sorted(self._infos)]
+
+    @staticmethod
+    def _get_local_aabb(objcm):
+        cdprimit_aabb = objcm.get_cdprimit_local_aabb()
+        cdmesh_aabb = objcm.get_cdmesh_local_aabb()
+        return np.array([np.minimum(cdprimit_aabb[0], cdmesh_aabb[0]), np.maximum(cdprimit_aabb[1], cdmesh_aabb[1])])
+
+    def _get_cell_range(self, gl_aabb):
+        """
+        :return: 2x3 int nparray, the first and last cell indices along each axis
+        """
+        return np.floor(gl_aabb / self.cell_size).astype(int)
+
+    def _bin(self, key, cell_range):
+        if cell_range is None:
+            self._oversized_keys.add(key)
+            return
+        for cell in np.ndindex(*(cell_range[1] - cell_range[0] + 1)):
+            self._cells[tuple(cell_range[0] + cell)].add(key)
+
+    def _unbin(self, key, cell_range):
+        if cell_range is None:
+            self._oversized_keys.discard(key)
+            return
+        for cell in np.ndindex(*(cell_range[1] - cell_range[0] + 1)):
+            cell = tuple(cell_range[0] + cell)
+            self._cells[cell].discard(key)
+            if len(self._cells[cell]) == 0:
+                del self._cells[cell]
+
+    def _locate(self, gl_aabb):
+        """
+        :return: the cell range of gl_aabb, None if it spans more than self.max_cells_per_objcm cells
+        """
+        cell_range = self._get_cell_range(gl_aabb)
+        if np.prod(cell_range[1] - cell_range[0] + 1) > self.max_cells_per_objcm:
+            return None
+        return cell_range
+
+    def add(self, objcm):
+        """
+        add a model at its current pose, the model is updated if it was added before
+        :param objcm:
+        :return:
+        """
+        if objcm in self:
+            self.update(objcm)
+            return
+        local_aabb = self._get_local_aabb(objcm)
+        if self.cell_size is None:
+            self.cell_size = max((local_aabb[1] - local_aabb[0]).max(), 1e-3)
+        gl_aabb = rm.transform_aabbs(local_aabb, objcm.get_pos(), objcm.get_rotmat())
+        cell_range = self._locate(gl_aabb)
+        self._keys[id(objcm)] = self._next_key
+        self._infos[self._next_key] = [objcm, local_aabb, gl_aabb, cell_range]
+        self._bin(self._next_key, cell_range)
+        self._next_key += 1
+
+    def remove(self, objcm):
+        """
+        :param objcm:
+        :return:
+        """
+        key = self._keys.pop(id(objcm))
+        self._unbin(key, self._infos.pop(key)[3])
+
+    def update(self, objcm):
+        """
+        recompute the bounds of a model after it was moved, only the cells it left or entered are changed
+        :param objcm:
+        :return:
+        """
+        key = self._keys[id(objcm)]
+        info = self._infos[key]
+        info[2] = rm.transform_aabbs(info[1], objcm.get_pos(), objcm.get_rotmat())
+        cell_range = self._locate(info[2])
+        if cell_range is None and info[3] is None:
+            return
+        if cell_range is not None and info[3] is not None and np.array_equal(cell_range, info[3]):
+            return
+        self._unbin(key, info[3])
+        self._bin(key, cell_range)
+        info[3] = cell_range
+
+    def query(self, gl_aabb):
+        """
+        the models whose bounds overlap gl_aabb
+        :param gl_aabb: 2x3 nparray, [min, max] in the world frame
+        :return: a list of collision models in the order they were added
+        """
+        if len(self._infos) == 0:
+            return []
+        gl_aabb = np.asarray(gl_aabb)
+        cell_range = self._get_cell_range(gl_aabb)
+        if np.prod(cell_range[1] - cell_range[0] + 1) > len(self._cells):
+            # the query is larger than the occupied part of the grid
+            keys = set().union(*self._cells.values())
+        else:
+            keys = set()
+            for cell in np.ndindex(*(cell_range[1] - cell_range[0] + 1)):
+                keys.update(self._cells.get(tuple(cell_range[0] + cell), ()))
+        keys.update(self._oversized_keys)
+        if len(keys) == 0:
+            return []
+        keys = sorted(keys)
+        candidate_aabbs = np.array([self._infos[key][2] for key in keys])
+        is_overlapped = np.all((candidate_aabbs[:, 0] <= gl_aabb[1]) & (candidate_aabbs[:, 1] >= gl_aabb[0]), axis=1)
+        return [self._infos[key][0] for key, overlapped in zip(keys, is_overlapped) if overlapped]
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import basis
+    import modeling.collision_model as cm
+    import modeling.geometric_model as gm
+    import visualization.panda.world as wd
+
+    base = wd.World(cam_pos=[2, 2, 1.5], lookat_pos=[0, 0, 0])
+    bunnycm = cm.CollisionModel(os.path.join(basis.__path__[0], 'objects', 'bunnysim.stl'))
+    obstacle_list = []
+    for x in np.linspace(-1, 1, 20):
+        for y in np.linspace(-1, 1, 20):
+            obstacle = bunnycm.copy()
+            obstacle.set_pos(np.array([x, y, 0]))
+            obstacle.attach_to(base)
+            obstacle_list.append(obstacle)
+    env = CollisionEnvironment(obstacle_list)
+    tool = bunnycm.copy()
+    tool.set_pos(np.array([.05, .03, .02]))
+    tool.set_rgba([1, 0, 0, 1])
+    tool.attach_to(base)
+    tic = time.time()
+    print(tool.is_mcdwith(obstacle_list), time.time() - tic)
+    tic = time.time()
+    print(tool.is_mcdwith(env), time.time() - tic)
+    # move an obstacle onto the tool without rebuilding the environment
+    obstacle_list[0].set_pos(np.array([.07, .03, .02]))
+    env.update(obstacle_list[0])
+    print([obstacle.get_pos() for obstacle in env.query(np.array([[0, 0, 0], [.1, .1, .1]]))])
+    gm.gen_frame().attach_to(base)
+    base.run()
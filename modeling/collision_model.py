@@ -10,6 +10,7 @@ import modeling.geometric_model as gm
 import modeling.model_collection as mc
 import modeling._panda_cdhelper as pcd
 import modeling._ode_cdhelper as mcd
+import modeling.collision_environment as cenv
 import warnings as wrn
 
 
@@ -76,6 +77,8 @@ class CollisionModel(gm.GeometricModel):
             self._cdmesh_type = cdmesh_type
             self._cdmesh = mcd.gen_cdmesh_vvnf(*self.extract_rotated_vvnf())
             self._localframe = None
+        self._ray_cdmesh = None  # see _get_ray_cdmesh
+        self._cdmesh_local_aabb = None  # see get_cdmesh_local_aabb
         # reinit self._cdmesh while ignoring the initor types.
         # The reinit helps to avoid the annoying ode warning caused by deepcopy.
 
@@ -123,6 +126,8 @@ class CollisionModel(gm.GeometricModel):
             raise ValueError("Wrong mesh collision model type name!")
         self._cdmesh_type = cdmesh_type
         self._cdmesh = mcd.gen_cdmesh_vvnf(*self.extract_rotated_vvnf())
+        self._ray_cdmesh = None
+        self._cdmesh_local_aabb = None
 
     @property
     def cdnp(self):
@@ -142,6 +147,8 @@ class CollisionModel(gm.GeometricModel):
         self._objpdnp.setScale(scale[0], scale[1], scale[2])
         self._objtrm.apply_scale(scale)
         self._cdmesh = mcd.gen_cdmesh_vvnf(*self.extract_rotated_vvnf())
+        self._ray_cdmesh = None
+        self._cdmesh_local_aabb = None
 
     def get_scale(self):
         return da.pdv3_to_npv3(self._objpdnp.getScale())
@@ -176,13 +183,11 @@ class CollisionModel(gm.GeometricModel):
         self.set_rotmat(npmat3)
         mcd.update_pose(self._cdmesh, self._objpdnp)
 
-    def extract_rotated_vvnf(self, cdmesh_type=None):
+    def _get_cdmesh_trm(self, cdmesh_type=None):
         """
-        allow either extract a vvnf following the specified cdmesh_type or the value of self.cdmesh_type
+        the trimesh of the given cdmesh_type or self.cdmesh_type in the local frame
         :param cdmesh_type:
         :return:
-        author: weiwei
-        date: 20211215
         """
         if cdmesh_type is None:
             cdmesh_type = self.cdmesh_type
@@ -194,6 +199,17 @@ class CollisionModel(gm.GeometricModel):
             objtrm = self.objtrm.convex_hull
         elif cdmesh_type == 'triangles':
             objtrm = self.objtrm
+        return objtrm
+
+    def extract_rotated_vvnf(self, cdmesh_type=None):
+        """
+        allow either extract a vvnf following the specified cdmesh_type or the value of self.cdmesh_type
+        :param cdmesh_type:
+        :return:
+        author: weiwei
+        date: 20211215
+        """
+        objtrm = self._get_cdmesh_trm(cdmesh_type)
         homomat = self.get_homomat()
         vertices = rm.homomat_transform_points(homomat, objtrm.vertices)
         vertex_normals = rm.homomat_transform_points(homomat, objtrm.vertex_normals)
@@ -282,37 +298,101 @@ class CollisionModel(gm.GeometricModel):
     def is_mcdwith(self, objcm_list, toggle_contacts=False):
         """
         Is the mesh of the cm collide with the mesh of the given cm
-        :param objcm_list: one or a list of Collision Model object
+        :param objcm_list: one or a list of Collision Model object, or a CollisionEnvironment
         :param toggle_contacts: return a list of contact points if toggle_contacts is True
         author: weiwei
         date: 20201116
         """
+        if isinstance(objcm_list, cenv.CollisionEnvironment):
+            objcm_list = objcm_list.query(rm.transform_aabbs(self.get_cdmesh_local_aabb(),
+                                                             self.get_pos(),
+                                                             self.get_rotmat()))
         if not isinstance(objcm_list, list):
             objcm_list = [objcm_list]
         for objcm in objcm_list:
+            if not toggle_contacts:
+                if mcd.is_collided(self.cdmesh, objcm.cdmesh, toggle_contacts=False):
+                    return True
+                continue
             iscollided, contact_points = mcd.is_collided(self.cdmesh, objcm.cdmesh)
-            if iscollided and toggle_contacts:
+            if iscollided:
                 return [True, contact_points]
-            elif iscollided:
-                return True
         return [False, []] if toggle_contacts else False
 
+    def get_cdprimit_local_aabb(self):
+        """
+        the axis aligned bounds of the cd primitive in the local frame, including the scale
+        boxes are bounded exactly, other solids by their bounding spheres
+        :return: 2x3 nparray, [min, max]
+        """
+        cdnode = self.cdnp.node()
+        if cdnode.getNumSolids() == 0:
+            return self.get_cdmesh_local_aabb()
+        solid_aabbs = []
+        for i in range(cdnode.getNumSolids()):
+            solid = cdnode.getSolid(i)
+            if isinstance(solid, CollisionBox):
+                solid_aabbs.append([da.pdv3_to_npv3(solid.getMin()), da.pdv3_to_npv3(solid.getMax())])
+            else:
+                bounds = solid.getBounds()
+                center = da.pdv3_to_npv3(bounds.getCenter())
+                solid_aabbs.append([center - bounds.getRadius(), center + bounds.getRadius()])
+        solid_aabbs = np.array(solid_aabbs)
+        scale = da.pdv3_to_npv3(self._objpdnp.getScale())
+        return np.array([solid_aabbs[:, 0].min(axis=0), solid_aabbs[:, 1].max(axis=0)]) * np.abs(scale)
+
+    def get_cdmesh_local_aabb(self):
+        """
+        the axis aligned bounds of the cdmesh in the local frame,
+        cached until the scale or the cdmesh type is changed
+        :return: 2x3 nparray, [min, max]
+        """
+        if self._cdmesh_local_aabb is None:
+            self._cdmesh_local_aabb = np.array(self._get_cdmesh_trm().bounds)
+        return self._cdmesh_local_aabb
+
+    def _get_ray_cdmesh(self):
+        """
+        an ode trimesh of the cdmesh in the local frame for ray queries, built once and moved to the current pose
+        on each query, it is rebuilt after the scale or the cdmesh type is changed
+        :return:
+        """
+        if self._ray_cdmesh is None:
+            objtrm = self._get_cdmesh_trm()
+            self._ray_cdmesh = mcd.gen_cdmesh_vvnf(objtrm.vertices, objtrm.vertex_normals, objtrm.faces)
+        mcd.update_pose(self._ray_cdmesh, self._objpdnp)
+        return self._ray_cdmesh
+
     def ray_hit(self, point_from, point_to, option="all"):
         """
         check the intersection between segment point_from-point_to and the mesh
         :param point_from: 1x3 nparray
         :param point_to:
         :param option: "all" or “closest"
-        :return:
+        :return: "all": a list of hit points and a list of hit normals
+                 "closest": the hit point and the hit normal, None, None if missed
         author: weiwei
         date: 20210504
         """
+        rays = np.array([point_from, point_to], dtype=float).reshape(1, 2, 3)
         if option == "all":
-            contact_points, contact_normals = mcd.rayhit_all(point_from, point_to, self)
-            return contact_points, contact_normals
+            _, hit_points, hit_normals, _ = mcd.rayhit_batch(rays, self._get_ray_cdmesh(), option="all")
+            return list(hit_points), list(hit_normals)
         elif option == "closest":
-            contact_point, contact_normal = mcd.rayhit_closet(point_from, point_to, self)
-            return contact_point, contact_normal
+            hit_points, hit_normals, face_ids = mcd.rayhit_batch(rays, self._get_ray_cdmesh(), option="closest")
+            if face_ids[0] == -1:
+                return None, None
+            return hit_points[0], hit_normals[0]
+
+    def ray_hit_batch(self, rays, option="closest"):
+        """
+        check the intersections between many segments and the mesh
+        :param rays: Nx2x3 nparray, rays[i] = [point_from, point_to]
+        :param option: "closest" or "all"
+        :return: "closest": hit_points Nx3, hit_normals Nx3 (nan for missed rays), face_ids 1xN (-1 for missed rays);
+                 "all": ray_ids 1xK (the ray of each hit), hit_points Kx3, hit_normals Kx3, face_ids 1xK
+        """
+        return mcd.rayhit_batch(rays, self._get_ray_cdmesh(), option=option)
 
     def show_cdmesh(self):
         vertices, vertex_normals, faces = self.extract_rotated_vvnf()
@@ -1,24 +1,114 @@
 import copy
-
+import numpy as np
 import basis.data_adapter as da
+import basis.robot_math as rm
 import modeling.model_collection as mc
-from panda3d.core import NodePath, CollisionTraverser, CollisionHandlerQueue, BitMask32
+import modeling.collision_environment as cenv
+from panda3d.core import NodePath, CollisionTraverser, CollisionHandlerQueue, BitMask32, LVecBase3, \
+    LQuaternion
+
+
+def _gl_obbs(local_aabbs, poss, rotmats, margins=0):
+    """
+    the oriented bounds of boxes given in their local frames, after moving the frames to poss and rotmats
+    :param local_aabbs: ...x2x3 nparray, [min, max] in the local frames
+    :param poss: ...x3 nparray
+    :param rotmats: ...x3x3 nparray
+    :param margins: ... nparray, the bounds are expanded by margins along every axis
+    :return: centers ...x3, rotmats ...x3x3, half_extents ...x3
+    """
+    centers = np.einsum('...ij,...j->...i', rotmats, (local_aabbs[..., 0, :] + local_aabbs[..., 1, :]) / 2) + poss
+    half_extents = (local_aabbs[..., 1, :] - local_aabbs[..., 0, :]) / 2 + np.asarray(margins)[..., np.newaxis]
+    return centers, rotmats, np.broadcast_to(half_extents, centers.shape)
+
+
+class _OverflowLayer(object):
+    """
+    An extra nodepath and traverser holding the collision pairs that do not fit into the 31 bits of
+    CollisionChecker.np. A layer only copies the cd elements used by its own pairs and has no external bit,
+    it is only used for self collision detection.
+    """
+
+    def __init__(self, name):
+        self.ctrav = CollisionTraverser()
+        self.chan = CollisionHandlerQueue()
+        self.np = NodePath(name)
+        self.bitmask_list = [BitMask32(2 ** n) for n in range(32)]
+        self.cdelements = []  # the i-th element is the cdlnk or cdobj of self.np.getChild(i)
+
+    def find(self, cdelement):
+        """
+        :return: id of the copy of cdelement in self.np, -1 if not copied
+        """
+        for i, layer_cdelement in enumerate(self.cdelements):
+            if layer_cdelement is cdelement:
+                return i
+        return -1
+
+    def get_cdnp(self, checker_np, cdelement, toggle_from=False):
+        """
+        get the copy of a cd element in this layer, the copy is created if it does not exist
+        :param checker_np: CollisionChecker.np
+        :param cdelement: a cdlnk or cdobj
+        :param toggle_from: add the copy as a collider
+        :return:
+        """
+        layer_childid = self.find(cdelement)
+        if layer_childid == -1:
+            cdnp = checker_np.getChild(cdelement['cdprimit_childid']).copyTo(self.np)
+            cdnp.node().setCollideMask(BitMask32.allOff())
+            self.cdelements.append(cdelement)
+            layer_childid = len(self.cdelements) - 1
+        cdnp = self.np.getChild(layer_childid)
+        if toggle_from and not self.ctrav.hasCollider(cdnp):
+            self.ctrav.addCollider(cdnp, self.chan)
+        return cdnp
+
+    def remove_cdnp(self, cdelement):
+        layer_childid = self.find(cdelement)
+        cdnp = self.np.getChild(layer_childid)
+        self.ctrav.removeCollider(cdnp)
+        cdnp.detachNode()
+        self.cdelements.pop(layer_childid)
 
 
 class CollisionChecker(object):
     """
-    A fast collision checker that allows maximum 32 collision pairs
+    A fast collision checker
+    The first 31 collision pairs are bits of the collide masks of self.np, pairs beyond that are put into
+    overflow layers (an extra nodepath and traverser for every 32 pairs). is_collided traverses self.np first
+    and only continues with the overflow layers if no collision was found.
+    The poses of the cd elements are gathered from the fk buffers of the jlchains and written in bulk. Obstacles
+    and other robots can be registered once using set_persistent_scene instead of being passed to each call.
     author: weiwei
     date: 20201214osaka
     """
 
     def __init__(self, name="auto"):
+        self.name = name
         self.ctrav = CollisionTraverser()
         self.chan = CollisionHandlerQueue()
         self.np = NodePath(name)
         self.bitmask_list = [BitMask32(2**n) for n in range(31)]
         self._bitmask_ext = BitMask32(2 ** 31)  # 31 is prepared for cd with external non-active objects
         self.all_cdelements = []  # a list of cdlnks or cdobjs for quick accessing the cd elements (cdlnks/cdobjs)
+        self._overflow_layers = []
+        self._cdlnk_sources = []  # [(jlcobj, lnk_idlist), ...] of add_cdlnks, used to gather the poses from fk
+        self._pose_layout = None  # cached by _get_pose_layout, reset when the cd elements change
+        self._cdelement_local_aabbs = None  # cached by _get_cdelement_local_aabbs, reset with self._pose_layout
+        self._scene_np = None  # see set_persistent_scene
+        self._scene_obstacle_list = []
+        self._scene_otherrobot_list = []
+        self._scene_otherrobot_nps = []
+
+    def __getstate__(self):
+        # the persistent scene refers to external objects, it is not copied, see EEInterface.copy
+        state = self.__dict__.copy()
+        state['_scene_np'] = None
+        state['_scene_obstacle_list'] = []
+        state['_scene_otherrobot_list'] = []
+        state['_scene_otherrobot_nps'] = []
+        return state
 
     def add_cdlnks(self, jlcobj, lnk_idlist):
         """
@@ -39,6 +129,9 @@ class CollisionChecker(object):
                 jlcobj.lnks[id]['cdprimit_childid'] = len(self.all_cdelements) - 1
             else:
                 raise ValueError("The link is already added!")
+        self._cdlnk_sources.append((jlcobj, list(lnk_idlist)))
+        self._pose_layout = None
+        self._cdelement_local_aabbs = None
 
     def set_active_cdlnks(self, activelist):
         """
@@ -66,7 +159,8 @@ class CollisionChecker(object):
         date: 20201215
         """
         if len(self.bitmask_list) == 0:
-            raise ValueError("Too many collision pairs! Maximum: 29")
+            self._set_overflow_cdpair(fromlist, intolist)
+            return
         allocated_bitmask = self.bitmask_list.pop()
         for cdlnk in fromlist:
             if cdlnk['cdprimit_childid'] == -1:
@@ -83,6 +177,66 @@ class CollisionChecker(object):
             new_into_cdmask = current_into_cdmask | allocated_bitmask
             cdnp.node().setIntoCollideMask(new_into_cdmask)
 
+    def _set_overflow_cdpair(self, fromlist, intolist):
+        """
+        allocate the pair in the first overflow layer that has a free bit, a new layer is created if none
+        :param fromlist:
+        :param intolist:
+        :return:
+        """
+        for cdlnk in fromlist + intolist:
+            if cdlnk['cdprimit_childid'] == -1:
+                raise ValueError("The link needs to be added to collider using the addjlcobj function first!")
+        for layer in self._overflow_layers:
+            if len(layer.bitmask_list) > 0:
+                break
+        else:
+            layer = _OverflowLayer(self.name + "_overflow" + str(len(self._overflow_layers)))
+            self._overflow_layers.append(layer)
+        allocated_bitmask = layer.bitmask_list.pop()
+        self._pose_layout = None
+        self._cdelement_local_aabbs = None
+        for cdlnk in fromlist:
+            cdnp = layer.get_cdnp(self.np, cdlnk, toggle_from=True)
+            cdnp.node().setFromCollideMask(cdnp.node().getFromCollideMask() | allocated_bitmask)
+        for cdlnk in intolist:
+            cdnp = layer.get_cdnp(self.np, cdlnk)
+            cdnp.node().setIntoCollideMask(cdnp.node().getIntoCollideMask() | allocated_bitmask)
+
+    def prune_cdpairs(self, collision_matrix):
+        """
+        drop the self collision pairs of cdlnks that never or always collide, or that are adjacent, according to
+        collision_matrix; the remaining pairs are declared again with one bit for each from element, the pairs of
+        the cdobjs are kept and declared from the cdobjs like add_cdobj does
+        :param collision_matrix: robot_sim._kinematics.collision_matrix.CollisionMatrix built for this checker
+        :return: number of dropped pairs
+        """
+        _, cdobj_ids, _ = self._get_pose_layout()
+        if len(collision_matrix) < len(self.all_cdelements) - len(cdobj_ids):
+            raise ValueError("The collision matrix does not match the cd links of the checker!")
+        _, cdpairs = self._get_cdpairs()
+        cdpairs = np.unique(np.sort(cdpairs, axis=1), axis=0)
+        is_cdobj_pair = np.isin(cdpairs, cdobj_ids).any(axis=1)
+        is_kept = is_cdobj_pair.copy()
+        is_kept[~is_cdobj_pair] = collision_matrix.is_needed(cdpairs[~is_cdobj_pair])
+        # clear the pairs, the external bit of the active elements is kept
+        for cdnp in self.np.getChildren():
+            cdnp.node().setFromCollideMask(cdnp.node().getFromCollideMask() & self._bitmask_ext)
+            cdnp.node().setIntoCollideMask(cdnp.node().getIntoCollideMask() & self._bitmask_ext)
+        for layer in self._overflow_layers:
+            layer.np.removeNode()
+        self.bitmask_list = [BitMask32(2**n) for n in range(31)]
+        self._overflow_layers = []
+        self._pose_layout = None
+        self._cdelement_local_aabbs = None
+        # the cdobj is the from element of its pairs
+        from_ids = np.where(np.isin(cdpairs[:, 1], cdobj_ids), cdpairs[:, 1], cdpairs[:, 0])
+        into_ids = np.where(np.isin(cdpairs[:, 1], cdobj_ids), cdpairs[:, 0], cdpairs[:, 1])
+        for from_id in np.unique(from_ids[is_kept]):
+            self.set_cdpair([self.all_cdelements[from_id]],
+                            [self.all_cdelements[into_id] for into_id in into_ids[is_kept & (from_ids == from_id)]])
+        return int((~is_kept).sum())
+
     def add_cdobj(self, objcm, rel_pos, rel_rotmat, into_list):
         """
         :return: cdobj_info, a dictionary that mimics a joint link; Besides that, there is an additional 'into_list'
@@ -100,6 +254,8 @@ class CollisionChecker(object):
         self.ctrav.addCollider(cdnp, self.chan)
         self.all_cdelements.append(cdobj_info)
         cdobj_info['cdprimit_childid'] = len(self.all_cdelements) - 1
+        self._pose_layout = None
+        self._cdelement_local_aabbs = None
         self.set_cdpair([cdobj_info], into_list)
         return cdobj_info
 
@@ -109,7 +265,20 @@ class CollisionChecker(object):
         :param objcm:
         :return:
         """
+        for layer in self._overflow_layers:
+            layer_childid = layer.find(cdobj_info)
+            if layer_childid == -1:
+                continue
+            this_cdmask = layer.np.getChild(layer_childid).node().getFromCollideMask()
+            if this_cdmask != BitMask32.allOff():
+                for cdlnk in cdobj_info['into_list']:
+                    cdnp = layer.np.getChild(layer.find(cdlnk))
+                    cdnp.node().setIntoCollideMask(cdnp.node().getIntoCollideMask() & ~this_cdmask)
+                layer.bitmask_list.append(this_cdmask)
+            layer.remove_cdnp(cdobj_info)
         self.all_cdelements.remove(cdobj_info)
+        self._pose_layout = None
+        self._cdelement_local_aabbs = None
         cdnp_to_delete = self.np.getChild(cdobj_info['cdprimit_childid'])
         self.ctrav.removeCollider(cdnp_to_delete)
         this_cdmask = cdnp_to_delete.node().getFromCollideMask()
@@ -120,27 +289,173 @@ class CollisionChecker(object):
             new_into_cdmask = current_into_cdmask & ~this_cdmask_exclude_ext
             cdnp.node().setIntoCollideMask(new_into_cdmask)
         cdnp_to_delete.detachNode()
-        self.bitmask_list.append(this_cdmask_exclude_ext)
+        if this_cdmask_exclude_ext != BitMask32.allOff():
+            self.bitmask_list.append(this_cdmask_exclude_ext)
 
-    def is_collided(self, obstacle_list=[], otherrobot_list=[], toggle_contact_points=False):
+    def _get_pose_layout(self):
+        """
+        the indices for gathering the poses of self.all_cdelements and for writing them to the nodepaths
+        :return: [(jlcobj, lnk_ids, element_ids), ...] of the cdlnks, element ids of the cdobjs,
+                 element ids of the copies in each overflow layer
+        """
+        if self._pose_layout is None:
+            element_ids = {id(cdelement): i for i, cdelement in enumerate(self.all_cdelements)}
+            is_cdlnk = np.zeros(len(self.all_cdelements), dtype=bool)
+            cdlnk_groups = []
+            for jlcobj, lnk_idlist in self._cdlnk_sources:
+                cdlnk_ids = [element_ids[id(jlcobj.lnks[lnk_id])] for lnk_id in lnk_idlist
+                             if id(jlcobj.lnks[lnk_id]) in element_ids]
+                cdlnk_groups.append((jlcobj, np.array(lnk_idlist, dtype=int), np.array(cdlnk_ids, dtype=int)))
+                is_cdlnk[cdlnk_ids] = True
+            layer_element_ids = [[element_ids[id(cdelement)] for cdelement in layer.cdelements]
+                                 for layer in self._overflow_layers]
+            self._pose_layout = (cdlnk_groups, np.flatnonzero(~is_cdlnk), layer_element_ids)
+        return self._pose_layout
+
+    def get_gl_homomats(self):
+        """
+        the poses of self.all_cdelements, the ones of cdlnks are taken from the fk buffers of their jlchains,
+        the ones of cdobjs from their 'gl_pos' and 'gl_rotmat'
+        :return: Nx4x4 nparray
+        """
+        cdlnk_groups, cdobj_ids, _ = self._get_pose_layout()
+        gl_homomats = np.empty((len(self.all_cdelements), 4, 4))
+        for jlcobj, lnk_ids, element_ids in cdlnk_groups:
+            gl_homomats[element_ids] = jlcobj._fkt.lnk_gl_homomats[lnk_ids]
+        for i in cdobj_ids:
+            gl_homomats[i] = rm.homomat_from_posrot(self.all_cdelements[i]['gl_pos'],
+                                                    self.all_cdelements[i]['gl_rotmat'])
+        return gl_homomats
+
+    def _get_cdelement_local_aabbs(self):
+        """
+        the bounds of the cd primitives of self.all_cdelements in their local frames
+        :return: Nx2x3 nparray
+        """
+        if self._cdelement_local_aabbs is None:
+            self._cdelement_local_aabbs = np.array([cdelement['collision_model'].get_cdprimit_local_aabb()
+                                                    for cdelement in self.all_cdelements]).reshape(-1, 2, 3)
+        return self._cdelement_local_aabbs
+
+    def get_gl_aabb(self, gl_homomats_array):
+        """
+        the axis aligned bounds of the cd primitives at one or many sets of poses, i.e. the swept bounds
+        :param gl_homomats_array: Mx4x4 or NxMx4x4 nparray, see get_gl_homomats and get_gl_homomats_batch
+        :return: 2x3 nparray, [min, max]
+        """
+        gl_aabbs = rm.transform_aabbs(self._get_cdelement_local_aabbs(),
+                                      gl_homomats_array[..., :3, 3],
+                                      gl_homomats_array[..., :3, :3]).reshape(-1, 2, 3)
+        return np.array([gl_aabbs[:, 0].min(axis=0), gl_aabbs[:, 1].max(axis=0)])
+
+    def _query_environment(self, obstacle_list, gl_homomats_array):
         """
+        the obstacles of a CollisionEnvironment near the swept bounds of the given poses
+        :param obstacle_list: a list of obstacles, returned as it is, or a CollisionEnvironment
+        :param gl_homomats_array: see get_gl_aabb
+        :return: a list of obstacles
+        """
+        if not isinstance(obstacle_list, cenv.CollisionEnvironment):
+            return obstacle_list
+        if len(self.all_cdelements) == 0:
+            return []
+        return obstacle_list.query(self.get_gl_aabb(gl_homomats_array))
+
+    def get_gl_homomats_batch(self, jnt_values_dict):
+        """
+        the poses of self.all_cdelements at many configurations, computed using batched fk
+        :param jnt_values_dict: {jlcobj: Nxn nparray of the values of jlcobj.tgtjnts, ...}, the jlchains that are
+                                not given and the cdobjs (e.g. objects in hand) keep their current poses
+        :return: NxMx4x4 nparray, M = len(self.all_cdelements)
+        """
+        cdlnk_groups, _, _ = self._get_pose_layout()
+        lnk_gl_homomats_dict = {}
+        for jlcobj, jnt_values_array in jnt_values_dict.items():
+            gl_homomatqs = jlcobj._fkt.fk_batch(jnt_values_array)
+            lnk_gl_homomats_dict[jlcobj] = jlcobj._fkt.get_lnk_gl_batch(gl_homomatqs)
+        nconf = max([len(lnk_gl_homomats) for lnk_gl_homomats in lnk_gl_homomats_dict.values()], default=1)
+        gl_homomats_array = np.tile(self.get_gl_homomats(), (nconf, 1, 1, 1))
+        for jlcobj, lnk_ids, element_ids in cdlnk_groups:
+            if jlcobj in lnk_gl_homomats_dict:
+                gl_homomats_array[:, element_ids] = lnk_gl_homomats_dict[jlcobj][:, lnk_ids]
+        return gl_homomats_array
+
+    def _push_gl_homomats(self, gl_homomats, parent_np=None):
+        """
+        write the poses to the cd nodepaths, the quaternions are converted in one vectorized pass
+        :param gl_homomats: Nx4x4 nparray in the order of self.all_cdelements
+        :param parent_np: the children of parent_np are updated if given, otherwise self.np and the overflow layers
+        :return:
+        """
+        self._push_posquats(gl_homomats[:, :3, 3].tolist(),
+                            rm.quaternions_from_rotmats(gl_homomats[:, :3, :3]).tolist(),
+                            parent_np=parent_np)
+
+    def _push_posquats(self, poss, quaternions, parent_np=None):
+        """
+        the scales of the nodepaths are kept
+        :param poss: list of [x, y, z] in the order of self.all_cdelements
+        :param quaternions: list of [w, x, y, z] in the order of self.all_cdelements
+        :param parent_np: see _push_gl_homomats
+        :return:
+        """
+        if parent_np is not None:
+            for cdnp, pos, quaternion in zip(parent_np.getChildren(), poss, quaternions):
+                cdnp.setPosQuat(LVecBase3(*pos), LQuaternion(*quaternion))
+            return
+        for cdnp, pos, quaternion in zip(self.np.getChildren(), poss, quaternions):
+            cdnp.setPosQuat(LVecBase3(*pos), LQuaternion(*quaternion))
+        for layer, element_ids in zip(self._overflow_layers, self._get_pose_layout()[2]):
+            for cdnp, element_id in zip(layer.np.getChildren(), element_ids):
+                cdnp.setPosQuat(LVecBase3(*poss[element_id]), LQuaternion(*quaternions[element_id]))
+
+    def set_persistent_scene(self, obstacle_list=[], otherrobot_list=[]):
+        """
+        register obstacles and other robots once, is_collided considers them without attaching them on each call
+        the obstacles are instanced, their poses follow the originals; the cd elements of the other robots are
+        copied with the external into mask at their current poses, call update_persistent_scene after the other
+        robots moved; call this function again if the obstacles or other robots change
         :param obstacle_list: staticgeometricmodel
         :param otherrobot_list:
         :return:
         """
-        for cdelement in self.all_cdelements:
-            pos = cdelement['gl_pos']
-            rotmat = cdelement['gl_rotmat']
-            cdnp = self.np.getChild(cdelement['cdprimit_childid'])
-            cdnp.setPosQuat(da.npv3_to_pdv3(pos), da.npmat3_to_pdquat(rotmat))
-            # print(da.npv3mat3_to_pdmat4(pos, rotmat))
-            # print("From", cdnp.node().getFromCollideMask())
-            # print("Into", cdnp.node().getIntoCollideMask())
-        # print("xxxx colliders xxxx")
-        # for collider in self.ctrav.getColliders():
-        #     print(collider.getMat())
-        #     print("From", collider.node().getFromCollideMask())
-        #     print("Into", collider.node().getIntoCollideMask())
+        self.clear_persistent_scene()
+        self._scene_np = NodePath(self.name + "_scene")
+        for obstacle in obstacle_list:
+            obstacle.objpdnp.instanceTo(self._scene_np)
+        for robot in otherrobot_list:
+            robot_np = robot.cc.np.copyTo(self._scene_np)
+            for cdnp in robot_np.getChildren():
+                cdnp.node().setFromCollideMask(BitMask32.allOff())
+                cdnp.node().setIntoCollideMask(cdnp.node().getIntoCollideMask() | self._bitmask_ext)
+            self._scene_otherrobot_nps.append(robot_np)
+        self._scene_obstacle_list = list(obstacle_list)
+        self._scene_otherrobot_list = list(otherrobot_list)
+        self.update_persistent_scene()
+
+    def update_persistent_scene(self):
+        """
+        refresh the poses of the other robots in the persistent scene from their fk buffers
+        :return:
+        """
+        for robot, robot_np in zip(self._scene_otherrobot_list, self._scene_otherrobot_nps):
+            robot.cc._push_gl_homomats(robot.cc.get_gl_homomats(), parent_np=robot_np)
+
+    def clear_persistent_scene(self):
+        if self._scene_np is not None:
+            self._scene_np.getChildren().detach()
+        self._scene_np = None
+        self._scene_obstacle_list = []
+        self._scene_otherrobot_list = []
+        self._scene_otherrobot_nps = []
+
+    def _attach_scene(self, obstacle_list, otherrobot_list):
+        """
+        attach the persistent scene, the obstacles, and the other robots to self.np
+        :return: the parents of the obstacles, used by _detach_scene
+        """
+        if self._scene_np is not None:
+            self._scene_np.reparentTo(self.np)
         # attach obstacles
         obstacle_parent_list = []
         for obstacle in obstacle_list:
@@ -153,8 +468,9 @@ class CollisionChecker(object):
                 new_into_cdmask = current_into_cdmask | self._bitmask_ext
                 cdnp.node().setIntoCollideMask(new_into_cdmask)
             robot.cc.np.reparentTo(self.np)
-        # collision check
-        self.ctrav.traverse(self.np)
+        return obstacle_parent_list
+
+    def _detach_scene(self, obstacle_list, otherrobot_list, obstacle_parent_list):
         # clear obstacles
         for i, obstacle in enumerate(obstacle_list):
             obstacle.objpdnp.reparentTo(obstacle_parent_list[i])
@@ -165,17 +481,300 @@ class CollisionChecker(object):
                 new_into_cdmask = current_into_cdmask & ~self._bitmask_ext
                 cdnp.node().setIntoCollideMask(new_into_cdmask)
             robot.cc.np.detachNode()
-        if self.chan.getNumEntries() > 0:
-            collision_result = True
-        else:
-            collision_result = False
+        if self._scene_np is not None:
+            self._scene_np.detachNode()
+
+    def _traverse(self, toggle_contact_points=False):
+        """
+        traverse self.np, and the overflow layers until a collision is found, the poses must be pushed first
+        :param toggle_contact_points: traverse all overflow layers and collect the entries
+        :return: collision_result, a list of the collision entries (empty if toggle_contact_points is False)
+        """
+        self.ctrav.traverse(self.np)
+        collision_result = self.chan.getNumEntries() > 0
+        cd_entries = list(self.chan.getEntries()) if toggle_contact_points else []
+        for layer in self._overflow_layers:
+            if collision_result and not toggle_contact_points:
+                break
+            layer.ctrav.traverse(layer.np)
+            if layer.chan.getNumEntries() > 0:
+                collision_result = True
+                cd_entries += list(layer.chan.getEntries())
+        return collision_result, cd_entries
+
+    def is_collided(self, obstacle_list=[], otherrobot_list=[], toggle_contact_points=False):
+        """
+        :param obstacle_list: staticgeometricmodel, or a CollisionEnvironment
+        :param otherrobot_list:
+        :return:
+        """
+        gl_homomats = self.get_gl_homomats()
+        obstacle_list = self._query_environment(obstacle_list, gl_homomats)
+        self._push_gl_homomats(gl_homomats)
+        obstacle_parent_list = self._attach_scene(obstacle_list, otherrobot_list)
+        collision_result, cd_entries = self._traverse(toggle_contact_points)
+        self._detach_scene(obstacle_list, otherrobot_list, obstacle_parent_list)
         if toggle_contact_points:
-            contact_points = [da.pdv3_to_npv3(cd_entry.getSurfacePoint(base.render)) for cd_entry in
-                              self.chan.getEntries()]
+            contact_points = [da.pdv3_to_npv3(cd_entry.getSurfacePoint(base.render)) for cd_entry in cd_entries]
             return collision_result, contact_points
         else:
             return collision_result
 
+    def _get_jnt_values_dict(self, jnt_values, jlcobj=None):
+        """
+        :param jnt_values: values of jlcobj.tgtjnts, or a dictionary {jlcobj: values, ...} returned as it is
+        :param jlcobj: may be omitted if all cd links belong to one jlchain
+        :return: {jlcobj: values}
+        """
+        if isinstance(jnt_values, dict):
+            return jnt_values
+        if jlcobj is None:
+            jlcobjs = {id(cdlnk_source[0]): cdlnk_source[0] for cdlnk_source in self._cdlnk_sources}
+            if len(jlcobjs) != 1:
+                raise ValueError("The cd links belong to several jlchains, jlcobj must be given!")
+            jlcobj = list(jlcobjs.values())[0]
+        return {jlcobj: jnt_values}
+
+    def is_collided_batch(self,
+                          jnt_values_array,
+                          obstacle_list=[],
+                          otherrobot_list=[],
+                          jlcobj=None,
+                          toggle_stop_at_collision=False):
+        """
+        check many configurations in one call, the current joint values and dictionaries are not changed
+        :param jnt_values_array: Nxn nparray of the values of jlcobj.tgtjnts, or a dictionary
+                                 {jlcobj: Nxn nparray, ...} if the cd links belong to several jlchains
+        :param obstacle_list: staticgeometricmodel, or a CollisionEnvironment
+        :param otherrobot_list:
+        :param jlcobj: the jlchain of jnt_values_array, may be omitted if all cd links belong to one jlchain
+        :param toggle_stop_at_collision: stop at the first collided configuration, the remaining ones are not checked
+                                         and reported as collided
+        :return: 1xN bool nparray
+        """
+        jnt_values_dict = self._get_jnt_values_dict(jnt_values_array, jlcobj)
+        return self.is_collided_homomats_batch(self.get_gl_homomats_batch(jnt_values_dict),
+                                               obstacle_list=obstacle_list,
+                                               otherrobot_list=otherrobot_list,
+                                               toggle_stop_at_collision=toggle_stop_at_collision)
+
+    def is_collided_homomats_batch(self,
+                                   gl_homomats_array,
+                                   obstacle_list=[],
+                                   otherrobot_list=[],
+                                   toggle_stop_at_collision=False):
+        """
+        check many sets of poses of self.all_cdelements, the obstacles and other robots are attached once
+        :param gl_homomats_array: NxMx4x4 nparray, see get_gl_homomats_batch
+        :param obstacle_list: staticgeometricmodel, or a CollisionEnvironment, the obstacles near the swept bounds
+                              of all the configurations are attached
+        :param otherrobot_list:
+        :param toggle_stop_at_collision: see is_collided_batch
+        :return: 1xN bool nparray
+        """
+        gl_homomats_array = np.asarray(gl_homomats_array)
+        obstacle_list = self._query_environment(obstacle_list, gl_homomats_array)
+        nconf, nelements = gl_homomats_array.shape[:2]
+        poss_array = gl_homomats_array[:, :, :3, 3].tolist()
+        quaternions_array = rm.quaternions_from_rotmats(gl_homomats_array[:, :, :3, :3].reshape(-1, 3, 3))
+        quaternions_array = quaternions_array.reshape(nconf, nelements, 4).tolist()
+        is_collided_array = np.zeros(nconf, dtype=bool)
+        obstacle_parent_list = self._attach_scene(obstacle_list, otherrobot_list)
+        for i in range(nconf):
+            self._push_posquats(poss_array[i], quaternions_array[i])
+            is_collided_array[i] = self._traverse()[0]
+            if is_collided_array[i] and toggle_stop_at_collision:
+                is_collided_array[i:] = True
+                break
+        self._detach_scene(obstacle_list, otherrobot_list, obstacle_parent_list)
+        return is_collided_array
+
+    def _get_motion_bounds(self, jnt_values_from_dict, jnt_values_to_dict):
+        """
+        upper bounds of the distances travelled by the cd elements when the jlchains move linearly in the joint
+        space, see JLChainFK.get_lnk_motion_bounds; the cdobjs and the jlchains that are not given do not move
+        :param jnt_values_from_dict: {jlcobj: values of jlcobj.tgtjnts, ...}
+        :param jnt_values_to_dict: {jlcobj: values of jlcobj.tgtjnts, ...}
+        :return: 1xM nparray
+        """
+        cdlnk_groups, _, _ = self._get_pose_layout()
+        local_aabbs = self._get_cdelement_local_aabbs()
+        corner_ids = np.stack(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij'), axis=-1).reshape(-1, 3)
+        local_corners = np.where(corner_ids, local_aabbs[:, np.newaxis, 1], local_aabbs[:, np.newaxis, 0])
+        motion_bounds = np.zeros(len(self.all_cdelements))
+        for jlcobj, lnk_ids, element_ids in cdlnk_groups:
+            if jlcobj not in jnt_values_from_dict or len(element_ids) == 0:
+                continue
+            # distances from the corners of the bounds to the joints of the links
+            lnk_loc_homomats = jlcobj._fkt.lnk_loc_homomats[lnk_ids]
+            jnt_corners = np.einsum('nij,nkj->nki', lnk_loc_homomats[:, :3, :3], local_corners[element_ids]) + \
+                          lnk_loc_homomats[:, np.newaxis, :3, 3]
+            lnk_radii = np.zeros(jlcobj._fkt.nlnks)
+            lnk_radii[lnk_ids] = np.linalg.norm(jnt_corners, axis=2).max(axis=1)
+            motion_bounds[element_ids] = jlcobj._fkt.get_lnk_motion_bounds(jnt_values_from_dict[jlcobj],
+                                                                           jnt_values_to_dict[jlcobj],
+                                                                           lnk_radii)[lnk_ids]
+        return motion_bounds
+
+    def _get_cdpairs(self):
+        """
+        the active cd elements and the self collision pairs, read from the collide masks of self.np and the
+        overflow layers
+        :return: 1xA int nparray of element ids, Px2 int nparray of element ids
+        """
+        ext_word = self._bitmask_ext.getWord()
+        from_words = np.array([cdnp.node().getFromCollideMask().getWord() for cdnp in self.np.getChildren()],
+                              dtype=np.int64)
+        into_words = np.array([cdnp.node().getIntoCollideMask().getWord() for cdnp in self.np.getChildren()],
+                              dtype=np.int64)
+        active_ids = np.flatnonzero(from_words & ext_word)
+        is_paired = (from_words[:, np.newaxis] & into_words[np.newaxis, :] & ~ext_word) != 0
+        for layer, element_ids in zip(self._overflow_layers, self._get_pose_layout()[2]):
+            from_words = np.array([cdnp.node().getFromCollideMask().getWord() for cdnp in layer.np.getChildren()],
+                                  dtype=np.int64)
+            into_words = np.array([cdnp.node().getIntoCollideMask().getWord() for cdnp in layer.np.getChildren()],
+                                  dtype=np.int64)
+            is_paired[np.ix_(element_ids, element_ids)] |= (from_words[:, np.newaxis] & into_words) != 0
+        np.fill_diagonal(is_paired, False)
+        return active_ids, np.argwhere(is_paired)
+
+    def _get_external_obbs(self, obstacle_list, otherrobot_list):
+        """
+        the oriented bounds of the cd primitives checked against the active cd elements, including the persistent
+        scene, see _gl_obbs
+        :param obstacle_list: staticgeometricmodel, the ones without cd primitives are skipped
+        :param otherrobot_list:
+        :return: centers Kx3, rotmats Kx3x3, half_extents Kx3
+        """
+        local_aabbs = [np.zeros((0, 2, 3))]
+        poss = [np.zeros((0, 3))]
+        rotmats = [np.zeros((0, 3, 3))]
+        for obstacle in list(obstacle_list) + self._scene_obstacle_list:
+            if hasattr(obstacle, 'get_cdprimit_local_aabb'):
+                local_aabbs.append(obstacle.get_cdprimit_local_aabb()[np.newaxis])
+                poss.append(obstacle.get_pos()[np.newaxis])
+                rotmats.append(obstacle.get_rotmat()[np.newaxis])
+        # the cd nodepaths of the other robots keep the poses they were last pushed with, the copies in the
+        # persistent scene the ones of the last update_persistent_scene
+        robot_nps = [robot.cc.np for robot in otherrobot_list] + self._scene_otherrobot_nps
+        for robot, robot_np in zip(list(otherrobot_list) + self._scene_otherrobot_list, robot_nps):
+            local_aabbs.append(robot.cc._get_cdelement_local_aabbs())
+            poss.append(np.array([da.pdv3_to_npv3(cdnp.getPos()) for cdnp in robot_np.getChildren()]).reshape(-1, 3))
+            rotmats.append(np.array([da.pdquat_to_npmat3(cdnp.getQuat())
+                                     for cdnp in robot_np.getChildren()]).reshape(-1, 3, 3))
+        return _gl_obbs(np.concatenate(local_aabbs), np.concatenate(poss), np.concatenate(rotmats))
+
+    @staticmethod
+    def _is_free_swept(swept_obbs, active_ids, cdpairs, external_obbs):
+        """
+        :param swept_obbs: the oriented bounds of the cd elements swept over K ranges of an edge, see _gl_obbs
+        :param active_ids: see _get_cdpairs
+        :param cdpairs: see _get_cdpairs
+        :param external_obbs: see _get_external_obbs
+        :return: 1xK bool nparray, True if the bounds of the active elements do not overlap the external ones and
+                 the bounds of the self collision pairs do not overlap each other
+        """
+        centers, rotmats, half_extents = swept_obbs
+        is_free = np.ones(len(centers), dtype=bool)
+        if len(active_ids) > 0 and len(external_obbs[0]) > 0:
+            is_overlapped = rm.is_obb_overlapped(centers[:, active_ids, np.newaxis],
+                                                 rotmats[:, active_ids, np.newaxis],
+                                                 half_extents[:, active_ids, np.newaxis],
+                                                 *external_obbs)
+            is_free &= ~is_overlapped.any(axis=(1, 2))
+        if len(cdpairs) > 0:
+            is_overlapped = rm.is_obb_overlapped(centers[:, cdpairs[:, 0]],
+                                                 rotmats[:, cdpairs[:, 0]],
+                                                 half_extents[:, cdpairs[:, 0]],
+                                                 centers[:, cdpairs[:, 1]],
+                                                 rotmats[:, cdpairs[:, 1]],
+                                                 half_extents[:, cdpairs[:, 1]])
+            is_free &= ~is_overlapped.any(axis=1)
+        return is_free
+
+    def is_collided_edge(self,
+                         jnt_values_from,
+                         jnt_values_to,
+                         obstacle_list=[],
+                         otherrobot_list=[],
+                         jlcobj=None,
+                         resolution=np.pi / 180,
+                         toggle_nchecks=False):
+        """
+        check a straight edge in the joint space, the result is the same as checking it at the uniform samples
+        whose joint steps do not exceed resolution, but only some of the samples are checked
+        a range of samples is certified free if the bounds of the cd elements, expanded by how far they may move
+        within the range, overlap neither the external obstacles nor each other (for the self collision pairs);
+        the middle samples of the uncertified ranges are checked in batches and the ranges are bisected
+        the current joint values and dictionaries are not changed
+        :param jnt_values_from: values of jlcobj.tgtjnts, or a dictionary {jlcobj: values, ...}
+        :param jnt_values_to: the same type as jnt_values_from
+        :param obstacle_list: staticgeometricmodel, or a CollisionEnvironment
+        :param otherrobot_list:
+        :param jlcobj: see is_collided_batch
+        :param resolution: the largest step of any joint between two uniform samples, radian or meter
+        :param toggle_nchecks: also return the number of discrete checks and the number of uniform samples
+        :return: collision_result, [ndiscrete_checks, nsamples]
+        """
+        jnt_values_from_dict = {jlcobj: np.asarray(values, dtype=float) for jlcobj, values in
+                                self._get_jnt_values_dict(jnt_values_from, jlcobj).items()}
+        jnt_values_to_dict = {jlcobj: np.asarray(values, dtype=float) for jlcobj, values in
+                              self._get_jnt_values_dict(jnt_values_to, jlcobj).items()}
+        jnt_deltas_dict = {jlcobj: jnt_values_to_dict[jlcobj] - values for jlcobj, values in
+                           jnt_values_from_dict.items()}
+        max_delta = max([np.abs(jnt_deltas).max(initial=0) for jnt_deltas in jnt_deltas_dict.values()], default=0)
+        nsteps = max(int(np.ceil(max_delta / resolution)), 1)
+        collision_result = False
+        nchecks = 0
+        if len(self.all_cdelements) > 0:
+            motion_bounds = self._get_motion_bounds(jnt_values_from_dict, jnt_values_to_dict)
+            local_aabbs = self._get_cdelement_local_aabbs()
+            active_ids, cdpairs = self._get_cdpairs()
+            external_obbs = None
+            ranges = np.array([[0, nsteps]])  # ranges of unchecked sample ids, both ends included
+            while len(ranges) > 0:
+                fractions = ranges.sum(axis=1) / (2 * nsteps)
+                margins = motion_bounds * ((ranges[:, 1] - ranges[:, 0]) / (2 * nsteps))[:, np.newaxis]
+                gl_homomats_array = self.get_gl_homomats_batch(
+                    {jlcobj: values + fractions[:, np.newaxis] * jnt_deltas_dict[jlcobj]
+                     for jlcobj, values in jnt_values_from_dict.items()})
+                swept_obbs = _gl_obbs(local_aabbs,
+                                      gl_homomats_array[..., :3, 3],
+                                      gl_homomats_array[..., :3, :3],
+                                      margins)
+                if external_obbs is None:
+                    # the first range is the whole edge
+                    if isinstance(obstacle_list, cenv.CollisionEnvironment):
+                        centers, rotmats, half_extents = [item[0] for item in swept_obbs]
+                        swept_gl_aabbs = rm.transform_aabbs(np.stack([-half_extents, half_extents], axis=1),
+                                                            centers,
+                                                            rotmats)
+                        obstacle_list = obstacle_list.query(np.array([swept_gl_aabbs[:, 0].min(axis=0),
+                                                                      swept_gl_aabbs[:, 1].max(axis=0)]))
+                    external_obbs = self._get_external_obbs(obstacle_list, otherrobot_list)
+                ranges = ranges[~self._is_free_swept(swept_obbs, active_ids, cdpairs, external_obbs)]
+                if len(ranges) == 0:
+                    break
+                middle_ids = ranges.sum(axis=1) // 2
+                is_collided_array = self.is_collided_homomats_batch(
+                    self.get_gl_homomats_batch({jlcobj: values + (middle_ids / nsteps)[:, np.newaxis] *
+                                                        jnt_deltas_dict[jlcobj]
+                                                for jlcobj, values in jnt_values_from_dict.items()}),
+                    obstacle_list=obstacle_list,
+                    otherrobot_list=otherrobot_list,
+                    toggle_stop_at_collision=True)
+                if is_collided_array.any():
+                    nchecks += np.argmax(is_collided_array).item() + 1
+                    collision_result = True
+                    break
+                nchecks += len(middle_ids)
+                ranges = np.concatenate([np.stack([ranges[:, 0], middle_ids - 1], axis=1),
+                                         np.stack([middle_ids + 1, ranges[:, 1]], axis=1)])
+                ranges = ranges[ranges[:, 0] <= ranges[:, 1]]
+        if toggle_nchecks:
+            return collision_result, nchecks, nsteps + 1
+        return collision_result
+
     def show_cdprimit(self):
         """
         Copy the current nodepath to base.render to show collision states
@@ -203,4 +802,79 @@ class CollisionChecker(object):
         self.all_cdelements = []
         for child in self.np.getChildren():
             child.removeNode()
-        self.bitmask_list = list(range(31))
+        self.bitmask_list = [BitMask32(2**n) for n in range(31)]
+        self._overflow_layers = []
+        self._cdlnk_sources = []
+        self._pose_layout = None
+        self._cdelement_local_aabbs = None
+        self.clear_persistent_scene()
+
+
+if __name__ == '__main__':
+    import itertools
+    import time
+    import modeling.collision_model as cm
+    import robot_sim.end_effectors.gripper.robotiq85.robotiq85 as rtq85
+
+
+    def gen_gripper(pairs):
+        gripper = rtq85.Robotiq85()
+        gripper.jaw_to(.04)
+        for i, j in pairs:
+            gripper.cc.set_cdpair([gripper.cc.all_cdelements[i]], [gripper.cc.all_cdelements[j]])
+        return gripper
+
+
+    def timeit(func, ntimes=500):
+        tic = time.time()
+        for _ in range(ntimes):
+            func()
+        return (time.time() - tic) / ntimes * 1e6
+
+
+    # the pairs that are free of collision at jaw width .04, so that no traversal is cut short
+    free_pairs = []
+    for pair in itertools.combinations(range(11), 2):
+        if not gen_gripper([pair]).cc.is_collided():
+            free_pairs.append(pair)
+    print(f"{len(free_pairs)} collision-free pairs")
+    gripper_bitmask = gen_gripper(free_pairs[:31])
+    gripper_split = [gen_gripper(free_pairs[:31]), gen_gripper(free_pairs[31:])]
+    gripper_overflow = gen_gripper(free_pairs)
+    print(f"bitmask path, 31 pairs: {timeit(gripper_bitmask.cc.is_collided):.1f}us")
+    print(f"two checkers, {len(free_pairs)} pairs: "
+          f"{timeit(lambda: [gripper.cc.is_collided() for gripper in gripper_split]):.1f}us")
+    print(f"one checker with overflow layers, {len(free_pairs)} pairs: "
+          f"{timeit(gripper_overflow.cc.is_collided):.1f}us")
+    # obstacles and another robot, attached on each call vs registered once
+    obstacle_list = []
+    for pos in np.random.uniform(-.5, .5, (20, 3)):
+        obstacle = cm.gen_box(np.array([.02, .02, .02]))
+        obstacle.set_pos(pos + np.array([1, 0, 0]))
+        obstacle_list.append(obstacle)
+    other_gripper = rtq85.Robotiq85()
+    other_gripper.fix_to(np.array([0, 0, .3]), np.eye(3))
+    gripper_overflow.cc.set_persistent_scene(obstacle_list, [other_gripper])
+    print(f"obstacles and a robot attached on each call: "
+          f"{timeit(lambda: gripper_bitmask.cc.is_collided(obstacle_list, [other_gripper])):.1f}us")
+    print(f"persistent scene: {timeit(gripper_overflow.cc.is_collided):.1f}us")
+    # a straight edge of the jaw, checked at uniform samples vs certified by the motion bounds
+    motion_vals = np.linspace(0, .8, 161)
+    zeros = np.zeros_like(motion_vals)
+    edge_jnt_values_dict = {gripper_bitmask.lft_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+                            gripper_bitmask.lft_inner: motion_vals[:, np.newaxis],
+                            gripper_bitmask.rgt_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+                            gripper_bitmask.rgt_inner: motion_vals[:, np.newaxis]}
+    tic = time.time()
+    print("uniform samples", gripper_bitmask.cc.is_collided_batch(edge_jnt_values_dict, obstacle_list).any(),
+          time.time() - tic)
+    tic = time.time()
+    print("edge (result, discrete checks, samples)",
+          gripper_bitmask.cc.is_collided_edge({jlcobj: jnt_values[0] for jlcobj, jnt_values in
+                                               edge_jnt_values_dict.items()},
+                                              {jlcobj: jnt_values[-1] for jlcobj, jnt_values in
+                                               edge_jnt_values_dict.items()},
+                                              obstacle_list,
+                                              resolution=.005,
+                                              toggle_nchecks=True),
+          time.time() - tic)
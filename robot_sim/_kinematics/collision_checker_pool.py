@@ -0,0 +1,122 @@
+import collections
+import concurrent.futures as cf
+import os
+import numpy as np
+
+# the robot of a worker process, set once by _init_worker
+_worker_robot = None
+
+
+def _init_worker(robot_factory, scene_factory):
+    global _worker_robot
+    _worker_robot = robot_factory()
+    if scene_factory is not None:
+        obstacle_list, otherrobot_list = scene_factory()
+        _worker_robot.cc.set_persistent_scene(obstacle_list, otherrobot_list)
+
+
+def _check_chunk(gl_homomats_array, toggle_stop_at_collision):
+    return _worker_robot.cc.is_collided_homomats_batch(gl_homomats_array,
+                                                       toggle_stop_at_collision=toggle_stop_at_collision)
+
+
+class CollisionCheckerPool(object):
+    """
+    Check the collisions of many configurations using a pool of processes
+    Panda3D collision nodes cannot be sent to other processes, each worker builds its own robot (and thus its own
+    CollisionChecker and traverser) and scene once using the given factories. The poses of the cd elements are
+    computed in the main process, e.g. using CollisionChecker.get_gl_homomats_batch, and sent in chunks.
+    Use it as a context manager or call close() to shut the workers down.
+    """
+
+    def __init__(self, robot_factory, scene_factory=None, nworkers=None, chunk_size=64):
+        """
+        :param robot_factory: a picklable callable that returns a robot or end effector with cc enabled,
+                              its cd elements must be added in the same order as the ones of the checked robot,
+                              e.g. the class of the robot or functools.partial(robot_class, **kwargs)
+        :param scene_factory: a picklable callable that returns obstacle_list, otherrobot_list,
+                              registered as the persistent scene of the workers
+        :param nworkers: number of processes, os.cpu_count() if None
+        :param chunk_size: number of configurations in a task
+        """
+        self.nworkers = os.cpu_count() if nworkers is None else nworkers
+        self.chunk_size = chunk_size
+        self._executor = cf.ProcessPoolExecutor(max_workers=self.nworkers,
+                                                initializer=_init_worker,
+                                                initargs=(robot_factory, scene_factory))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        cancel the pending tasks and wait for the workers to exit
+        :return:
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def is_collided_batch(self, gl_homomats_array, toggle_stop_at_collision=False):
+        """
+        at most 2*nworkers chunks are submitted ahead of the one being collected
+        :param gl_homomats_array: NxMx4x4 nparray, see CollisionChecker.get_gl_homomats_batch
+        :param toggle_stop_at_collision: stop at the first collided configuration, the remaining ones are not checked
+                                         and reported as collided
+        :return: 1xN bool nparray
+        """
+        gl_homomats_array = np.asarray(gl_homomats_array)
+        is_collided_array = np.zeros(len(gl_homomats_array), dtype=bool)
+        pending = collections.deque()
+        is_stopped = False
+        try:
+            for start in range(0, len(gl_homomats_array), self.chunk_size):
+                pending.append((start, self._executor.submit(_check_chunk,
+                                                             gl_homomats_array[start:start + self.chunk_size],
+                                                             toggle_stop_at_collision)))
+                if len(pending) > 2 * self.nworkers:
+                    is_stopped = self._collect(pending.popleft(), is_collided_array, toggle_stop_at_collision)
+                    if is_stopped:
+                        break
+            while len(pending) > 0 and not is_stopped:
+                is_stopped = self._collect(pending.popleft(), is_collided_array, toggle_stop_at_collision)
+        finally:
+            # stopped early or a task failed
+            for _, future in pending:
+                future.cancel()
+        return is_collided_array
+
+    def _collect(self, task, is_collided_array, toggle_stop_at_collision):
+        """
+        :return: True if the remaining chunks do not need to be checked
+        """
+        start, future = task
+        chunk_result = future.result()
+        is_collided_array[start:start + len(chunk_result)] = chunk_result
+        if toggle_stop_at_collision and chunk_result.any():
+            is_collided_array[start + len(chunk_result):] = True
+            return True
+        return False
+
+
+if __name__ == '__main__':
+    import time
+    import robot_sim.end_effectors.gripper.robotiq85.robotiq85 as rtq85
+
+    gripper = rtq85.Robotiq85()
+    motion_vals = np.random.uniform(0, .8, 2000)
+    zeros = np.zeros_like(motion_vals)
+    gl_homomats_array = gripper.cc.get_gl_homomats_batch(
+        {gripper.lft_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+         gripper.lft_inner: motion_vals[:, np.newaxis],
+         gripper.rgt_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+         gripper.rgt_inner: motion_vals[:, np.newaxis]})
+    tic = time.time()
+    results = gripper.cc.is_collided_homomats_batch(gl_homomats_array)
+    print("is_collided_homomats_batch", time.time() - tic, results.sum())
+    # each worker builds its own Robotiq85, the cd elements are added in the same order
+    with CollisionCheckerPool(rtq85.Robotiq85, chunk_size=250) as pool:
+        tic = time.time()
+        results = pool.is_collided_batch(gl_homomats_array)
+        print("pool", time.time() - tic, results.sum())
@@ -0,0 +1,243 @@
+import os
+import hashlib
+import numpy as np
+import basis.robot_math as rm
+from panda3d.core import NodePath, CollisionTraverser, CollisionHandlerQueue, BitMask32
+
+# the states of the pairs of cd links
+NEVER = 0
+SOMETIMES = 1
+ALWAYS = 2
+
+# the matrices are saved here by build_collision_matrix if no cache_dir is given
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".wrs", "collision_matrices")
+
+
+def _get_cdlnk_ids(cc):
+    """
+    :param cc: robot_sim._kinematics.collision_checker.CollisionChecker
+    :return: 1xL int nparray, element ids of the cdlnks of cc
+    """
+    cdlnk_groups, _, _ = cc._get_pose_layout()
+    return np.sort(np.concatenate([element_ids for _, _, element_ids in cdlnk_groups] + [np.zeros(0, dtype=int)]))
+
+
+def get_definition_md5(cc):
+    """
+    the md5 of the parts of a robot that decide the self collisions of its cdlnks: the kinematics of the jlchains
+    relative to the first one, the joint ranges, and the meshes and cd primitives of the links
+    :param cc: robot_sim._kinematics.collision_checker.CollisionChecker
+    :return: hex string
+    """
+    md5 = hashlib.md5()
+    base_homomat_inv = None
+    for jlcobj, lnk_idlist in cc._cdlnk_sources:
+        fkt = jlcobj._fkt
+        base_homomat = rm.homomat_from_posrot(jlcobj.pos, jlcobj.rotmat)
+        if base_homomat_inv is None:
+            base_homomat_inv = np.linalg.inv(base_homomat)
+        for array in [base_homomat_inv.dot(base_homomat), fkt.parent_ids, fkt.jnt_types, fkt.loc_homomats,
+                      fkt.lnk_loc_homomats, fkt.loc_motionaxes, fkt.motion_rngs, np.array(lnk_idlist)]:
+            md5.update(np.ascontiguousarray(np.round(array, 9)).tobytes())
+    local_aabbs = cc._get_cdelement_local_aabbs()
+    for element_id in _get_cdlnk_ids(cc):
+        objcm = cc.all_cdelements[element_id]['collision_model']
+        cdnode = cc.np.getChild(element_id).node()
+        md5.update(np.ascontiguousarray(np.round(local_aabbs[element_id], 9)).tobytes())
+        md5.update(np.ascontiguousarray(objcm.objtrm.vertices, dtype=float).tobytes())
+        md5.update(np.ascontiguousarray(objcm.objtrm.faces, dtype=int).tobytes())
+        md5.update(",".join(cdnode.getSolid(i).getType().getName() for i in range(cdnode.getNumSolids())).encode())
+    return md5.hexdigest()
+
+
+def get_adjacency(cc):
+    """
+    the pairs of cdlnks connected by a joint of their jlchain
+    :param cc: robot_sim._kinematics.collision_checker.CollisionChecker
+    :return: MxM bool nparray, M = len(cc.all_cdelements)
+    """
+    is_adjacent = np.zeros((len(cc.all_cdelements), len(cc.all_cdelements)), dtype=bool)
+    cdlnk_groups, _, _ = cc._get_pose_layout()
+    for jlcobj, lnk_ids, element_ids in cdlnk_groups:
+        element_id_dict = dict(zip(lnk_ids.tolist(), element_ids.tolist()))
+        for lnk_id, element_id in element_id_dict.items():
+            parent_element_id = element_id_dict.get(jlcobj.jnts[lnk_id]['parent'], -1)
+            if parent_element_id != -1:
+                is_adjacent[element_id, parent_element_id] = is_adjacent[parent_element_id, element_id] = True
+    return is_adjacent
+
+
+def _rand_jnt_values_dict(cc, nsamples):
+    """
+    random configurations of the jlchains of cc, every jlchain is sampled independently using rand_conf
+    :return: {jlcobj: nsamples x n nparray, ...}
+    """
+    jlcobjs = {id(jlcobj): jlcobj for jlcobj, _ in cc._cdlnk_sources}
+    return {jlcobj: np.array([jlcobj.rand_conf() for _ in range(nsamples)]) for jlcobj in jlcobjs.values()}
+
+
+class CollisionMatrix(object):
+    """
+    The frequencies of the self collisions of the cdlnks of a robot at random configurations
+    A pair is NEVER collided (ALWAYS collided) if it is collided in at most never_frequency (at least
+    always_frequency) of the samples, and SOMETIMES otherwise. NEVER is a sampled estimate, a pair that collides in
+    a small region of the configuration space may be missed by too few samples.
+    The rows and columns are the element ids of the CollisionChecker, cdobjs are SOMETIMES and never adjacent.
+    """
+
+    def __init__(self, frequencies, is_adjacent, nsamples, never_frequency=0, always_frequency=1):
+        """
+        :param frequencies: MxM nparray, ratio of the samples in which a pair of elements is collided
+        :param is_adjacent: MxM bool nparray, see get_adjacency
+        :param nsamples: number of configurations the frequencies are computed from
+        :param never_frequency:
+        :param always_frequency:
+        """
+        self.frequencies = np.asarray(frequencies)
+        self.is_adjacent = np.asarray(is_adjacent, dtype=bool)
+        self.nsamples = nsamples
+        self.never_frequency = never_frequency
+        self.always_frequency = always_frequency
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    @property
+    def states(self):
+        """
+        :return: MxM int nparray of NEVER, SOMETIMES, ALWAYS
+        """
+        states = np.full(self.frequencies.shape, SOMETIMES)
+        states[self.frequencies <= self.never_frequency] = NEVER
+        states[self.frequencies >= self.always_frequency] = ALWAYS
+        states[np.isnan(self.frequencies)] = SOMETIMES
+        return states
+
+    def is_needed(self, cdpairs):
+        """
+        :param cdpairs: Px2 int nparray of element ids
+        :return: 1xP bool nparray, True for the pairs that are SOMETIMES collided and not adjacent
+        """
+        cdpairs = np.asarray(cdpairs, dtype=int).reshape(-1, 2)
+        return (self.states[cdpairs[:, 0], cdpairs[:, 1]] == SOMETIMES) & \
+               ~self.is_adjacent[cdpairs[:, 0], cdpairs[:, 1]]
+
+    def get_cdpairs(self):
+        """
+        :return: Px2 int nparray, the pairs (i<j) worth checking, see is_needed
+        """
+        cdpairs = np.argwhere(np.triu(np.ones(self.frequencies.shape, dtype=bool), k=1))
+        return cdpairs[self.is_needed(cdpairs)]
+
+    def save(self, file_name):
+        np.savez(file_name,
+                 frequencies=self.frequencies,
+                 is_adjacent=self.is_adjacent,
+                 nsamples=self.nsamples)
+
+    @classmethod
+    def load(cls, file_name, never_frequency=0, always_frequency=1):
+        with np.load(file_name) as data:
+            return cls(data['frequencies'], data['is_adjacent'], int(data['nsamples']),
+                       never_frequency=never_frequency, always_frequency=always_frequency)
+
+
+def build_collision_matrix(cc, nsamples=10000, sampler=None, batch_size=1000, cache_dir=None):
+    """
+    check every pair of cdlnks at random configurations, all pairs are checked by one traverser on copies of
+    the cd nodepaths, the declared pairs of cc are not used
+    the matrix is saved under the md5 of the robot definition (see get_definition_md5) and nsamples,
+    and loaded instead of sampled if it exists
+    :param cc: robot_sim._kinematics.collision_checker.CollisionChecker
+    :param nsamples: number of configurations
+    :param sampler: callable(n) that returns {jlcobj: nxdof nparray, ...}, e.g. for mimic joints; the jlchains are
+                    sampled independently using rand_conf if None. The cache does not know about the sampler,
+                    use a different cache_dir for each sampler
+    :param batch_size: number of configurations in a batched fk
+    :param cache_dir: DEFAULT_CACHE_DIR if None
+    :return: a CollisionMatrix
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    file_name = os.path.join(cache_dir, f"{get_definition_md5(cc)}_{nsamples}.npz")
+    if os.path.isfile(file_name):
+        return CollisionMatrix.load(file_name)
+    if sampler is None:
+        sampler = lambda n: _rand_jnt_values_dict(cc, n)
+    cdlnk_ids = _get_cdlnk_ids(cc)
+    nelements = len(cc.all_cdelements)
+    # the copies of the cdlnks collide with each other, the copies of the cdobjs with nothing
+    probe_np = NodePath(cc.name + "_probe")
+    ctrav = CollisionTraverser()
+    chan = CollisionHandlerQueue()
+    for element_id, cdnp in enumerate(cc.np.getChildren()):
+        probe_cdnp = cdnp.copyTo(probe_np)
+        probe_cdnp.setName(str(element_id))
+        if element_id in cdlnk_ids:
+            probe_cdnp.node().setCollideMask(BitMask32.bit(0))
+            ctrav.addCollider(probe_cdnp, chan)
+        else:
+            probe_cdnp.node().setCollideMask(BitMask32.allOff())
+    counts = np.zeros((nelements, nelements))
+    for start in range(0, nsamples, batch_size):
+        gl_homomats_array = cc.get_gl_homomats_batch(sampler(min(batch_size, nsamples - start)))
+        nconf = len(gl_homomats_array)
+        poss_array = gl_homomats_array[:, :, :3, 3].tolist()
+        quaternions_array = rm.quaternions_from_rotmats(gl_homomats_array[:, :, :3, :3].reshape(-1, 3, 3))
+        quaternions_array = quaternions_array.reshape(nconf, nelements, 4).tolist()
+        for i in range(nconf):
+            cc._push_posquats(poss_array[i], quaternions_array[i], parent_np=probe_np)
+            ctrav.traverse(probe_np)
+            cdpairs = {(int(entry.getFromNodePath().getName()), int(entry.getIntoNodePath().getName()))
+                       for entry in chan.getEntries()}
+            for element_id0, element_id1 in cdpairs | {(pair[1], pair[0]) for pair in cdpairs}:
+                counts[element_id0, element_id1] += 1
+    probe_np.removeNode()
+    frequencies = counts / nsamples
+    is_cdlnk = np.zeros(nelements, dtype=bool)
+    is_cdlnk[cdlnk_ids] = True
+    frequencies[~(is_cdlnk[:, np.newaxis] & is_cdlnk[np.newaxis, :])] = np.nan
+    np.fill_diagonal(frequencies, np.nan)
+    collision_matrix = CollisionMatrix(frequencies, get_adjacency(cc), nsamples)
+    os.makedirs(cache_dir, exist_ok=True)
+    collision_matrix.save(file_name)
+    return collision_matrix
+
+
+if __name__ == '__main__':
+    import itertools
+    import time
+    import robot_sim.end_effectors.gripper.robotiq85.robotiq85 as rtq85
+
+    gripper = rtq85.Robotiq85()
+    # all joints of the robotiq85 mimic lft_outer.jnts[1]
+    def sampler(n):
+        motion_vals = np.random.uniform(0, .8, n)
+        zeros = np.zeros_like(motion_vals)
+        return {gripper.lft_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+                gripper.lft_inner: motion_vals[:, np.newaxis],
+                gripper.rgt_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+                gripper.rgt_inner: motion_vals[:, np.newaxis]}
+    tic = time.time()
+    collision_matrix = build_collision_matrix(gripper.cc, nsamples=2000, sampler=sampler,
+                                              cache_dir=os.path.join(DEFAULT_CACHE_DIR, "robotiq85_jaw"))
+    print(f"build or load: {time.time() - tic:.2f}s")
+    states = collision_matrix.states[np.triu_indices(len(collision_matrix), k=1)]
+    print(f"never {(states == NEVER).sum()}, sometimes {(states == SOMETIMES).sum()}, "
+          f"always {(states == ALWAYS).sum()}, adjacent {np.triu(collision_matrix.is_adjacent).sum()}")
+    # all pairs declared by hand vs the pairs left by the matrix, on a standard set of configurations
+    # the traversals are not cut short at the first collision, so that the cost of the pairs is compared
+    def time_traversals(cc, gl_homomats_array):
+        tic = time.time()
+        is_collided_array = np.zeros(len(gl_homomats_array), dtype=bool)
+        for i, gl_homomats in enumerate(gl_homomats_array):
+            cc._push_gl_homomats(gl_homomats)
+            is_collided_array[i] = cc._traverse(toggle_contact_points=True)[0]
+        return time.time() - tic, is_collided_array.sum()
+    for pair in itertools.combinations(range(len(gripper.cc.all_cdelements)), 2):
+        gripper.cc.set_cdpair([gripper.cc.all_cdelements[pair[0]]], [gripper.cc.all_cdelements[pair[1]]])
+    np.random.seed(0)
+    gl_homomats_array = gripper.cc.get_gl_homomats_batch(sampler(1000))
+    print("all pairs (time, collided)", time_traversals(gripper.cc, gl_homomats_array))
+    print(f"{gripper.cc.prune_cdpairs(collision_matrix)} pairs dropped, {len(gripper.cc._get_cdpairs()[1])} left")
+    print("pruned pairs (time, collided)", time_traversals(gripper.cc, gl_homomats_array))
@@ -2,6 +2,7 @@ import math
 import copy
 import numpy as np
 import basis.robot_math as rm
+import robot_sim._kinematics.jlchain_fk as jlfk
 import robot_sim._kinematics.jlchain_mesh as jlm
 import robot_sim._kinematics.jlchain_ik as jlik
 
@@ -46,6 +47,7 @@ class JLChain(object):
         self.lnks, self.jnts = self._init_jlchain()
         self._tgtjnts = list(range(1, self.ndof + 1))
         self._jnt_ranges = self._get_jnt_ranges()
+        self._fkt = jlfk.JLChainFK(self)  # t = tool
         self.goto_homeconf()
         # default tcp
         self.tcp_jnt_id = -1
@@ -57,6 +59,8 @@ class JLChain(object):
         self.cdmesh_type = cdmesh_type
         self._mt = jlm.JLChainMesh(self, cdprimitive_type=cdprimitive_type, cdmesh_type=cdmesh_type)  # t = tool
         self._ikt = jlik.JLChainIK(self)  # t = tool
+        # analytic ik solvers, name -> callable, see register_ik_backend
+        self._ik_backends = {}
 
     def _init_jlchain(self):
         """
@@ -115,37 +119,10 @@ class JLChain(object):
         author: weiwei
         date: 20161202, 20201009osaka
         """
-        id = 0
-        while id != -1:
-            # update joint values
-            pjid = self.jnts[id]['parent']
-            if pjid == -1:
-                self.jnts[id]['gl_pos0'] = self.pos
-                self.jnts[id]['gl_rotmat0'] = self.rotmat
-            else:
-                self.jnts[id]['gl_pos0'] = self.jnts[pjid]['gl_posq'] + self.jnts[pjid]['gl_rotmatq'] @ self.jnts[id][
-                    'loc_pos']
-                self.jnts[id]['gl_rotmat0'] = self.jnts[pjid]['gl_rotmatq'] @ self.jnts[id]['loc_rotmat']
-            self.jnts[id]['gl_motionax'] = np.dot(self.jnts[id]['gl_rotmat0'], self.jnts[id]['loc_motionax'])
-            if self.jnts[id]['type'] == "end" or self.jnts[id]['type'] == "fixed":
-                self.jnts[id]['gl_rotmatq'] = self.jnts[id]['gl_rotmat0']
-                self.jnts[id]['gl_posq'] = self.jnts[id]['gl_pos0']
-            elif self.jnts[id]['type'] == "revolute":
-                loc_rotmat = rm.rotmat_from_axangle(self.jnts[id]['loc_motionax'], self.jnts[id]['motion_val'])
-                self.jnts[id]['gl_rotmatq'] = self.jnts[id]['gl_rotmat0'] @ loc_rotmat
-                self.jnts[id]['gl_posq'] = self.jnts[id]['gl_pos0']
-            elif self.jnts[id]['type'] == "prismatic":
-                self.jnts[id]['gl_rotmatq'] = self.jnts[id]['gl_rotmat0']
-                tmp_translation = np.dot(self.jnts[id]['gl_rotmatq'],
-                                         self.jnts[id]['loc_motionax'] * self.jnts[id]['motion_val'])
-                self.jnts[id]['gl_posq'] = self.jnts[id]['gl_pos0'] + tmp_translation
-            # update link values, child link id = id
-            if id < self.ndof + 1:
-                self.lnks[id]['gl_pos'] = np.dot(self.jnts[id]['gl_rotmatq'], self.lnks[id]['loc_pos']) + \
-                                          self.jnts[id]['gl_posq']
-                self.lnks[id]['gl_rotmat'] = np.dot(self.jnts[id]['gl_rotmatq'], self.lnks[id]['loc_rotmat'])
-                # self.lnks[id]['cdprimit_cache'][0] = True
-            id = self.jnts[id]['child']
+        self._fkt.motion_vals[:] = [jnt['motion_val'] for jnt in self.jnts]
+        self._fkt.set_base(self.pos, self.rotmat)
+        self._fkt.update()
+        self._fkt.sync_to(self.jnts, self.lnks)
         return self.lnks, self.jnts
 
     @property
@@ -168,6 +145,7 @@ class JLChain(object):
     def tgtjnts(self, values):
         self._tgtjnts = values
         self._jnt_ranges = self._get_jnt_ranges()
+        self._fkt = jlfk.JLChainFK(self)
         self._ikt = jlik.JLChainIK(self)
 
     def _get_jnt_ranges(self):
@@ -212,6 +190,7 @@ class JLChain(object):
         date: 20201126
         """
         self._jnt_ranges = self._get_jnt_ranges()
+        self._fkt = jlfk.JLChainFK(self)
         self.goto_homeconf()
         if cdprimitive_type is None:  # use previously set values if none
             cdprimitive_type = self.cdprimitive_type
@@ -267,16 +246,34 @@ class JLChain(object):
         """
         status = "succ"  # "succ" or "out_of_rng"
         if jnt_values is not None:
-            counter = 0
-            for id in self.tgtjnts:
-                if jnt_values[counter] < self.jnts[id]["motion_rng"][0] or jnt_values[counter] > \
-                        self.jnts[id]["motion_rng"][1]:
-                    status = "out_of_rng"
+            if not self._fkt.is_in_ranges(jnt_values):
+                status = "out_of_rng"
+            for counter, id in enumerate(self.tgtjnts):
                 self.jnts[id]['motion_val'] = jnt_values[counter]
-                counter += 1
         self._update_fk()
         return status
 
+    def fk_batch(self, jnt_values_array, tcp_jnt_id=None, tcp_loc_pos=None, tcp_loc_rotmat=None):
+        """
+        forward kinematics of many configurations in one vectorized pass
+        the current joint values and the joint/link dictionaries are not changed
+        :param jnt_values_array: Nxn nparray where each row indicates the values of self.tgtjnts
+        :param tcp_jnt_id: a single joint id, self.tcp_jnt_id will be used if None
+        :param tcp_loc_pos: 1x3 nparray, self.tcp_loc_pos will be used if None
+        :param tcp_loc_rotmat: 3x3 nparray, self.tcp_loc_rotmat will be used if None
+        :return: gl_homomats, Nxnjntsx4x4 nparray of the joint frames (gl_posq, gl_rotmatq);
+                 tcp_homomats, Nx4x4 nparray of the global tool center poses
+        """
+        if tcp_jnt_id is None:
+            tcp_jnt_id = self.tcp_jnt_id
+        if tcp_loc_pos is None:
+            tcp_loc_pos = self.tcp_loc_pos
+        if tcp_loc_rotmat is None:
+            tcp_loc_rotmat = self.tcp_loc_rotmat
+        gl_homomats = self._fkt.fk_batch(jnt_values_array, base_homomat=rm.homomat_from_posrot(self.pos, self.rotmat))
+        tcp_homomats = self._fkt.get_gl_tcp_batch(gl_homomats, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+        return gl_homomats, tcp_homomats
+
     def goto_homeconf(self):
         """
         move the robot_s to initial pose
@@ -322,6 +319,74 @@ class JLChain(object):
             counter += 1
         return jnt_values
 
+    def set_ik_seed_cache(self, seed_cache):
+        """
+        use seed_cache to warm start ik when no seed_jnt_values is given
+        NOTE: the cache is dropped by reinitialize and by setting tgtjnts, set it again afterwards
+        :param seed_cache: an instance of robot_sim._kinematics.jlchain_ik_cache.IKSeedCache, None to disable
+        :return:
+        """
+        self._ikt.seed_cache = seed_cache
+
+    def set_ik_reachability_map(self, reachability_map, toggle_reject=False, min_count=1):
+        """
+        seed ik using reachability_map when no seed_jnt_values is given, and optionally reject unreachable goals
+        NOTE: the map is dropped by reinitialize and by setting tgtjnts, set it again afterwards
+        :param reachability_map: an instance of robot_sim._kinematics.jlchain_reachability.ReachabilityMap,
+                                 None to disable
+        :param toggle_reject: return None without solving if the goal is not reachable in the map,
+                              the map may miss reachable goals, see build_reachability_map
+        :param min_count: cells with fewer samples are considered unreachable when rejecting
+        :return:
+        """
+        self._ikt.reachability_map = reachability_map
+        self._ikt.reachability_toggle_reject = toggle_reject
+        self._ikt.reachability_min_count = min_count
+
+    def register_ik_backend(self, name, ik_backend):
+        """
+        register an analytic ik solver, the solvers are tried in the order of registration before num_ik
+        an ik_backend is a callable:
+            ik_backend(tgt_pos, tgt_rotmat, base_pos, base_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+        that returns all closed-form branches as a kxn nparray (k could be 0), or None if it does not apply
+        (e.g. a different tcp), see robot_sim._kinematics.jlchain_ik_analytic.SphericalWristIK
+        :param name: registering the same name replaces the previous solver
+        :param ik_backend:
+        :return:
+        """
+        self._ik_backends[name] = ik_backend
+
+    def unregister_ik_backend(self, name):
+        self._ik_backends.pop(name, None)
+
+    def analytic_ik(self,
+                    tgt_pos,
+                    tgt_rotmat,
+                    tcp_jnt_id=None,
+                    tcp_loc_pos=None,
+                    tcp_loc_rotmat=None):
+        """
+        all branches of the registered analytic ik solvers
+        :param tgt_pos: 1x3 nparray
+        :param tgt_rotmat: 3x3 nparray
+        :param tcp_jnt_id: self.tcp_jnt_id will be used if None
+        :param tcp_loc_pos: self.tcp_loc_pos will be used if None
+        :param tcp_loc_rotmat: self.tcp_loc_rotmat will be used if None
+        :return: kxn nparray, k=0 if no solver applies
+        """
+        tcp_jnt_id = self.tcp_jnt_id if tcp_jnt_id is None else tcp_jnt_id
+        tcp_loc_pos = self.tcp_loc_pos if tcp_loc_pos is None else tcp_loc_pos
+        tcp_loc_rotmat = self.tcp_loc_rotmat if tcp_loc_rotmat is None else tcp_loc_rotmat
+        candidates_list = []
+        for ik_backend in self._ik_backends.values():
+            candidates = ik_backend(tgt_pos, tgt_rotmat, self.pos, self.rotmat, tcp_jnt_id, tcp_loc_pos,
+                                    tcp_loc_rotmat)
+            if candidates is not None:
+                candidates_list.append(np.asarray(candidates).reshape(-1, len(self.tgtjnts)))
+        if len(candidates_list) == 0:
+            return np.empty((0, len(self.tgtjnts)))
+        return np.vstack(candidates_list)
+
     def ik(self,
            tgt_pos,
            tgt_rotmat,
@@ -331,9 +396,12 @@ class JLChain(object):
            tcp_loc_rotmat=None,
            max_niter=100,
            local_minima="accept",
+           toggle_fk=False,
            toggle_debug=False):
         """
         Numerical IK
+        if analytic solvers are registered (see register_ik_backend), the branch nearest to seed_jnt_values
+        (or self.homeconf) is polished by num_ik, num_ik falls back to seed_jnt_values if no branch is found
         NOTE1: in the numik function of rotjntlinksik,
         tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat are the tool center pose parameters. They are
         used for temporary computation, the self.tcp_xxx parameters will not be changed
@@ -347,8 +415,25 @@ class JLChain(object):
         :param tcp_loc_rotmat: 3x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id], single value or list
         :param max_niter
         :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+        :param toggle_fk: move the jlchain to the result if True, the jlchain is not changed otherwise
         :return:
         """
+        if self._ik_backends and not isinstance(tgt_pos, list):
+            candidates = self.analytic_ik(tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+            if len(candidates) > 0:
+                ref_jnt_values = self.homeconf if seed_jnt_values is None else seed_jnt_values
+                jnt_values = self._ikt.num_ik(tgt_pos=tgt_pos,
+                                              tgt_rot=tgt_rotmat,
+                                              seed_jnt_values=candidates[
+                                                  np.argmin(np.linalg.norm(candidates - ref_jnt_values, axis=1))],
+                                              max_niter=max_niter,
+                                              tcp_jnt_id=tcp_jnt_id,
+                                              tcp_loc_pos=tcp_loc_pos,
+                                              tcp_loc_rotmat=tcp_loc_rotmat,
+                                              local_minima="end",
+                                              toggle_fk=toggle_fk)
+                if jnt_values is not None:
+                    return jnt_values
         return self._ikt.num_ik(tgt_pos=tgt_pos,
                                 tgt_rot=tgt_rotmat,
                                 seed_jnt_values=seed_jnt_values,
@@ -357,8 +442,40 @@ class JLChain(object):
                                 tcp_loc_pos=tcp_loc_pos,
                                 tcp_loc_rotmat=tcp_loc_rotmat,
                                 local_minima=local_minima,
+                                toggle_fk=toggle_fk,
                                 toggle_debug=toggle_debug)
 
+    def ik_batch(self,
+                 tgt_poss,
+                 tgt_rotmats,
+                 seed_jnt_values=None,
+                 tcp_jnt_id=None,
+                 tcp_loc_pos=None,
+                 tcp_loc_rotmat=None,
+                 max_niter=100,
+                 local_minima="accept"):
+        """
+        Numerical IK of many targets, the iterations of all targets and seeds are carried out together
+        only a single tcp_jnt_id is acceptable, the jlchain is not changed
+        :param tgt_poss: Mx3 nparray
+        :param tgt_rotmats: Mx3x3 nparray
+        :param seed_jnt_values: 1xn (shared), Mxn (one for each target), or MxKxn (K for each target) nparray
+        :param tcp_jnt_id: a joint ID in the self.tgtjnts
+        :param tcp_loc_pos: 1x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id]
+        :param tcp_loc_rotmat: 3x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id]
+        :param max_niter
+        :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+        :return: jnt_values (Mxn nparray, nan for failures), is_converged (1xM bool nparray), niters (1xM nparray)
+        """
+        return self._ikt.num_ik_batch(tgt_poss=tgt_poss,
+                                      tgt_rotmats=tgt_rotmats,
+                                      seed_jnt_values=seed_jnt_values,
+                                      max_niter=max_niter,
+                                      tcp_jnt_id=tcp_jnt_id,
+                                      tcp_loc_pos=tcp_loc_pos,
+                                      tcp_loc_rotmat=tcp_loc_rotmat,
+                                      local_minima=local_minima)
+
     def manipulability(self,
                        tcp_jnt_id,
                        tcp_loc_pos,
@@ -391,6 +508,48 @@ class JLChain(object):
                                   tcp_loc_pos=tcp_loc_pos,
                                   tcp_loc_rotmat=tcp_loc_rotmat)
 
+    def jacobian_batch(self,
+                       jnt_values_array,
+                       tcp_jnt_id=None,
+                       tcp_loc_pos=None,
+                       tcp_loc_rotmat=None):
+        """
+        the jacobians of many configurations, the current joint values are not changed
+        :param jnt_values_array: Nxn nparray
+        :param tcp_jnt_id: single value or list, self.tcp_jnt_id will be used if None
+        :param tcp_loc_pos: single value or list, self.tcp_loc_pos will be used if None
+        :param tcp_loc_rotmat: single value or list, self.tcp_loc_rotmat will be used if None
+        :return: Nx6xn nparray, or Nx(6*len(tcp_jnt_id))xn nparray if list
+        """
+        tcp_jnt_id = self.tcp_jnt_id if tcp_jnt_id is None else tcp_jnt_id
+        tcp_loc_pos = self.tcp_loc_pos if tcp_loc_pos is None else tcp_loc_pos
+        tcp_loc_rotmat = self.tcp_loc_rotmat if tcp_loc_rotmat is None else tcp_loc_rotmat
+        return self._ikt.jacobian_batch(jnt_values_array,
+                                        tcp_jnt_id=tcp_jnt_id,
+                                        tcp_loc_pos=tcp_loc_pos,
+                                        tcp_loc_rotmat=tcp_loc_rotmat)
+
+    def manipulability_batch(self,
+                             jnt_values_array,
+                             tcp_jnt_id=None,
+                             tcp_loc_pos=None,
+                             tcp_loc_rotmat=None):
+        """
+        the yoshikawa manipulability of many configurations, the current joint values are not changed
+        :param jnt_values_array: Nxn nparray
+        :param tcp_jnt_id: single value or list, self.tcp_jnt_id will be used if None
+        :param tcp_loc_pos: single value or list, self.tcp_loc_pos will be used if None
+        :param tcp_loc_rotmat: single value or list, self.tcp_loc_rotmat will be used if None
+        :return: 1xN nparray
+        """
+        tcp_jnt_id = self.tcp_jnt_id if tcp_jnt_id is None else tcp_jnt_id
+        tcp_loc_pos = self.tcp_loc_pos if tcp_loc_pos is None else tcp_loc_pos
+        tcp_loc_rotmat = self.tcp_loc_rotmat if tcp_loc_rotmat is None else tcp_loc_rotmat
+        return self._ikt.manipulability_batch(jnt_values_array,
+                                              tcp_jnt_id=tcp_jnt_id,
+                                              tcp_loc_pos=tcp_loc_pos,
+                                              tcp_loc_rotmat=tcp_loc_rotmat)
+
     def cvt_loc_tcp_to_gl(self,
                           loc_pos=np.zeros(3),
                           loc_rotmat=np.eye(3),
@@ -0,0 +1,423 @@
+import numpy as np
+
+# joint type codes of the compiled representation
+JNT_END = 0
+JNT_FIXED = 1
+JNT_REVOLUTE = 2
+JNT_PRISMATIC = 3
+JNT_TYPE_CODES = {'end': JNT_END, 'fixed': JNT_FIXED, 'revolute': JNT_REVOLUTE, 'prismatic': JNT_PRISMATIC}
+
+
+# component orders for computing cross products of stacked vectors
+_YZX = [1, 2, 0]
+_ZXY = [2, 0, 1]
+
+
+def _as_index(ids):
+    """
+    convert an array of ids into a slice if the ids are consecutive, slicing is faster than fancy indexing
+    :param ids: 1xk nparray
+    :return:
+    """
+    if ids.size > 0 and np.all(np.diff(ids) == 1):
+        return slice(ids[0].item(), ids[-1].item() + 1)
+    return ids
+
+
+class JLChainFK(object):
+    """
+    Array-backed forward kinematics of a JLChain
+    The lists of joint and link dictionaries are compiled once into contiguous arrays (local transforms,
+    motion axes, joint types, and ranges). fk writes into preallocated buffers; the dictionaries of the
+    jlchain are refreshed from the buffers by sync_to.
+    The object does not hold a reference to the jlchain. It only contains nparrays and could be pickled.
+    Use copy() to get an instance that shares the compiled arrays but owns a separate set of buffers.
+    NOTE: the compiled arrays are not updated automatically, call JLChain.reinitialize() after changing
+    the 'loc_xxx', 'type', or 'motion_rng' values of joints and links
+    """
+
+    def __init__(self, jlc_object):
+        """
+        :param jlc_object: an instance of robot_sim._kinematics.jlchain.JLChain
+        """
+        jnts = jlc_object.jnts
+        lnks = jlc_object.lnks
+        self.njnts = len(jnts)
+        self.nlnks = len(lnks)
+        self.ndof = jlc_object.ndof
+        self.tgtjnts = np.asarray(jlc_object.tgtjnts, dtype=int)
+        # traversal order, following the child ids from the root joint
+        order = []
+        id = 0
+        while id != -1:
+            order.append(id)
+            id = jnts[id]['child']
+        self.order = np.asarray(order, dtype=int)
+        self._order_is_sequential = np.array_equal(self.order, np.arange(self.njnts))
+        self.parent_ids = np.array([jnt['parent'] for jnt in jnts], dtype=int)
+        self._root_ids = np.flatnonzero(self.parent_ids == -1)
+        nonroot_ids = np.flatnonzero(self.parent_ids != -1)
+        self._nonroot_ids = _as_index(nonroot_ids)
+        self._nonroot_pids = _as_index(self.parent_ids[nonroot_ids])
+        self._traversal = [(id, self.parent_ids[id].item()) for id in order]  # python ints for fast looping
+        self.jnt_types = np.array([JNT_TYPE_CODES[jnt['type']] for jnt in jnts], dtype=int)
+        self.motion_rngs = np.array([jnt['motion_rng'] for jnt in jnts], dtype=float)
+        self.loc_motionaxes = np.array([jnt['loc_motionax'] for jnt in jnts], dtype=float)
+        self.loc_homomats = np.tile(np.eye(4), (self.njnts, 1, 1))
+        for id, jnt in enumerate(jnts):
+            if jnt['parent'] != -1:  # the connecting end is fixed to the given pos and rotmat directly
+                self.loc_homomats[id, :3, :3] = jnt['loc_rotmat']
+                self.loc_homomats[id, :3, 3] = jnt['loc_pos']
+        self.lnk_loc_homomats = np.tile(np.eye(4), (self.nlnks, 1, 1))
+        for id, lnk in enumerate(lnks):
+            self.lnk_loc_homomats[id, :3, :3] = lnk['loc_rotmat']
+            self.lnk_loc_homomats[id, :3, 3] = lnk['loc_pos']
+        self.rev_ids = np.flatnonzero(self.jnt_types == JNT_REVOLUTE)
+        self.pris_ids = np.flatnonzero(self.jnt_types == JNT_PRISMATIC)
+        axlens = np.linalg.norm(self.loc_motionaxes[self.rev_ids], axis=1, keepdims=True)
+        axlens[np.isclose(axlens, 0)] = 1.0
+        self.rev_unitaxes = self.loc_motionaxes[self.rev_ids] / axlens
+        # rodrigues terms premultiplied by the local rotmats, loc_rotmat.dot(rotmat_from_axangle(ax, q)) is
+        # computed as _rev_const+cos(q)*_rev_cos+sin(q)*_rev_sin
+        outers = np.einsum('ij,ik->ijk', self.rev_unitaxes, self.rev_unitaxes)
+        skews = np.zeros((self.rev_ids.size, 3, 3))
+        skews[:, 0, 1] = -self.rev_unitaxes[:, 2]
+        skews[:, 0, 2] = self.rev_unitaxes[:, 1]
+        skews[:, 1, 0] = self.rev_unitaxes[:, 2]
+        skews[:, 1, 2] = -self.rev_unitaxes[:, 0]
+        skews[:, 2, 0] = -self.rev_unitaxes[:, 1]
+        skews[:, 2, 1] = self.rev_unitaxes[:, 0]
+        rev_loc_rotmats = self.loc_homomats[self.rev_ids, :3, :3]
+        self._rev_const = np.matmul(rev_loc_rotmats, outers)
+        self._rev_cos = np.matmul(rev_loc_rotmats, np.eye(3) - outers)
+        self._rev_sin = np.matmul(rev_loc_rotmats, skews)
+        # quick access to the tgt joints
+        self._rev_index = _as_index(self.rev_ids)
+        self._pris_index = _as_index(self.pris_ids)
+        self._tgt_index = _as_index(self.tgtjnts)
+        self.tgt_rngs = self.motion_rngs[self.tgtjnts] if self.tgtjnts.size > 0 else np.empty((0, 2))
+        self.tgt_is_rev = (self.jnt_types[self.tgtjnts] == JNT_REVOLUTE)
+        self.tgt_is_pris = (self.jnt_types[self.tgtjnts] == JNT_PRISMATIC)
+        self._tgt_rev_wts = self.tgt_is_rev[:, None].astype(float)
+        self._tgt_pris_wts = self.tgt_is_pris[:, None].astype(float)
+        self._tgt_rng_mins = self.tgt_rngs[:, 0].copy()
+        self._tgt_rng_maxs = self.tgt_rngs[:, 1].copy()
+        self._tgt_counters = {}  # jnt id -> position in tgtjnts, the first one is kept if repeated
+        for counter, id in enumerate(self.tgtjnts.tolist()):
+            self._tgt_counters.setdefault(id, counter)
+        self._init_buffers()
+
+    def _init_buffers(self):
+        self.motion_vals = np.zeros(self.njnts)
+        self.base_homomat = np.eye(4)
+        # local transforms including joint motions, static for end and fixed joints
+        self._loc_homomatqs = self.loc_homomats.copy()
+        # frames described in the base frame, the global ones are obtained by base_homomat.dot(bs_xxx)
+        self._bs_homomatqs = np.tile(np.eye(4), (self.njnts, 1, 1))
+        self._bs_homomat0s = np.tile(np.eye(4), (self.njnts, 1, 1))
+        self.gl_homomat0s = np.tile(np.eye(4), (self.njnts, 1, 1))
+        self.gl_homomatqs = np.tile(np.eye(4), (self.njnts, 1, 1))
+        self.gl_motionaxes = np.zeros((self.njnts, 3))
+        self.lnk_gl_homomats = np.tile(np.eye(4), (self.nlnks, 1, 1))
+        # per-joint views for fast looping
+        self._loc_homomatq_views = list(self._loc_homomatqs)
+        self._bs_homomatq_views = list(self._bs_homomatqs)
+        # dirty tracking, the motion values and base used by the last update (nan = never updated)
+        self._cached_motion_vals = np.full(self.njnts, np.nan)
+        self._cached_base_homomat = np.full((4, 4), np.nan)
+        self._is_full = False  # if gl_homomat0s and lnk_gl_homomats are up to date
+        self._unsynced_from = 0  # position in self.order from which the dictionaries are outdated
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # views do not survive pickling, they are recreated in __setstate__
+        del state['_loc_homomatq_views']
+        del state['_bs_homomatq_views']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._loc_homomatq_views = list(self._loc_homomatqs)
+        self._bs_homomatq_views = list(self._bs_homomatqs)
+
+    def copy(self):
+        """
+        a shallow copy that shares the compiled arrays and owns a new set of buffers
+        :return:
+        """
+        fkt = object.__new__(JLChainFK)
+        fkt.__dict__.update(self.__dict__)
+        fkt._init_buffers()
+        fkt.motion_vals[:] = self.motion_vals
+        fkt.base_homomat[:] = self.base_homomat
+        return fkt
+
+    def set_base(self, pos, rotmat):
+        self.base_homomat[:3, :3] = rotmat
+        self.base_homomat[:3, 3] = pos
+
+    def set_tgt_motion_vals(self, jnt_values):
+        self.motion_vals[self._tgt_index] = jnt_values
+
+    def get_tgt_motion_vals(self):
+        return self.motion_vals[self._tgt_index]
+
+    def is_in_ranges(self, jnt_values):
+        """
+        :param jnt_values: 1xn nparray of the tgt joints
+        :return: True or False
+        """
+        return bool(np.logical_and(self._tgt_rng_mins <= jnt_values, jnt_values <= self._tgt_rng_maxs).all())
+
+    def _update_loc_homomatqs(self, is_changed):
+        """
+        :param is_changed: 1xnjnts bool nparray, only the changed joints are recomputed
+        :return:
+        """
+        if self.rev_ids.size > 0:
+            selection = is_changed[self._rev_index]
+            if selection.all():
+                angles = self.motion_vals[self._rev_index, None, None]
+                self._loc_homomatqs[self._rev_index, :3, :3] = self._rev_const + np.cos(
+                    angles) * self._rev_cos + np.sin(angles) * self._rev_sin
+            elif selection.any():
+                ids = self.rev_ids[selection]
+                angles = self.motion_vals[ids, None, None]
+                self._loc_homomatqs[ids, :3, :3] = self._rev_const[selection] + np.cos(
+                    angles) * self._rev_cos[selection] + np.sin(angles) * self._rev_sin[selection]
+        if self.pris_ids.size > 0 and is_changed[self._pris_index].any():
+            translations = self.loc_motionaxes[self._pris_index] * self.motion_vals[self._pris_index, None]
+            self._loc_homomatqs[self._pris_index, :3, 3] = self.loc_homomats[self._pris_index, :3, 3] + np.einsum(
+                'ijk,ik->ij', self.loc_homomats[self._pris_index, :3, :3], translations)
+
+    def update(self, toggle_full=True):
+        """
+        update the buffers using self.motion_vals and self.base_homomat
+        only the joints downstream of the first changed motion value are recomputed, the frames are cached in
+        the base frame so that a change of the base alone costs one rigid transform of the cached frames
+        :param toggle_full: False to only update gl_homomatqs and gl_motionaxes (e.g. in numerical ik),
+                            gl_homomat0s and lnk_gl_homomats are skipped
+        :return:
+        """
+        is_changed = self.motion_vals != self._cached_motion_vals
+        is_base_changed = not np.array_equal(self.base_homomat, self._cached_base_homomat)
+        if is_changed.any():
+            start = int(np.argmax(is_changed[self.order]))
+            self._cached_motion_vals[:] = self.motion_vals
+            self._update_loc_homomatqs(is_changed)
+            bs_homomatqs = self._bs_homomatq_views
+            loc_homomatqs = self._loc_homomatq_views
+            for id, pid in self._traversal[start:]:
+                if pid == -1:
+                    np.copyto(bs_homomatqs[id], loc_homomatqs[id])
+                else:
+                    np.dot(bs_homomatqs[pid], loc_homomatqs[id], out=bs_homomatqs[id])
+            self._is_full = False
+        elif is_base_changed:
+            start = 0
+        elif self._is_full or not toggle_full:
+            return
+        else:
+            start = self.order.size
+        if is_base_changed:
+            self._cached_base_homomat[:] = self.base_homomat
+            self._is_full = False
+            start = 0
+        self._unsynced_from = min(self._unsynced_from, start if self._order_is_sequential else 0)
+        np.matmul(self.base_homomat, self._bs_homomatqs, out=self.gl_homomatqs)
+        if not toggle_full:
+            # the motion axes are invariant to the motions of their own joints
+            np.einsum('ijk,ik->ij', self.gl_homomatqs[:, :3, :3], self.loc_motionaxes, out=self.gl_motionaxes)
+            return
+        # frames before joint motion
+        np.matmul(self._bs_homomatqs[self._nonroot_pids], self.loc_homomats[self._nonroot_ids],
+                  out=self._bs_homomat0s[self._nonroot_ids])
+        np.matmul(self.base_homomat, self._bs_homomat0s, out=self.gl_homomat0s)
+        np.einsum('ijk,ik->ij', self.gl_homomat0s[:, :3, :3], self.loc_motionaxes, out=self.gl_motionaxes)
+        np.matmul(self.gl_homomatqs[:self.nlnks], self.lnk_loc_homomats, out=self.lnk_gl_homomats)
+        self._is_full = True
+
+    def fk(self, tgt_jnt_values=None, base_pos=None, base_rotmat=None, toggle_full=True):
+        """
+        :param tgt_jnt_values: 1xn nparray of the tgt joints, the buffered values are used if None
+        :param base_pos: the buffered base pose is used if None
+        :param base_rotmat:
+        :param toggle_full: see update
+        :return:
+        """
+        if base_pos is not None:
+            self.base_homomat[:3, 3] = base_pos
+        if base_rotmat is not None:
+            self.base_homomat[:3, :3] = base_rotmat
+        if tgt_jnt_values is not None:
+            self.motion_vals[self._tgt_index] = tgt_jnt_values
+        self.update(toggle_full=toggle_full)
+
+    def fk_batch(self, tgt_jnt_values_array, base_homomat=None):
+        """
+        forward kinematics of a stack of configurations in one pass, the buffers are not changed
+        the joints that are not in tgtjnts keep their buffered motion values
+        :param tgt_jnt_values_array: Nxn nparray of the tgt joints
+        :param base_homomat: 4x4 nparray, the buffered base pose is used if None
+        :return: Nxnjntsx4x4 nparray, the gl_homomatqs of all joints
+        """
+        tgt_jnt_values_array = np.asarray(tgt_jnt_values_array, dtype=float).reshape(-1, self.tgtjnts.size)
+        nconf = tgt_jnt_values_array.shape[0]
+        if base_homomat is None:
+            base_homomat = self.base_homomat
+        motion_vals = np.tile(self.motion_vals, (nconf, 1))
+        motion_vals[:, self._tgt_index] = tgt_jnt_values_array
+        loc_homomatqs = np.tile(self.loc_homomats, (nconf, 1, 1, 1))
+        if self.rev_ids.size > 0:
+            angles = motion_vals[:, self._rev_index, None, None]
+            loc_homomatqs[:, self._rev_index, :3, :3] = self._rev_const + np.cos(angles) * self._rev_cos + np.sin(
+                angles) * self._rev_sin
+        if self.pris_ids.size > 0:
+            translations = self.loc_motionaxes[self._pris_index] * motion_vals[:, self._pris_index, None]
+            loc_homomatqs[:, self._pris_index, :3, 3] += np.einsum('ijk,nik->nij',
+                                                                   self.loc_homomats[self._pris_index, :3, :3],
+                                                                   translations)
+        gl_homomatqs = np.empty_like(loc_homomatqs)
+        for id, pid in self._traversal:
+            if pid == -1:
+                np.matmul(base_homomat, loc_homomatqs[:, id], out=gl_homomatqs[:, id])
+            else:
+                np.matmul(gl_homomatqs[:, pid], loc_homomatqs[:, id], out=gl_homomatqs[:, id])
+        return gl_homomatqs
+
+    def get_lnk_motion_bounds(self, tgt_jnt_values_from, tgt_jnt_values_to, lnk_radii):
+        """
+        upper bounds of the distances travelled by the points of the links when the tgt joints move linearly,
+        a point at distance r from a revolute joint moves at most |dq|*r, a prismatic joint moves the points
+        downstream by at most |dq|*|motionax|; the base is fixed and the other joints keep their buffered values
+        :param tgt_jnt_values_from: 1xn nparray of the tgt joints
+        :param tgt_jnt_values_to: 1xn nparray of the tgt joints
+        :param lnk_radii: 1xnlnks nparray, bounds of the distances from the points of each link to its joint
+        :return: 1xnlnks nparray
+        """
+        motion_vals_from = self.motion_vals.copy()
+        motion_vals_from[self._tgt_index] = tgt_jnt_values_from
+        motion_vals_to = self.motion_vals.copy()
+        motion_vals_to[self._tgt_index] = tgt_jnt_values_to
+        deltas = np.abs(motion_vals_to - motion_vals_from)
+        axlens = np.linalg.norm(self.loc_motionaxes, axis=1)
+        # distances between the joints and their parents, prismatic joints add their largest extension
+        offsets = np.linalg.norm(self.loc_homomats[:, :3, 3], axis=1)
+        offsets[self.pris_ids] += np.maximum(np.abs(motion_vals_from[self.pris_ids]),
+                                             np.abs(motion_vals_to[self.pris_ids])) * axlens[self.pris_ids]
+        lnk_motion_bounds = np.zeros(self.nlnks)
+        for lnk_id in range(self.nlnks):
+            distance = lnk_radii[lnk_id]
+            id = lnk_id
+            while id != -1:
+                if self.jnt_types[id] == JNT_REVOLUTE:
+                    lnk_motion_bounds[lnk_id] += deltas[id] * distance
+                elif self.jnt_types[id] == JNT_PRISMATIC:
+                    lnk_motion_bounds[lnk_id] += deltas[id] * axlens[id]
+                distance += offsets[id]
+                id = self.parent_ids[id]
+        return lnk_motion_bounds
+
+    def get_gl_tcp_batch(self, gl_homomatqs, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        :param gl_homomatqs: Nxnjntsx4x4 nparray returned by fk_batch
+        :param tcp_jnt_id: a single joint id
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :return: Nx4x4 nparray
+        """
+        tcp_loc_homomat = np.eye(4)
+        tcp_loc_homomat[:3, :3] = tcp_loc_rotmat
+        tcp_loc_homomat[:3, 3] = tcp_loc_pos
+        return np.matmul(gl_homomatqs[:, tcp_jnt_id], tcp_loc_homomat)
+
+    def get_lnk_gl_batch(self, gl_homomatqs):
+        """
+        :param gl_homomatqs: Nxnjntsx4x4 nparray returned by fk_batch
+        :return: Nxnlnksx4x4 nparray, the global poses of the links
+        """
+        return np.matmul(gl_homomatqs[:, :self.nlnks], self.lnk_loc_homomats)
+
+    def get_gl_tcp(self, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        :param tcp_jnt_id: a single joint id
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :return: tcp_gl_pos, tcp_gl_rotmat
+        """
+        gl_rotmatq = self.gl_homomatqs[tcp_jnt_id, :3, :3]
+        tcp_gl_pos = gl_rotmatq.dot(tcp_loc_pos) + self.gl_homomatqs[tcp_jnt_id, :3, 3]
+        tcp_gl_rotmat = gl_rotmatq.dot(tcp_loc_rotmat)
+        return tcp_gl_pos, tcp_gl_rotmat
+
+    def jacobian(self, tcp_jnt_id, tcp_gl_pos, out=None):
+        """
+        the jacobian of a single tcp_jnt_id using the buffered frames
+        :param tcp_jnt_id: a single joint id
+        :param tcp_gl_pos: 1x3 nparray
+        :param out: 6xn nparray, optional
+        :return: 6xn nparray
+        """
+        if out is None:
+            out = np.empty((6, self.tgtjnts.size))
+        gl_motionaxes = self.gl_motionaxes[self._tgt_index]
+        diffqs = tcp_gl_pos - self.gl_homomatqs[self._tgt_index, :3, 3]
+        # cross(gl_motionaxes, diffqs) for revolute joints, gl_motionaxes for prismatic joints
+        out[:3] = ((gl_motionaxes[:, _YZX] * diffqs[:, _ZXY] - gl_motionaxes[:, _ZXY] * diffqs[:, _YZX]) *
+                   self._tgt_rev_wts + gl_motionaxes * self._tgt_pris_wts).T
+        out[3:6] = (gl_motionaxes * self._tgt_rev_wts).T
+        # joints after tcp_jnt_id do not move the tcp
+        tcp_counter = self._tgt_counters.get(tcp_jnt_id)
+        if tcp_counter is not None:
+            out[:, tcp_counter + 1:] = 0
+        return out
+
+    def jacobian_batch(self, gl_homomatqs, tcp_jnt_id, tcp_gl_poss):
+        """
+        the jacobians of a single tcp_jnt_id using the frames returned by fk_batch
+        :param gl_homomatqs: Nxnjntsx4x4 nparray
+        :param tcp_jnt_id: a single joint id
+        :param tcp_gl_poss: Nx3 nparray
+        :return: Nx6xn nparray
+        """
+        tgt_homomatqs = gl_homomatqs[:, self._tgt_index]
+        # the motion axes are invariant to the motions of their own joints
+        gl_motionaxes = np.einsum('nijk,ik->nij', tgt_homomatqs[:, :, :3, :3], self.loc_motionaxes[self._tgt_index])
+        diffqs = tcp_gl_poss[:, None, :] - tgt_homomatqs[:, :, :3, 3]
+        j = np.empty((gl_homomatqs.shape[0], 6, self.tgtjnts.size))
+        j[:, :3, :] = ((gl_motionaxes[..., _YZX] * diffqs[..., _ZXY] - gl_motionaxes[..., _ZXY] * diffqs[..., _YZX]) *
+                       self._tgt_rev_wts + gl_motionaxes * self._tgt_pris_wts).transpose(0, 2, 1)
+        j[:, 3:6, :] = (gl_motionaxes * self._tgt_rev_wts).transpose(0, 2, 1)
+        tcp_counter = self._tgt_counters.get(tcp_jnt_id)
+        if tcp_counter is not None:
+            j[:, :, tcp_counter + 1:] = 0
+        return j
+
+    def sync_to(self, jnts, lnks):
+        """
+        refresh the 'gl_xxx' values of the joint and link dictionaries using the buffers
+        new arrays are assigned so that previously returned values are not changed
+        only the joints and links changed since the last call are refreshed, call it after a full update and
+        always with the same dictionaries
+        :param jnts: jlchain.jnts
+        :param lnks: jlchain.lnks
+        :return:
+        """
+        start = self._unsynced_from
+        self._unsynced_from = self.order.size
+        gl_pos0s = self.gl_homomat0s[start:, :3, 3].copy()
+        gl_rotmat0s = self.gl_homomat0s[start:, :3, :3].copy()
+        gl_posqs = self.gl_homomatqs[start:, :3, 3].copy()
+        gl_rotmatqs = self.gl_homomatqs[start:, :3, :3].copy()
+        gl_motionaxes = self.gl_motionaxes[start:].copy()
+        for jnt, gl_pos0, gl_rotmat0, gl_motionax, gl_posq, gl_rotmatq in zip(jnts[start:], gl_pos0s, gl_rotmat0s,
+                                                                              gl_motionaxes, gl_posqs, gl_rotmatqs):
+            jnt['gl_pos0'] = gl_pos0
+            jnt['gl_rotmat0'] = gl_rotmat0
+            jnt['gl_motionax'] = gl_motionax
+            jnt['gl_posq'] = gl_posq
+            jnt['gl_rotmatq'] = gl_rotmatq
+        for lnk, gl_pos, gl_rotmat in zip(lnks[start:], self.lnk_gl_homomats[start:, :3, 3].copy(),
+                                          self.lnk_gl_homomats[start:, :3, :3].copy()):
+            lnk['gl_pos'] = gl_pos
+            lnk['gl_rotmat'] = gl_rotmat
@@ -4,17 +4,345 @@ import basis.robot_math as rm
 import warnings as wns
 
 
-class JLChainIK(object):
+class NumIKSolver(object):
+    """
+    Numerical ik core working on an internal copy of a JLChainFK
+    The iterations only change the buffers of the copy, the jlchain and its joint dictionaries are not touched.
+    Work arrays are allocated once per call of solve; the weight matrices of the WLN method are replaced by
+    elementwise scaling and the damped system is solved instead of inverted.
+    The object only contains nparrays and could be pickled. Several solvers could be created from the same
+    JLChainFK since the compiled arrays are shared and read only.
+    """
 
-    def __init__(self, jlc_object, wln_ratio=.05):
-        self.jlc_object = jlc_object
+    def __init__(self, fkt, wln_ratio=.05):
+        """
+        :param fkt: an instance of robot_sim._kinematics.jlchain_fk.JLChainFK
+        :param wln_ratio:
+        """
+        self.fkt = fkt.copy()
         self.wln_ratio = wln_ratio
+        # the result of the last call of solve
+        self.is_converged = False
         # IK macros
         wt_pos = 0.628  # 0.628m->1 == 0.01->0.00628m
         wt_agl = 1 / (math.pi * math.pi)  # pi->1 == 0.01->0.18degree
-        self.ws_wtlist = [wt_pos, wt_pos, wt_pos, wt_agl, wt_agl, wt_agl]
+        self.ws_wts = np.array([wt_pos, wt_pos, wt_pos, wt_agl, wt_agl, wt_agl])
         # maximum reach
         self.max_rng = 20.0
+        self.jmvmin = self.fkt.tgt_rngs[:, 0].copy()
+        self.jmvmax = self.fkt.tgt_rngs[:, 1].copy()
+        self.jmvrng = self.jmvmax - self.jmvmin
+        self.jmvmiddle = (self.jmvmax + self.jmvmin) / 2
+        # 1/(jmvmin_threshhold-jmvmin), the width of the damping intervals could be 0 for fixed ranges
+        wln_widths = self.jmvrng * self.wln_ratio
+        self._wln_scales = np.full_like(wln_widths, 1e12)
+        np.divide(1.0, wln_widths, out=self._wln_scales, where=wln_widths > 0)
+
+    @property
+    def ndof(self):
+        return self.fkt.tgtjnts.size
+
+    def set_base(self, pos, rotmat):
+        self.fkt.set_base(pos, rotmat)
+
+    def rand_conf(self):
+        return np.random.uniform(self.jmvmin, self.jmvmax)
+
+    def wln_weights(self, jnt_values, out=None):
+        """
+        the diagonal of the wln weightmat
+        :param jnt_values: 1xn nparray
+        :param out: 1xn nparray, optional
+        :return:
+        """
+        normalized_diff = np.minimum(jnt_values - self.jmvmin, self.jmvmax - jnt_values, out=out)
+        normalized_diff *= self._wln_scales
+        np.clip(normalized_diff, 0, 1, out=normalized_diff)
+        # -2x^3+3x^2
+        normalized_diff *= normalized_diff * (3 - 2 * normalized_diff)
+        return normalized_diff
+
+    def _prepare_tcp(self, tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        convert the goals and the tcp parameters into lists, the list of tcp_xxx is trimmed to the goals
+        :return: [[tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat], ...]
+        """
+        if isinstance(tgt_pos, list):
+            return list(zip(tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat))
+        elif isinstance(tcp_jnt_id, list):
+            return [(tgt_pos, tgt_rotmat, tcp_jnt_id[0], tcp_loc_pos[0], tcp_loc_rotmat[0])]
+        else:
+            return [(tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)]
+
+    def _update_err_jacobian(self, tcps, err, j):
+        """
+        compute the tcp error and the jacobian at the buffered frames
+        :param tcps: returned by _prepare_tcp
+        :param err: 1x(6*len(tcps)) nparray, updated in place
+        :param j: (6*len(tcps))xn nparray, updated in place
+        :return:
+        """
+        for i, (tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat) in enumerate(tcps):
+            tcp_gl_pos, tcp_gl_rotmat = self.fkt.get_gl_tcp(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+            err[6 * i:6 * i + 3] = tgt_pos - tcp_gl_pos
+            err[6 * i + 3:6 * i + 6] = rm.deltaw_between_rotmat(tcp_gl_rotmat, tgt_rotmat)
+            self.fkt.jacobian(tcp_jnt_id, tcp_gl_pos, out=j[6 * i:6 * i + 6])
+
+    def solve(self,
+              tgt_pos,
+              tgt_rotmat,
+              seed_jnt_values,
+              tcp_jnt_id,
+              tcp_loc_pos,
+              tcp_loc_rotmat,
+              max_niter=100,
+              local_minima="randomrestart",
+              toggle_debug=False):
+        """
+        solveik numerically using the Levenberg-Marquardt Method, see JLChainIK.num_ik for the details
+        NOTE: if list, len(tgt_pos)=len(tgt_rotmat) <= len(tcp_jnt_id)=len(tcp_loc_pos)=len(tcp_loc_rotmat)
+        :param tgt_pos: the position of the goal, 1-by-3 numpy ndarray, single value or list
+        :param tgt_rotmat: the orientation of the goal, 3-by-3 numpyndarray, single value or list
+        :param seed_jnt_values: the starting configuration used in the numerical iteration
+        :param tcp_jnt_id: a joint ID in the self.tgtjnts, single value or list
+        :param tcp_loc_pos: 1x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id], single value or list
+        :param tcp_loc_rotmat: 3x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id], single value or list
+        :param max_niter: max number of numercial iternations
+        :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+        :return: a 1xn numpy ndarray, None if failed
+        """
+        self.is_converged = False
+        deltapos = np.asarray(tgt_pos) - self.fkt.base_homomat[:3, 3]
+        if np.linalg.norm(deltapos) > self.max_rng:
+            print("The goal is outside maximum range!")
+            return None
+        tcps = self._prepare_tcp(tgt_pos, tgt_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+        # work buffers
+        nrows = 6 * len(tcps)
+        ws_wts = np.tile(self.ws_wts, len(tcps))
+        err = np.zeros(nrows)
+        j = np.zeros((nrows, self.ndof))
+        rhs = np.empty((2, nrows))
+        wts = np.empty(self.ndof)
+        jnt_values_iter = np.array(seed_jnt_values, dtype=float)
+        jnt_values_ref = jnt_values_iter.copy()
+        self.fkt.fk(jnt_values_iter, toggle_full=False)
+        if toggle_debug:
+            dqbefore = []
+            dqcorrected = []
+            dqnull = []
+            ajpath = []
+        random_restart = False
+        errnormlast = 0.0
+        for i in range(max_niter):
+            self._update_err_jacobian(tcps, err, j)
+            errnorm = err.dot(ws_wts * err)
+            if toggle_debug:
+                print(errnorm)
+                ajpath.append(jnt_values_iter.copy())
+            if errnorm < 1e-9:
+                if toggle_debug:
+                    print(f"Number of IK iterations before finding a result: {i}")
+                    self._plot_debug(dqbefore, dqnull, dqcorrected, ajpath)
+                self.is_converged = True
+                return jnt_values_iter
+            # judge local minima
+            if abs(errnorm - errnormlast) < 1e-12:
+                if toggle_debug:
+                    self._plot_debug(dqbefore, dqnull, dqcorrected, ajpath)
+                if local_minima == 'accept':
+                    print('Bypassing local minima! The return value is a local minima, not an exact IK result.')
+                    return jnt_values_iter
+                elif local_minima == 'randomrestart':
+                    print('Local Minima! Random restart at local minima!')
+                    jnt_values_iter = self.rand_conf()
+                    self.fkt.fk(jnt_values_iter, toggle_full=False)
+                    random_restart = True
+                    continue
+                else:
+                    print('No feasible IK solution!')
+                    break
+            # -- notes --
+            ## note1: do not use np.linalg.inv since it is not precise
+            ## note2: use np.linalg.solve if the system is exactly determined, it is faster
+            ## note3: use np.linalg.lstsq if there might be singularity (no regularization)
+            ## see https://stackoverflow.com/questions/34170618/normal-equation-and-numpy-least-squares-solve-methods-difference-in-regress
+            ## note4: null space https://www.slideserve.com/marietta/kinematic-redundancy
+            ## note5: avoid joint limits; Paper Name: Clamping weighted least-norm method for the manipulator kinematic control: Avoiding joint limits
+            ## note6: constant damper; Sugihara Paper: https://www.mi.ams.eng.osaka-u.ac.jp/member/sugihara/pub/jrsj_ik.pdf
+            # strecthingcoeff = 1 / (1 + math.exp(1 / ((errnorm / self.max_rng) * 1000 + 1)))
+            # strecthingcoeff = -2*math.pow(errnorm / errnormmax, 3)+3*math.pow(errnorm / errnormmax, 2)
+            # print("stretching ", strecthingcoeff)
+            # dampercoeff = (strecthingcoeff + .1) * 1e-6  # a non-zero regulation coefficient
+            # WLN with a constant damper
+            # jsharp = W.J^T.(J.W.J^T+damper)^-1 with W=diag(wts)
+            dampercoeff = 1e-3 * errnorm + 1e-6  # a non-zero regulation coefficient
+            self.wln_weights(jnt_values_iter, out=wts)
+            w_jt = j.T * wts[:, None]
+            j_w_jt = j.dot(w_jt)
+            j_w_jt.flat[::nrows + 1] += dampercoeff
+            # Clamping (Paper Name: Clamping weighted least-norm method for the manipulator kinematic control)
+            phi_q = (2 * jnt_values_iter - self.jmvmiddle) / self.jmvrng
+            clamping = (wts - 1) * phi_q
+            w_init = 0 if random_restart else 0.1
+            w_middle = 1
+            dqref = w_init * (jnt_values_ref - jnt_values_iter) + w_middle * clamping
+            # dq = .1*jsharp.err, dqref_on_ns = (I-jsharp.J).dqref, both share (J.W.J^T+damper)^-1
+            rhs[0] = err
+            np.dot(j, dqref, out=rhs[1])
+            x = np.linalg.solve(j_w_jt, rhs.T)
+            if toggle_debug:
+                dq = .1 * w_jt.dot(x[:, 0])
+                dqref_on_ns = dqref - w_jt.dot(x[:, 1])
+                dqbefore.append(dq)
+                dqcorrected.append(dq + dqref_on_ns)
+                dqnull.append(dqref_on_ns)
+            jnt_values_iter += w_jt.dot(.1 * x[:, 0] - x[:, 1])
+            jnt_values_iter += dqref
+            self.fkt.fk(jnt_values_iter, toggle_full=False)
+            errnormlast = errnorm
+        if toggle_debug:
+            self._plot_debug(dqbefore, dqnull, dqcorrected, ajpath)
+        print('Failed to solve the IK, returning None.')
+        return None
+
+    def solve_batch(self,
+                    tgt_poss,
+                    tgt_rotmats,
+                    seed_jnt_values,
+                    tcp_jnt_id,
+                    tcp_loc_pos,
+                    tcp_loc_rotmat,
+                    max_niter=100,
+                    local_minima="randomrestart"):
+        """
+        solve many ik problems together, the iterations of solve are carried out as stacked array operations
+        each target could have several seeds, a target is retired once one of its seeds converges
+        only a single tcp_jnt_id is acceptable
+        :param tgt_poss: Mx3 nparray
+        :param tgt_rotmats: Mx3x3 nparray
+        :param seed_jnt_values: MxKxn nparray, K seeds for each target
+        :param tcp_jnt_id: a single joint id
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :param max_niter: max number of numercial iternations
+        :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+                             the accepted local minima are returned only if none of the seeds converged
+        :return: jnt_values (Mxn nparray, nan for failures), is_converged (1xM bool nparray), niters (1xM nparray)
+        """
+        tgt_poss = np.asarray(tgt_poss, dtype=float).reshape(-1, 3)
+        tgt_rotmats = np.asarray(tgt_rotmats, dtype=float).reshape(-1, 3, 3)
+        nseeds = seed_jnt_values.shape[1]
+        ntgts = tgt_poss.shape[0]
+        jnt_values_iter = np.array(seed_jnt_values, dtype=float).reshape(-1, self.ndof)
+        jnt_values_ref = jnt_values_iter.copy()
+        # per problem (a pair of target and seed)
+        tgt_ids = np.repeat(np.arange(ntgts), nseeds)
+        w_inits = np.full(tgt_ids.size, .1)
+        errnormlasts = np.zeros(tgt_ids.size)
+        niters_per_problem = np.zeros(tgt_ids.size, dtype=int)
+        is_retired = np.zeros(tgt_ids.size, dtype=bool)
+        # per target
+        jnt_values = np.full((ntgts, self.ndof), np.nan)
+        is_converged = np.zeros(ntgts, dtype=bool)
+        niters = np.zeros(ntgts, dtype=int)
+        is_accepted = np.zeros(ntgts, dtype=bool)
+        is_out_of_rng = np.linalg.norm(tgt_poss - self.fkt.base_homomat[:3, 3], axis=1) > self.max_rng
+        is_retired[is_out_of_rng[tgt_ids]] = True
+        active_ids = np.flatnonzero(~is_retired)
+        nrows_range = np.arange(6)
+        for i in range(max_niter):
+            if active_ids.size == 0:
+                break
+            niters_per_problem[active_ids] += 1
+            active_tgt_ids = tgt_ids[active_ids]
+            q = jnt_values_iter[active_ids]
+            gl_homomats = self.fkt.fk_batch(q)
+            tcp_homomats = self.fkt.get_gl_tcp_batch(gl_homomats, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+            err = np.empty((active_ids.size, 6))
+            err[:, :3] = tgt_poss[active_tgt_ids] - tcp_homomats[:, :3, 3]
+            err[:, 3:] = rm.deltaw_between_rotmats(tcp_homomats[:, :3, :3], tgt_rotmats[active_tgt_ids])
+            j = self.fkt.jacobian_batch(gl_homomats, tcp_jnt_id, tcp_homomats[:, :3, 3])
+            errnorms = (err * err).dot(self.ws_wts)
+            selection_converged = errnorms < 1e-9
+            if selection_converged.any():
+                converged_tgt_ids, first = np.unique(active_tgt_ids[selection_converged], return_index=True)
+                jnt_values[converged_tgt_ids] = q[selection_converged][first]
+                is_converged[converged_tgt_ids] = True
+                niters[converged_tgt_ids] = i
+            # judge local minima
+            selection_stalled = np.logical_and(~selection_converged, np.abs(errnorms - errnormlasts[active_ids]) < 1e-12)
+            if selection_stalled.any():
+                stalled_ids = active_ids[selection_stalled]
+                if local_minima == 'randomrestart':
+                    jnt_values_iter[stalled_ids] = np.random.uniform(self.jmvmin, self.jmvmax,
+                                                                     (stalled_ids.size, self.ndof))
+                    w_inits[stalled_ids] = 0
+                else:
+                    is_retired[stalled_ids] = True
+                    if local_minima == 'accept':
+                        accepted_tgt_ids, first = np.unique(tgt_ids[stalled_ids], return_index=True)
+                        selection = ~is_accepted[accepted_tgt_ids]
+                        is_accepted[accepted_tgt_ids[selection]] = True
+                        jnt_values[accepted_tgt_ids[selection]] = q[selection_stalled][first[selection]]
+            # WLN with a constant damper, see solve
+            selection = np.logical_and(~selection_converged, ~selection_stalled)
+            moving_ids = active_ids[selection]
+            if moving_ids.size > 0:
+                q = q[selection]
+                j = j[selection]
+                err = err[selection]
+                errnorms = errnorms[selection]
+                wts = self.wln_weights(q)
+                w_jt = j.transpose(0, 2, 1) * wts[:, :, None]
+                j_w_jt = np.matmul(j, w_jt)
+                j_w_jt[:, nrows_range, nrows_range] += (1e-3 * errnorms + 1e-6)[:, None]
+                clamping = (wts - 1) * (2 * q - self.jmvmiddle) / self.jmvrng
+                dqref = w_inits[moving_ids, None] * (jnt_values_ref[moving_ids] - q) + clamping
+                rhs = np.stack((err, np.einsum('ijk,ik->ij', j, dqref)), axis=2)
+                x = np.linalg.solve(j_w_jt, rhs)
+                jnt_values_iter[moving_ids] = q + np.einsum('ijk,ik->ij', w_jt, .1 * x[:, :, 0] - x[:, :, 1]) + dqref
+                errnormlasts[moving_ids] = errnorms
+            active_ids = active_ids[np.logical_and(~is_retired[active_ids], ~is_converged[tgt_ids[active_ids]])]
+        selection = ~is_converged
+        niters[selection] = niters_per_problem.reshape(ntgts, nseeds).max(axis=1)[selection]
+        jnt_values[np.logical_and(selection, ~is_accepted)] = np.nan
+        return jnt_values, is_converged, niters
+
+    @staticmethod
+    def _plot_debug(dqbefore, dqnull, dqcorrected, ajpath):
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+        axbefore = fig.add_subplot(411)
+        axbefore.set_title('Original dq')
+        axnull = fig.add_subplot(412)
+        axnull.set_title('dqref on Null space')
+        axcorrec = fig.add_subplot(413)
+        axcorrec.set_title('Minimized dq')
+        axaj = fig.add_subplot(414)
+        axbefore.plot(dqbefore)
+        axnull.plot(dqnull)
+        axcorrec.plot(dqcorrected)
+        axaj.plot(ajpath)
+        plt.show()
+
+
+
+class JLChainIK(object):
+
+    def __init__(self, jlc_object, wln_ratio=.05):
+        self.jlc_object = jlc_object
+        self.wln_ratio = wln_ratio
+        self._solver = NumIKSolver(jlc_object._fkt, wln_ratio=wln_ratio)
+        # an optional IKSeedCache, see robot_sim._kinematics.jlchain_ik_cache
+        self.seed_cache = None
+        # an optional ReachabilityMap, see robot_sim._kinematics.jlchain_reachability
+        self.reachability_map = None
+        # goals outside the map are rejected only if toggled, a cell needs min_count samples to be reachable
+        self.reachability_toggle_reject = False
+        self.reachability_min_count = 1
+        # IK macros
+        self.ws_wtlist = self._solver.ws_wts.tolist()
         # # extract min max for quick access
         self.jmvmin = self.jlc_object.jnt_ranges[:, 0]
         self.jmvmax = self.jlc_object.jnt_ranges[:, 1]
@@ -23,6 +351,20 @@ class JLChainIK(object):
         self.jmvmin_threshhold = self.jmvmin + self.jmvrng * self.wln_ratio
         self.jmvmax_threshhold = self.jmvmax - self.jmvrng * self.wln_ratio
 
+    @property
+    def max_rng(self):
+        # maximum reach
+        return self._solver.max_rng
+
+    @max_rng.setter
+    def max_rng(self, value):
+        self._solver.max_rng = value
+
+    def _sync_solver(self):
+        # the joints out of tgtjnts and the base of the solver follow the jlchain
+        self._solver.fkt.motion_vals[:] = self.jlc_object._fkt.motion_vals
+        self._solver.fkt.base_homomat[:] = self.jlc_object._fkt.base_homomat
+
     def _jacobian_sgl(self, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
         """
         compute the jacobian matrix of a rjlinstance
@@ -35,41 +377,7 @@ class JLChainIK(object):
         date: 20161202, 20200331, 20200706
         """
         tcp_gl_pos, tcp_gl_rotmat = self.get_gl_tcp(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
-        j = np.zeros((6, len(self.jlc_object.tgtjnts)))
-        counter = 0
-        for jid in self.jlc_object.tgtjnts:
-            grax = self.jlc_object.jnts[jid]["gl_motionax"]
-            if self.jlc_object.jnts[jid]["type"] == 'revolute':
-                diffq = tcp_gl_pos - self.jlc_object.jnts[jid]["gl_posq"]
-                j[:3, counter] = np.cross(grax, diffq)
-                j[3:6, counter] = grax
-            if self.jlc_object.jnts[jid]["type"] == 'prismatic':
-                j[:3, counter] = grax
-            counter += 1
-            if jid == tcp_jnt_id:
-                break
-        return j
-
-    def _wln_weightmat(self, jntvalues):
-        """
-        get the wln weightmat
-        :param jntvalues:
-        :return:
-        author: weiwei
-        date: 20201126
-        """
-        wtmat = np.ones(len(self.jlc_object.tgtjnts))
-        # min damping interval
-        selection = jntvalues < self.jmvmin_threshhold
-        normalized_diff_at_selected = ((jntvalues - self.jmvmin) / (self.jmvmin_threshhold - self.jmvmin))[selection]
-        wtmat[selection] = -2 * np.power(normalized_diff_at_selected, 3) + 3 * np.power(normalized_diff_at_selected, 2)
-        # max damping interval
-        selection = jntvalues > self.jmvmax_threshhold
-        normalized_diff_at_selected = ((self.jmvmax - jntvalues) / (self.jmvmax - self.jmvmax_threshhold))[selection]
-        wtmat[selection] = -2 * np.power(normalized_diff_at_selected, 3) + 3 * np.power(normalized_diff_at_selected, 2)
-        wtmat[jntvalues >= self.jmvmax] = 0
-        wtmat[jntvalues <= self.jmvmin] = 0
-        return np.diag(wtmat)
+        return self.jlc_object._fkt.jacobian(tcp_jnt_id, tcp_gl_pos)
 
     def jacobian(self, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
         """
@@ -106,6 +414,40 @@ class JLChainIK(object):
                           tcp_loc_rotmat)
         return math.sqrt(np.linalg.det(np.dot(j, j.transpose())))
 
+    def jacobian_batch(self, jnt_values_array, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        compute the jacobian matrices of many configurations using the batched fk frames
+        multiple tcp_jnt_id acceptable
+        :param jnt_values_array: Nxn nparray
+        :param tcp_jnt_id: the joint id where the tool center pose is specified, single vlaue or list
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :return: Nx6xn nparray, or Nx(6*len(tcp_jnt_id))xn nparray if list
+        """
+        fkt = self.jlc_object._fkt
+        gl_homomats = fkt.fk_batch(jnt_values_array,
+                                   base_homomat=rm.homomat_from_posrot(self.jlc_object.pos, self.jlc_object.rotmat))
+        if isinstance(tcp_jnt_id, list):
+            j = np.zeros((gl_homomats.shape[0], 6 * len(tcp_jnt_id), len(self.jlc_object.tgtjnts)))
+            for i, this_tcp_jnt_id in enumerate(tcp_jnt_id):
+                tcp_homomats = fkt.get_gl_tcp_batch(gl_homomats, this_tcp_jnt_id, tcp_loc_pos[i], tcp_loc_rotmat[i])
+                j[:, 6 * i:6 * i + 6, :] = fkt.jacobian_batch(gl_homomats, this_tcp_jnt_id, tcp_homomats[:, :3, 3])
+            return j
+        else:
+            tcp_homomats = fkt.get_gl_tcp_batch(gl_homomats, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+            return fkt.jacobian_batch(gl_homomats, tcp_jnt_id, tcp_homomats[:, :3, 3])
+
+    def manipulability_batch(self, jnt_values_array, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        compute the yoshikawa manipulability of many configurations
+        :param jnt_values_array: Nxn nparray
+        :param tcp_jnt_id: the joint id where the tool center pose is specified, single vlaue or list
+        :return: 1xN nparray
+        """
+        j = self.jacobian_batch(jnt_values_array, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+        # tiny negative determinants may appear at singular configurations
+        return np.sqrt(np.maximum(np.linalg.det(np.matmul(j, j.transpose(0, 2, 1))), 0))
+
     def manipulability_axmat(self,
                              tcp_jnt_id,
                              tcp_loc_pos,
@@ -150,21 +492,17 @@ class JLChainIK(object):
             tcp_loc_pos = self.jlc_object.tcp_loc_pos
         if tcp_loc_rotmat is None:
             tcp_loc_rotmat = self.jlc_object.tcp_loc_rotmat
+        fkt = self.jlc_object._fkt
         if isinstance(tcp_jnt_id, list):
             returnposlist = []
             returnrotmatlist = []
             for i, jid in enumerate(tcp_jnt_id):
-                tcp_gl_pos = np.dot(self.jlc_object.jnts[jid]["gl_rotmatq"], tcp_loc_pos[i]) + \
-                             self.jlc_object.jnts[jid]["gl_posq"]
-                tcp_gl_rotmat = np.dot(self.jlc_object.jnts[jid]["gl_rotmatq"], tcp_loc_rotmat[i])
+                tcp_gl_pos, tcp_gl_rotmat = fkt.get_gl_tcp(jid, tcp_loc_pos[i], tcp_loc_rotmat[i])
                 returnposlist.append(tcp_gl_pos)
                 returnrotmatlist.append(tcp_gl_rotmat)
             return [returnposlist, returnrotmatlist]
         else:
-            tcp_gl_pos = np.dot(self.jlc_object.jnts[tcp_jnt_id]["gl_rotmatq"], tcp_loc_pos) + \
-                         self.jlc_object.jnts[tcp_jnt_id]["gl_posq"]
-            tcp_gl_rotmat = np.dot(self.jlc_object.jnts[tcp_jnt_id]["gl_rotmatq"], tcp_loc_rotmat)
-            return tcp_gl_pos, tcp_gl_rotmat
+            return fkt.get_gl_tcp(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
 
     def tcp_error(self, tgt_pos, tgt_rot, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
         """
@@ -266,10 +604,17 @@ class JLChainIK(object):
                tcp_loc_pos=None,
                tcp_loc_rotmat=None,
                local_minima="randomrestart",
+               toggle_fk=False,
                toggle_debug=False):
         """
         solveik numerically using the Levenberg-Marquardt Method
         the details of this method can be found in: https://www.math.ucsd.edu/~sbuss/ResearchWeb/ikmethods/iksurvey.pdf
+        the iterations are carried out by NumIKSolver, the jlchain is not changed unless toggle_fk is True
+        if self.seed_cache is set and compatible with the tcp, it provides the seed when seed_jnt_values is None and
+        stores the converged results
+        if self.reachability_map is set and compatible with the tcp, the representative of the goal's cell is used
+        as the seed when no other seed is available; goals outside the map are rejected directly only if
+        self.reachability_toggle_reject is True, the map is sampling based and may miss reachable goals
         NOTE: if list, len(tgt_pos)=len(tgt_rotmat) <= len(tcp_jnt_id)=len(tcp_loc_pos)=len(tcp_loc_rotmat)
         :param tgt_pos: the position of the goal, 1-by-3 numpy ndarray
         :param tgt_rot: the orientation of the goal, 3-by-3 numpyndarray
@@ -279,193 +624,96 @@ class JLChainIK(object):
         :param tcp_loc_pos: 1x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id], single value or list
         :param tcp_loc_rotmat: 3x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id], single value or list
         :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+        :param toggle_fk: move the jlchain to the result if True
         :return: a 1xn numpy ndarray
         author: weiwei
         date: 20180203, 20200328
         """
-        deltapos = tgt_pos - self.jlc_object.jnts[0]['gl_pos0']
-        if np.linalg.norm(deltapos) > self.max_rng:
-            print("The goal is outside maximum range!")
-            return None
         if tcp_jnt_id is None:
             tcp_jnt_id = self.jlc_object.tcp_jnt_id
         if tcp_loc_pos is None:
             tcp_loc_pos = self.jlc_object.tcp_loc_pos
         if tcp_loc_rotmat is None:
             tcp_loc_rotmat = self.jlc_object.tcp_loc_rotmat
-        # trim list
-        if isinstance(tgt_pos, list):
-            tcp_jnt_id = tcp_jnt_id[0:len(tgt_pos)]
-            tcp_loc_pos = tcp_loc_pos[0:len(tgt_pos)]
-            tcp_loc_rotmat = tcp_loc_rotmat[0:len(tgt_pos)]
-        elif isinstance(tcp_jnt_id, list):
-            tcp_jnt_id = tcp_jnt_id[0]
-            tcp_loc_pos = tcp_loc_pos[0]
-            tcp_loc_rotmat = tcp_loc_rotmat[0]
-        jnt_values_bk = self.jlc_object.get_jnt_values()
-        jnt_values_iter = self.jlc_object.homeconf if seed_jnt_values is None else seed_jnt_values.copy()
-        self.jlc_object.fk(jnt_values=jnt_values_iter)
-        jnt_values_ref = jnt_values_iter.copy()
-        if isinstance(tcp_jnt_id, list):
-            diaglist = []
-            for i in tcp_jnt_id:
-                diaglist += self.ws_wtlist
-            ws_wtdiagmat = np.diag(diaglist)
-        else:
-            ws_wtdiagmat = np.diag(self.ws_wtlist)
-        if toggle_debug:
-            if "jlm" not in dir():
-                import robot_sim._kinematics.jlchain_mesh as jlm
-            if "plt" not in dir():
-                import matplotlib.pyplot as plt
-            dqbefore = []
-            dqcorrected = []
-            dqnull = []
-            ajpath = []
-        random_restart = False
-        errnormlast = 0.0
-        errnormmax = 0.0
-        for i in range(max_niter):
-            j = self.jacobian(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
-            err = self.tcp_error(tgt_pos, tgt_rot, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
-            errnorm = err.T.dot(ws_wtdiagmat).dot(err)
-            # err = .05 / errnorm * err if errnorm > .05 else err
-            if errnorm > errnormmax:
-                errnormmax = errnorm
-            if toggle_debug:
-                print(errnorm)
-                ajpath.append(self.jlc_object.get_jnt_values())
-            if errnorm < 1e-9:
-                if toggle_debug:
-                    print(f"Number of IK iterations before finding a result: {i}")
-                    fig = plt.figure()
-                    axbefore = fig.add_subplot(411)
-                    axbefore.set_title('Original dq')
-                    axnull = fig.add_subplot(412)
-                    axnull.set_title('dqref on Null space')
-                    axcorrec = fig.add_subplot(413)
-                    axcorrec.set_title('Minimized dq')
-                    axaj = fig.add_subplot(414)
-                    axbefore.plot(dqbefore)
-                    axnull.plot(dqnull)
-                    axcorrec.plot(dqcorrected)
-                    axaj.plot(ajpath)
-                    plt.show()
-                jntvalues_return = self.jlc_object.get_jnt_values()
-                self.jlc_object.fk(jnt_values=jnt_values_bk)
-                return jntvalues_return
-            else:
-                # judge local minima
-                if abs(errnorm - errnormlast) < 1e-12:
-                    if toggle_debug:
-                        fig = plt.figure()
-                        axbefore = fig.add_subplot(411)
-                        axbefore.set_title('Original dq')
-                        axnull = fig.add_subplot(412)
-                        axnull.set_title('dqref on Null space')
-                        axcorrec = fig.add_subplot(413)
-                        axcorrec.set_title('Minimized dq')
-                        axaj = fig.add_subplot(414)
-                        axbefore.plot(dqbefore)
-                        axnull.plot(dqnull)
-                        axcorrec.plot(dqcorrected)
-                        axaj.plot(ajpath)
-                        plt.show()
-                    if local_minima == 'accept':
-                        print('Bypassing local minima! The return value is a local minima, not an exact IK result.')
-                        jntvalues_return = self.jlc_object.get_jnt_values()
-                        self.jlc_object.fk(jnt_values_bk)
-                        return jntvalues_return
-                    elif local_minima == 'randomrestart':
-                        print('Local Minima! Random restart at local minima!')
-                        jnt_values_iter = self.jlc_object.rand_conf()
-                        self.jlc_object.fk(jnt_values_iter)
-                        random_restart = True
-                        continue
-                    else:
-                        print('No feasible IK solution!')
-                        break
-                else:
-                    # -- notes --
-                    ## note1: do not use np.linalg.inv since it is not precise
-                    ## note2: use np.linalg.solve if the system is exactly determined, it is faster
-                    ## note3: use np.linalg.lstsq if there might be singularity (no regularization)
-                    ## see https://stackoverflow.com/questions/34170618/normal-equation-and-numpy-least-squares-solve-methods-difference-in-regress
-                    ## note4: null space https://www.slideserve.com/marietta/kinematic-redundancy
-                    ## note5: avoid joint limits; Paper Name: Clamping weighted least-norm method for the manipulator kinematic control: Avoiding joint limits
-                    ## note6: constant damper; Sugihara Paper: https://www.mi.ams.eng.osaka-u.ac.jp/member/sugihara/pub/jrsj_ik.pdf
-                    # strecthingcoeff = 1 / (1 + math.exp(1 / ((errnorm / self.max_rng) * 1000 + 1)))
-                    # strecthingcoeff = -2*math.pow(errnorm / errnormmax, 3)+3*math.pow(errnorm / errnormmax, 2)
-                    # print("stretching ", strecthingcoeff)
-                    # dampercoeff = (strecthingcoeff + .1) * 1e-6  # a non-zero regulation coefficient
-                    dampercoeff = 1e-3 * errnorm + 1e-6  # a non-zero regulation coefficient
-                    # -- lft moore-penrose inverse --
-                    ## jtj = armjac.T.dot(armjac)
-                    ## regulator = regcoeff*np.identity(jtj.shape[0])
-                    ## jstar = np.linalg.inv(jtj+regulator).dot(armjac.T)
-                    ## dq = jstar.dot(err)
-                    # -- rgt moore-penrose inverse --
-                    # # jjt
-                    # jjt = j.dot(j.T)
-                    # damper = dampercoeff * np.identity(jjt.shape[0])
-                    # jsharp = j.T.dot(np.linalg.inv(jjt + damper))
-                    # weighted jjt
-                    qs_wtdiagmat = self._wln_weightmat(jnt_values_iter)
-                    # WLN
-                    w_jt = qs_wtdiagmat.dot(j.T)
-                    j_w_jt = j.dot(w_jt)
-                    damper = dampercoeff * np.identity(j_w_jt.shape[0])
-                    jsharp = w_jt.dot(np.linalg.inv(j_w_jt + damper))
-                    # Clamping (Paper Name: Clamping weighted least-norm method for the manipulator kinematic control)
-                    phi_q = ((2 * jnt_values_iter - self.jmvmiddle) / self.jmvrng)
-                    clamping = -(np.identity(qs_wtdiagmat.shape[0]) - qs_wtdiagmat).dot(phi_q)
-                    # # if do not use WLN
-                    # j_jt = j.dot(j.T)
-                    # damper = dampercoeff * np.identity(j_jt.shape[0])
-                    # jsharp = j.T.dot(np.linalg.inv(j_jt + damper))
-                    # update dq
-                    dq = .1 * jsharp.dot(err)
-                    if not random_restart:
-                        w_init = 0.1
-                    else:
-                        w_init = 0
-                    w_middle = 1
-                    ns_projmat = np.identity(jnt_values_iter.size) - jsharp.dot(j)
-                    dqref_init = (jnt_values_ref - jnt_values_iter)
-                    dqref_on_ns = ns_projmat.dot(w_init * dqref_init + w_middle * clamping)
-                    dq_minimized = dq + dqref_on_ns
-                    if toggle_debug:
-                        dqbefore.append(dq)
-                        dqcorrected.append(dq_minimized)
-                        dqnull.append(dqref_on_ns)
-                jnt_values_iter += dq_minimized  # translation problem
-                # isdragged, jntvalues_iter = self.check_jntsrange_drag(jntvalues_iter)
-                # print(jnt_values_iter)
-                self.jlc_object.fk(jnt_values=jnt_values_iter)
-                # if toggle_debug:
-                #     self.jlc_object.gen_stickmodel(tcp_jnt_id=tcp_jnt_id, tcp_loc_pos=tcp_loc_pos,
-                #                                    tcp_loc_rotmat=tcp_loc_rotmat, toggle_jntscs=True).attach_to(base)
-            errnormlast = errnorm
-        if toggle_debug:
-            fig = plt.figure()
-            axbefore = fig.add_subplot(411)
-            axbefore.set_title('Original dq')
-            axnull = fig.add_subplot(412)
-            axnull.set_title('dqref on Null space')
-            axcorrec = fig.add_subplot(413)
-            axcorrec.set_title('Minimized dq')
-            axaj = fig.add_subplot(414)
-            axbefore.plot(dqbefore)
-            axnull.plot(dqnull)
-            axcorrec.plot(dqcorrected)
-            axaj.plot(ajpath)
-            plt.show()
-            self.jlc_object.gen_stickmodel(tcp_jnt_id=tcp_jnt_id, tcp_loc_pos=tcp_loc_pos,
-                                           tcp_loc_rotmat=tcp_loc_rotmat, toggle_jntscs=True).attach_to(base)
-            # base.run()
-        self.jlc_object.fk(jnt_values_bk)
-        print('Failed to solve the IK, returning None.')
-        return None
+        use_seed_cache = (self.seed_cache is not None and not isinstance(tgt_pos, list) and
+                          self.seed_cache.is_compatible(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat))
+        use_reachability_map = (self.reachability_map is not None and not isinstance(tgt_pos, list) and
+                                self.reachability_map.is_compatible(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat))
+        if use_reachability_map and self.reachability_toggle_reject:
+            if not self.reachability_map.is_reachable(tgt_pos, tgt_rot, self.jlc_object.pos, self.jlc_object.rotmat,
+                                                      min_count=self.reachability_min_count):
+                print("The goal is outside the reachability map!")
+                return None
+        if seed_jnt_values is None and use_seed_cache:
+            seed_jnt_values = self.seed_cache.lookup(tgt_pos, tgt_rot, self.jlc_object.pos, self.jlc_object.rotmat)
+        if seed_jnt_values is None and use_reachability_map:
+            seed_jnt_values = self.reachability_map.get_seed(tgt_pos, tgt_rot, self.jlc_object.pos,
+                                                             self.jlc_object.rotmat)
+        if seed_jnt_values is None:
+            seed_jnt_values = self.jlc_object.homeconf
+        self._sync_solver()
+        jnt_values = self._solver.solve(tgt_pos,
+                                        tgt_rot,
+                                        seed_jnt_values,
+                                        tcp_jnt_id,
+                                        tcp_loc_pos,
+                                        tcp_loc_rotmat,
+                                        max_niter=max_niter,
+                                        local_minima=local_minima,
+                                        toggle_debug=toggle_debug)
+        if use_seed_cache and self._solver.is_converged:
+            self.seed_cache.store(tgt_pos, tgt_rot, jnt_values, self.jlc_object.pos, self.jlc_object.rotmat,
+                                  tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+        if jnt_values is not None and toggle_fk:
+            self.jlc_object.fk(jnt_values=jnt_values)
+        return jnt_values
+
+    def num_ik_batch(self,
+                     tgt_poss,
+                     tgt_rotmats,
+                     seed_jnt_values=None,
+                     max_niter=100,
+                     tcp_jnt_id=None,
+                     tcp_loc_pos=None,
+                     tcp_loc_rotmat=None,
+                     local_minima="randomrestart"):
+        """
+        solve the ik of many targets together, see NumIKSolver.solve_batch
+        only a single tcp_jnt_id is acceptable, the jlchain is not changed
+        :param tgt_poss: Mx3 nparray
+        :param tgt_rotmats: Mx3x3 nparray
+        :param seed_jnt_values: 1xn (shared), Mxn (one for each target), or MxKxn (K for each target) nparray,
+                                self.jlc_object.homeconf is used if None
+        :param max_niter: max number of numercial iternations
+        :param tcp_jnt_id: a joint ID in the self.tgtjnts
+        :param tcp_loc_pos: 1x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id]
+        :param tcp_loc_rotmat: 3x3 nparray, decribed in the local frame of self.jnts[tcp_jnt_id]
+        :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+        :return: jnt_values (Mxn nparray, nan for failures), is_converged (1xM bool nparray), niters (1xM nparray)
+        """
+        if tcp_jnt_id is None:
+            tcp_jnt_id = self.jlc_object.tcp_jnt_id
+        if tcp_loc_pos is None:
+            tcp_loc_pos = self.jlc_object.tcp_loc_pos
+        if tcp_loc_rotmat is None:
+            tcp_loc_rotmat = self.jlc_object.tcp_loc_rotmat
+        if seed_jnt_values is None:
+            seed_jnt_values = self.jlc_object.homeconf
+        tgt_poss = np.asarray(tgt_poss, dtype=float).reshape(-1, 3)
+        ntgts = tgt_poss.shape[0]
+        ndof = len(self.jlc_object.tgtjnts)
+        seed_jnt_values = np.asarray(seed_jnt_values, dtype=float)
+        if seed_jnt_values.ndim < 3:
+            seed_jnt_values = np.broadcast_to(seed_jnt_values.reshape(-1, 1, ndof), (ntgts, 1, ndof))
+        self._sync_solver()
+        return self._solver.solve_batch(tgt_poss,
+                                        tgt_rotmats,
+                                        seed_jnt_values,
+                                        tcp_jnt_id,
+                                        tcp_loc_pos,
+                                        tcp_loc_rotmat,
+                                        max_niter=max_niter,
+                                        local_minima=local_minima)
 
     def numik_rel(self, deltapos, deltarotmat, tcp_jnt_id=None, tcp_loc_pos=None, tcp_loc_rotmat=None):
         """
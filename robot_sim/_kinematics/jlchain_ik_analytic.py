@@ -0,0 +1,289 @@
+import math
+import numpy as np
+import basis.robot_math as rm
+
+
+# -- Paden-Kahan subproblems --
+# the notations follow Murray, Li, and Sastry, A Mathematical Introduction to Robotic Manipulation, 1994
+# an axis is given by a unit direction ax and a point r on it
+
+
+def _subproblem1(ax, r, p, q):
+    """
+    the angle that rotates p to q around the axis
+    :return: angle
+    """
+    u = p - r
+    v = q - r
+    u_prj = u - ax * ax.dot(u)
+    v_prj = v - ax * ax.dot(v)
+    return math.atan2(ax.dot(np.cross(u_prj, v_prj)), u_prj.dot(v_prj))
+
+
+def _subproblem2(ax1, ax2, r, p, q):
+    """
+    the angles that satisfy rot(ax1, angle1).rot(ax2, angle2).(p-r) = q-r, the two axes intersect at r
+    :return: [[angle1, angle2], ...], 0, 1, or 2 solutions
+    """
+    u = p - r
+    v = q - r
+    cos12 = ax1.dot(ax2)
+    denominator = cos12 * cos12 - 1
+    if abs(denominator) < 1e-12:  # parallel axes
+        return []
+    alpha = (cos12 * ax2.dot(u) - ax1.dot(v)) / denominator
+    beta = (cos12 * ax1.dot(v) - ax2.dot(u)) / denominator
+    ax12 = np.cross(ax1, ax2)
+    gamma_sq = (u.dot(u) - alpha * alpha - beta * beta - 2 * alpha * beta * cos12) / ax12.dot(ax12)
+    if gamma_sq < -1e-9:
+        return []
+    gammas = [0.0] if gamma_sq < 1e-12 else [math.sqrt(gamma_sq), -math.sqrt(gamma_sq)]
+    solutions = []
+    for gamma in gammas:
+        c = alpha * ax1 + beta * ax2 + gamma * ax12 + r
+        solutions.append([_subproblem1(ax1, r, c, q), _subproblem1(ax2, r, p, c)])
+    return solutions
+
+
+def _subproblem3(ax, r, p, q, delta):
+    """
+    the angles that satisfy |rot(ax, angle).(p-r)+r-q| = delta
+    :return: [angle, ...], 0, 1, or 2 solutions
+    """
+    u = p - r
+    v = q - r
+    u_prj = u - ax * ax.dot(u)
+    v_prj = v - ax * ax.dot(v)
+    delta_prj_sq = delta * delta - ax.dot(p - q) ** 2
+    angle0 = math.atan2(ax.dot(np.cross(u_prj, v_prj)), u_prj.dot(v_prj))
+    u_len = np.linalg.norm(u_prj)
+    v_len = np.linalg.norm(v_prj)
+    if u_len < 1e-12 or v_len < 1e-12:
+        return []
+    cos_val = (u_len * u_len + v_len * v_len - delta_prj_sq) / (2 * u_len * v_len)
+    if cos_val > 1 + 1e-9 or cos_val < -1 - 1e-9:
+        return []
+    offset = math.acos(min(max(cos_val, -1.0), 1.0))
+    if offset < 1e-9:
+        return [angle0]
+    return [angle0 - offset, angle0 + offset]
+
+
+def _rotate_about(ax, r, angle, homomat):
+    """
+    left multiply homomat by the rotation around the axis
+    :return: 4x4 nparray
+    """
+    rotmat = rm.rotmat_from_axangle(ax, angle)
+    result = np.empty((4, 4))
+    result[:3, :3] = rotmat.dot(homomat[:3, :3])
+    result[:3, 3] = rotmat.dot(homomat[:3, 3] - r) + r
+    result[3] = homomat[3]
+    return result
+
+
+def _closest_points_between_lines(r1, ax1, r2, ax2):
+    """
+    :return: the closest points on the two lines, None if the lines are parallel
+    """
+    w = r1 - r2
+    b = ax1.dot(ax2)
+    denominator = 1 - b * b
+    if denominator < 1e-12:
+        return None
+    d = ax1.dot(w)
+    e = ax2.dot(w)
+    t1 = (b * e - d) / denominator
+    t2 = (e - b * d) / denominator
+    return r1 + t1 * ax1, r2 + t2 * ax2
+
+
+class SphericalWristIK(object):
+    """
+    Closed-form ik of 6-dof revolute chains whose first two axes intersect and whose last three axes intersect
+    at a common point (a spherical wrist), e.g. PUMA-like and many industrial arms
+    The position of the wrist center is solved by subproblem 3 (joint 3) and subproblem 2 (joints 1 and 2),
+    the orientation is solved by subproblem 2 (joints 4 and 5) and subproblem 1 (joint 6); all (up to 8)
+    branches are returned.
+    The geometry is extracted from the jlchain at construction; is_applicable is False for other geometries,
+    in which case the solver returns None. Construct again after reinitializing the jlchain.
+    usage: jlc.register_ik_backend('spherical_wrist', SphericalWristIK(jlc))
+    """
+
+    def __init__(self, jlc_object, tcp_jnt_id=None, tcp_loc_pos=None, tcp_loc_rotmat=None, tol=1e-6):
+        """
+        :param jlc_object: an instance of robot_sim._kinematics.jlchain.JLChain
+        :param tcp_jnt_id: the tcp the solver is built for, the values of jlc_object are used if None
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :param tol: tolerance of the geometric checks (in meter) and the verification of the results
+        """
+        self.tcp_jnt_id = jlc_object.tcp_jnt_id if tcp_jnt_id is None else tcp_jnt_id
+        self.tcp_loc_pos = np.array(jlc_object.tcp_loc_pos if tcp_loc_pos is None else tcp_loc_pos)
+        self.tcp_loc_rotmat = np.array(jlc_object.tcp_loc_rotmat if tcp_loc_rotmat is None else tcp_loc_rotmat)
+        self.tol = tol
+        self._fkt = jlc_object._fkt.copy()
+        self.jnt_ranges = jlc_object.jnt_ranges.copy()
+        self.is_applicable = self._compile()
+
+    def _compile(self):
+        """
+        extract the twists at the zero configuration and check the geometry
+        :return: True if applicable
+        """
+        fkt = self._fkt
+        if fkt.tgtjnts.size != 6 or not fkt.tgt_is_rev.all():
+            return False
+        if fkt._tgt_counters.get(self.tcp_jnt_id % fkt.njnts) is not None and \
+                fkt._tgt_counters[self.tcp_jnt_id % fkt.njnts] < 5:
+            return False
+        fkt.fk(np.zeros(6), base_pos=np.zeros(3), base_rotmat=np.eye(3))
+        axes = fkt.gl_motionaxes[fkt.tgtjnts]
+        self.axes = axes / np.linalg.norm(axes, axis=1, keepdims=True)
+        self.points = fkt.gl_homomatqs[fkt.tgtjnts, :3, 3].copy()
+        tcp_gl_pos, tcp_gl_rotmat = fkt.get_gl_tcp(self.tcp_jnt_id, self.tcp_loc_pos, self.tcp_loc_rotmat)
+        self.home_tcp_homomat = rm.homomat_from_posrot(tcp_gl_pos, tcp_gl_rotmat)
+        # shoulder: axes 1 and 2 intersect
+        closest_points = _closest_points_between_lines(self.points[0], self.axes[0], self.points[1], self.axes[1])
+        if closest_points is None or np.linalg.norm(closest_points[0] - closest_points[1]) > self.tol:
+            return False
+        self.shoulder_center = (closest_points[0] + closest_points[1]) / 2
+        # wrist: axes 4, 5, and 6 intersect at a common point
+        closest_points = _closest_points_between_lines(self.points[3], self.axes[3], self.points[4], self.axes[4])
+        if closest_points is None or np.linalg.norm(closest_points[0] - closest_points[1]) > self.tol:
+            return False
+        self.wrist_center = (closest_points[0] + closest_points[1]) / 2
+        diff = self.wrist_center - self.points[5]
+        if np.linalg.norm(diff - self.axes[5] * self.axes[5].dot(diff)) > self.tol:
+            return False
+        if np.linalg.norm(np.cross(self.axes[4], self.axes[5])) < 1e-6:
+            return False
+        return True
+
+    def _wrap_to_ranges(self, jnt_values):
+        """
+        shift the angles by 2pi to fit the joint ranges
+        :return: the shifted values, None if some angle does not fit
+        """
+        result = jnt_values.copy()
+        for i in range(6):
+            for candidate in (jnt_values[i], jnt_values[i] - 2 * math.pi, jnt_values[i] + 2 * math.pi):
+                if self.jnt_ranges[i, 0] <= candidate <= self.jnt_ranges[i, 1]:
+                    result[i] = candidate
+                    break
+            else:
+                return None
+        return result
+
+    def __call__(self, tgt_pos, tgt_rotmat, base_pos, base_rotmat, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        :param tgt_pos: 1x3 nparray
+        :param tgt_rotmat: 3x3 nparray
+        :param base_pos: the pos of the jlchain
+        :param base_rotmat: the rotmat of the jlchain
+        :param tcp_jnt_id: the solver is not applied unless the tcp equals to the one used at construction
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :return: kx6 nparray of the solutions inside the joint ranges, None if not applicable
+        """
+        if not self.is_applicable or isinstance(tcp_jnt_id, list):
+            return None
+        if tcp_jnt_id != self.tcp_jnt_id or not np.allclose(tcp_loc_pos, self.tcp_loc_pos) or \
+                not np.allclose(tcp_loc_rotmat, self.tcp_loc_rotmat):
+            return None
+        # the product of exponentials of the 6 joints in the base frame
+        tgt_homomat = np.eye(4)
+        tgt_homomat[:3, :3] = base_rotmat.T.dot(tgt_rotmat)
+        tgt_homomat[:3, 3] = base_rotmat.T.dot(tgt_pos - base_pos)
+        g = tgt_homomat.dot(rm.homomat_inverse(self.home_tcp_homomat))
+        axes = self.axes
+        points = self.points
+        wrist_pos = g[:3, :3].dot(self.wrist_center) + g[:3, 3]
+        delta = np.linalg.norm(wrist_pos - self.shoulder_center)
+        candidates = []
+        for q3 in _subproblem3(axes[2], points[2], self.wrist_center, self.shoulder_center, delta):
+            rotated_wrist_center = rm.rotmat_from_axangle(axes[2], q3).dot(
+                self.wrist_center - points[2]) + points[2]
+            for q1, q2 in _subproblem2(axes[0], axes[1], self.shoulder_center, rotated_wrist_center, wrist_pos):
+                g123 = _rotate_about(axes[0], self.shoulder_center, q1,
+                                     _rotate_about(axes[1], self.shoulder_center, q2,
+                                                   _rotate_about(axes[2], points[2], q3, np.eye(4))))
+                g456 = rm.homomat_inverse(g123).dot(g)
+                # a point on axis 6 but not on axis 5
+                p6 = self.wrist_center + axes[5]
+                q6_tgt = g456[:3, :3].dot(p6) + g456[:3, 3]
+                for q4, q5 in _subproblem2(axes[3], axes[4], self.wrist_center, p6, q6_tgt):
+                    g45 = _rotate_about(axes[3], self.wrist_center, q4,
+                                        _rotate_about(axes[4], self.wrist_center, q5, np.eye(4)))
+                    g6 = rm.homomat_inverse(g45).dot(g456)
+                    # a point not on axis 6
+                    p = self.wrist_center + rm.orthogonal_vector(axes[5])
+                    q6 = _subproblem1(axes[5], self.wrist_center, p, g6[:3, :3].dot(p) + g6[:3, 3])
+                    candidates.append([q1, q2, q3, q4, q5, q6])
+        if len(candidates) == 0:
+            return np.empty((0, 6))
+        candidates = np.array(candidates)
+        # verify the results, degenerated configurations may produce invalid branches
+        gl_homomats = self._fkt.fk_batch(candidates, base_homomat=rm.homomat_from_posrot(base_pos, base_rotmat))
+        tcp_homomats = self._fkt.get_gl_tcp_batch(gl_homomats, self.tcp_jnt_id, self.tcp_loc_pos,
+                                                  self.tcp_loc_rotmat)
+        pos_errs = np.linalg.norm(tcp_homomats[:, :3, 3] - tgt_pos, axis=1)
+        rot_errs = np.linalg.norm(tcp_homomats[:, :3, :3] - tgt_rotmat, axis=(1, 2))
+        result = []
+        for candidate, pos_err, rot_err in zip(candidates, pos_errs, rot_errs):
+            if pos_err < self.tol and rot_err < self.tol:
+                candidate = self._wrap_to_ranges(candidate)
+                if candidate is not None:
+                    result.append(candidate)
+        return np.array(result).reshape(-1, 6)
+
+
+if __name__ == '__main__':
+    import time
+    import robot_sim._kinematics.jlchain as jl
+
+    # a puma-like arm: axes 1 and 2 intersect at the shoulder, axes 4, 5, 6 intersect at the wrist
+    jlinstance = jl.JLChain(homeconf=np.zeros(6))
+    jlinstance.jnts[1]['loc_pos'] = np.array([0, 0, .3])
+    jlinstance.jnts[1]['loc_motionax'] = np.array([0, 0, 1])
+    jlinstance.jnts[2]['loc_pos'] = np.array([0, 0, .1])
+    jlinstance.jnts[2]['loc_motionax'] = np.array([0, 1, 0])
+    jlinstance.jnts[3]['loc_pos'] = np.array([.03, .12, .4])
+    jlinstance.jnts[3]['loc_motionax'] = np.array([0, 1, 0])
+    jlinstance.jnts[4]['loc_pos'] = np.array([.02, -.12, .15])
+    jlinstance.jnts[4]['loc_motionax'] = np.array([0, 0, 1])
+    jlinstance.jnts[5]['loc_pos'] = np.array([0, 0, .25])
+    jlinstance.jnts[5]['loc_motionax'] = np.array([0, 1, 0])
+    jlinstance.jnts[6]['loc_pos'] = np.array([0, 0, 0])
+    jlinstance.jnts[6]['loc_motionax'] = np.array([0, 0, 1])
+    jlinstance.jnts[7]['loc_pos'] = np.array([0, 0, .08])
+    jlinstance.reinitialize()
+    jlinstance.tcp_loc_pos = np.array([0, 0, .1])
+    analytic_ik = SphericalWristIK(jlinstance)
+    print("applicable:", analytic_ik.is_applicable)
+    jlinstance.register_ik_backend('spherical_wrist', analytic_ik)
+    ntrials = 200
+    tgt_list = []
+    for jnt_values in np.random.uniform(-2.5, 2.5, (ntrials, 6)):
+        jlinstance.fk(jnt_values=jnt_values)
+        tgt_list.append(jlinstance.get_gl_tcp())
+    jlinstance.goto_homeconf()
+    nbranches = 0
+    tic = time.time()
+    for tgt_pos, tgt_rotmat in tgt_list:
+        nbranches += len(jlinstance.analytic_ik(tgt_pos, tgt_rotmat))
+    toc = time.time()
+    print(f"analytic, all branches: {(toc - tic) / ntrials * 1000:.3f}ms per query, {nbranches / ntrials:.2f} branches")
+    nsuccess = 0
+    tic = time.time()
+    for tgt_pos, tgt_rotmat in tgt_list:
+        nsuccess += jlinstance.ik(tgt_pos, tgt_rotmat) is not None
+    toc = time.time()
+    print(f"ik with the backend: {(toc - tic) / ntrials * 1000:.3f}ms per query, {nsuccess}/{ntrials} solved")
+    jlinstance.unregister_ik_backend('spherical_wrist')
+    nsuccess = 0
+    tic = time.time()
+    for tgt_pos, tgt_rotmat in tgt_list:
+        nsuccess += jlinstance.ik(tgt_pos, tgt_rotmat) is not None
+    toc = time.time()
+    print(f"num_ik: {(toc - tic) / ntrials * 1000:.3f}ms per query, {nsuccess}/{ntrials} solved")
@@ -0,0 +1,180 @@
+import collections
+import itertools
+import math
+import pickle
+import numpy as np
+import basis.robot_math as rm
+
+# offsets of the 27 voxels around (and including) a voxel
+_NEIGHBOR_OFFSETS = list(itertools.product((-1, 0, 1), repeat=3))
+
+
+class IKSeedCache(object):
+    """
+    Warm-start seeds for numerical ik, indexed by discretized target poses in the base frame of the jlchain
+    A key is the voxel of the target position plus the bin of the target quaternion. lookup returns the
+    solution stored under the same key, or the one of the nearest target in the 26 neighboring voxels
+    with the same quaternion bin. q and -q are the same rotation, both bins are looked up.
+    The entries are only valid for the tcp they were stored with, see is_compatible.
+    The size is bounded, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, pos_resolution=.01, agl_resolution=math.radians(10), max_size=100000):
+        """
+        :param pos_resolution: edge length of the voxels, in meter
+        :param agl_resolution: approximate width of the orientation bins, in radian
+        :param max_size: max number of stored solutions
+        """
+        self.pos_resolution = pos_resolution
+        self.agl_resolution = agl_resolution
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # key -> (loc_tgt_pos, jnt_values)
+        # the tcp of the entries, set by the first store
+        self.tcp_jnt_id = None
+        self.tcp_loc_pos = None
+        self.tcp_loc_rotmat = None
+        self.nhits = 0
+        self.nmisses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _voxel(self, loc_tgt_pos):
+        return tuple(np.floor(np.asarray(loc_tgt_pos) / self.pos_resolution).astype(int).tolist())
+
+    def _quaternion_bin(self, loc_tgt_rotmat):
+        # the quaternion components change about half of the rotation angle
+        quaternion = rm.quaternion_from_matrix(loc_tgt_rotmat)
+        return tuple(np.round(quaternion / (self.agl_resolution / 2)).astype(int).tolist())
+
+    @staticmethod
+    def _to_base(tgt_pos, tgt_rotmat, base_pos, base_rotmat):
+        return (np.asarray(tgt_pos) - base_pos).dot(base_rotmat), np.asarray(base_rotmat).T.dot(tgt_rotmat)
+
+    def key(self, tgt_pos, tgt_rotmat, base_pos=np.zeros(3), base_rotmat=np.eye(3)):
+        loc_tgt_pos, loc_tgt_rotmat = self._to_base(tgt_pos, tgt_rotmat, base_pos, base_rotmat)
+        return self._voxel(loc_tgt_pos) + self._quaternion_bin(loc_tgt_rotmat)
+
+    def is_compatible(self, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        if the entries were stored with the given tcp, always True before the first store
+        :return:
+        """
+        if self.tcp_jnt_id is None:
+            return True
+        return (tcp_jnt_id == self.tcp_jnt_id and np.allclose(tcp_loc_pos, self.tcp_loc_pos) and
+                np.allclose(tcp_loc_rotmat, self.tcp_loc_rotmat))
+
+    def lookup(self, tgt_pos, tgt_rotmat, base_pos=np.zeros(3), base_rotmat=np.eye(3)):
+        """
+        :param tgt_pos: 1x3 nparray
+        :param tgt_rotmat: 3x3 nparray
+        :param base_pos: the pos of the jlchain
+        :param base_rotmat: the rotmat of the jlchain
+        :return: a copy of the stored jnt_values, None if missed
+        """
+        loc_tgt_pos, loc_tgt_rotmat = self._to_base(tgt_pos, tgt_rotmat, base_pos, base_rotmat)
+        voxel = self._voxel(loc_tgt_pos)
+        quaternion_bin = self._quaternion_bin(loc_tgt_rotmat)
+        # rotations near pi have w close to 0, q and -q may fall into opposite bins
+        quaternion_bins = [quaternion_bin, tuple(-value for value in quaternion_bin)]
+        key = None
+        for quaternion_bin in quaternion_bins:
+            if voxel + quaternion_bin in self._entries:
+                key = voxel + quaternion_bin
+                break
+        if key is None:
+            min_dist = np.inf
+            for quaternion_bin in quaternion_bins:
+                for offset in _NEIGHBOR_OFFSETS:
+                    neighbor_key = (voxel[0] + offset[0], voxel[1] + offset[1], voxel[2] + offset[2]) + quaternion_bin
+                    entry = self._entries.get(neighbor_key)
+                    if entry is not None:
+                        dist = np.linalg.norm(entry[0] - loc_tgt_pos)
+                        if dist < min_dist:
+                            min_dist = dist
+                            key = neighbor_key
+        if key is None:
+            self.nmisses += 1
+            return None
+        self.nhits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][1].copy()
+
+    def store(self,
+              tgt_pos,
+              tgt_rotmat,
+              jnt_values,
+              base_pos=np.zeros(3),
+              base_rotmat=np.eye(3),
+              tcp_jnt_id=None,
+              tcp_loc_pos=None,
+              tcp_loc_rotmat=None):
+        """
+        store a solution, the previous one of the same key is replaced
+        :param tgt_pos: 1x3 nparray
+        :param tgt_rotmat: 3x3 nparray
+        :param jnt_values: 1xn nparray
+        :param base_pos: the pos of the jlchain
+        :param base_rotmat: the rotmat of the jlchain
+        :param tcp_jnt_id: the tcp of the solution, recorded by the first store and checked by the later ones,
+                           see is_compatible; the tcp is neither recorded nor checked if None
+        :param tcp_loc_pos: zeros if None
+        :param tcp_loc_rotmat: eye if None
+        :return:
+        """
+        if tcp_jnt_id is not None:
+            tcp_loc_pos = np.zeros(3) if tcp_loc_pos is None else np.array(tcp_loc_pos, dtype=float)
+            tcp_loc_rotmat = np.eye(3) if tcp_loc_rotmat is None else np.array(tcp_loc_rotmat, dtype=float)
+            if not self.is_compatible(tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+                raise ValueError("The tcp is different from the one of the stored entries!")
+            if self.tcp_jnt_id is None:
+                self.tcp_jnt_id = tcp_jnt_id
+                self.tcp_loc_pos = tcp_loc_pos
+                self.tcp_loc_rotmat = tcp_loc_rotmat
+        loc_tgt_pos, loc_tgt_rotmat = self._to_base(tgt_pos, tgt_rotmat, base_pos, base_rotmat)
+        key = self._voxel(loc_tgt_pos) + self._quaternion_bin(loc_tgt_rotmat)
+        self._entries[key] = (np.array(loc_tgt_pos, dtype=float), np.array(jnt_values, dtype=float))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.tcp_jnt_id = None
+        self.tcp_loc_pos = None
+        self.tcp_loc_rotmat = None
+        self.nhits = 0
+        self.nmisses = 0
+
+    def save(self, file_name):
+        """
+        save the settings, the tcp and the entries (in lru order) to a pickle file, the counters are not saved
+        :param file_name:
+        :return:
+        """
+        data = {'pos_resolution': self.pos_resolution,
+                'agl_resolution': self.agl_resolution,
+                'max_size': self.max_size,
+                'tcp_jnt_id': self.tcp_jnt_id,
+                'tcp_loc_pos': self.tcp_loc_pos,
+                'tcp_loc_rotmat': self.tcp_loc_rotmat,
+                'entries': list(self._entries.items())}
+        with open(file_name, 'wb') as f:
+            pickle.dump(data, f)
+
+    def load(self, file_name):
+        """
+        replace the settings, the tcp and the entries with the ones saved in file_name
+        :param file_name:
+        :return:
+        """
+        with open(file_name, 'rb') as f:
+            data = pickle.load(f)
+        self.pos_resolution = data['pos_resolution']
+        self.agl_resolution = data['agl_resolution']
+        self.max_size = data['max_size']
+        self.tcp_jnt_id = data['tcp_jnt_id']
+        self.tcp_loc_pos = data['tcp_loc_pos']
+        self.tcp_loc_rotmat = data['tcp_loc_rotmat']
+        self._entries = collections.OrderedDict(data['entries'])
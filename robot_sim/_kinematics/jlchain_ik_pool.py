@@ -0,0 +1,181 @@
+import collections
+import concurrent.futures as cf
+import os
+import numpy as np
+
+# the solver of a worker process, set once by _init_worker
+_worker_solver = None
+
+
+def _init_worker(solver):
+    global _worker_solver
+    _worker_solver = solver
+
+
+def _solve_chunk(tgt_poss, tgt_rotmats, seed_jnt_values, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat, max_niter,
+                 local_minima, random_seed):
+    # the random restarts of a chunk only depend on its seed, not on the worker that runs it
+    np.random.seed(random_seed)
+    return _worker_solver.solve_batch(tgt_poss,
+                                      tgt_rotmats,
+                                      seed_jnt_values,
+                                      tcp_jnt_id,
+                                      tcp_loc_pos,
+                                      tcp_loc_rotmat,
+                                      max_niter=max_niter,
+                                      local_minima=local_minima)
+
+
+class JLChainIKPool(object):
+    """
+    Solve the ik of many target poses using a pool of processes
+    Only the NumIKSolver of the jlchain (nparrays, no meshes or collision models) is sent to the workers,
+    once per worker when the pool starts. The targets are split into chunks that are solved by
+    NumIKSolver.solve_batch; the results are returned in the order of the targets.
+    The pool uses the base pose and joint values of the jlchain at the time of construction.
+    Use it as a context manager or call close() to shut the workers down.
+    """
+
+    def __init__(self, jlc_object, nworkers=None, chunk_size=256, random_seed=0):
+        """
+        :param jlc_object: an instance of robot_sim._kinematics.jlchain.JLChain
+        :param nworkers: number of processes, os.cpu_count() if None
+        :param chunk_size: number of targets in a task
+        :param random_seed: the seed of a chunk is derived from random_seed and the index of the chunk
+        """
+        jlc_object._ikt._sync_solver()
+        self.ndof = len(jlc_object.tgtjnts)
+        self.homeconf = jlc_object.homeconf
+        self.tcp_jnt_id = jlc_object.tcp_jnt_id
+        self.tcp_loc_pos = jlc_object.tcp_loc_pos
+        self.tcp_loc_rotmat = jlc_object.tcp_loc_rotmat
+        self.nworkers = os.cpu_count() if nworkers is None else nworkers
+        self.chunk_size = chunk_size
+        self.random_seed = random_seed
+        self._executor = cf.ProcessPoolExecutor(max_workers=self.nworkers,
+                                                initializer=_init_worker,
+                                                initargs=(jlc_object._ikt._solver,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        cancel the pending tasks and wait for the workers to exit
+        :return:
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _chunk_random_seed(self, chunk_id):
+        return np.random.SeedSequence([self.random_seed, chunk_id]).generate_state(1)[0]
+
+    def ik_iter(self,
+                tgt_poss,
+                tgt_rotmats,
+                seed_jnt_values=None,
+                tcp_jnt_id=None,
+                tcp_loc_pos=None,
+                tcp_loc_rotmat=None,
+                max_niter=100,
+                local_minima="randomrestart"):
+        """
+        a generator that yields the results chunk by chunk in the order of the targets
+        at most 2*nworkers chunks are submitted ahead of the one being yielded
+        :param tgt_poss: Mx3 nparray
+        :param tgt_rotmats: Mx3x3 nparray
+        :param seed_jnt_values: 1xn (shared), Mxn (one for each target), or MxKxn (K for each target) nparray,
+                                the homeconf of the jlchain is used if None
+        :param tcp_jnt_id: a single joint id, the values of the jlchain are used if None
+        :param tcp_loc_pos:
+        :param tcp_loc_rotmat:
+        :param max_niter:
+        :param local_minima: what to do at local minima: "accept", "randomrestart", "end"
+        :return: jnt_values, is_converged, niters of each chunk, see NumIKSolver.solve_batch
+        """
+        if tcp_jnt_id is None:
+            tcp_jnt_id = self.tcp_jnt_id
+        if tcp_loc_pos is None:
+            tcp_loc_pos = self.tcp_loc_pos
+        if tcp_loc_rotmat is None:
+            tcp_loc_rotmat = self.tcp_loc_rotmat
+        if seed_jnt_values is None:
+            seed_jnt_values = self.homeconf
+        tgt_poss = np.asarray(tgt_poss, dtype=float).reshape(-1, 3)
+        tgt_rotmats = np.asarray(tgt_rotmats, dtype=float).reshape(-1, 3, 3)
+        ntgts = tgt_poss.shape[0]
+        seed_jnt_values = np.asarray(seed_jnt_values, dtype=float)
+        if seed_jnt_values.ndim < 3:
+            seed_jnt_values = np.broadcast_to(seed_jnt_values.reshape(-1, 1, self.ndof), (ntgts, 1, self.ndof))
+        pending = collections.deque()
+        try:
+            for chunk_id, start in enumerate(range(0, ntgts, self.chunk_size)):
+                end = start + self.chunk_size
+                pending.append(self._executor.submit(_solve_chunk,
+                                                     tgt_poss[start:end],
+                                                     tgt_rotmats[start:end],
+                                                     np.ascontiguousarray(seed_jnt_values[start:end]),
+                                                     tcp_jnt_id,
+                                                     tcp_loc_pos,
+                                                     tcp_loc_rotmat,
+                                                     max_niter,
+                                                     local_minima,
+                                                     self._chunk_random_seed(chunk_id)))
+                if len(pending) > 2 * self.nworkers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # the generator was closed early or a task failed
+            for future in pending:
+                future.cancel()
+
+    def ik(self,
+           tgt_poss,
+           tgt_rotmats,
+           seed_jnt_values=None,
+           tcp_jnt_id=None,
+           tcp_loc_pos=None,
+           tcp_loc_rotmat=None,
+           max_niter=100,
+           local_minima="randomrestart"):
+        """
+        solve all targets, see ik_iter for the parameters
+        :return: jnt_values (Mxn nparray, nan for failures), is_converged (1xM bool nparray), niters (1xM nparray)
+        """
+        results = list(self.ik_iter(tgt_poss,
+                                    tgt_rotmats,
+                                    seed_jnt_values=seed_jnt_values,
+                                    tcp_jnt_id=tcp_jnt_id,
+                                    tcp_loc_pos=tcp_loc_pos,
+                                    tcp_loc_rotmat=tcp_loc_rotmat,
+                                    max_niter=max_niter,
+                                    local_minima=local_minima))
+        if len(results) == 0:
+            return np.empty((0, self.ndof)), np.empty(0, dtype=bool), np.empty(0, dtype=int)
+        jnt_values, is_converged, niters = zip(*results)
+        return np.vstack(jnt_values), np.concatenate(is_converged), np.concatenate(niters)
+
+
+if __name__ == '__main__':
+    import time
+    import robot_sim._kinematics.jlchain as jl
+
+    jlinstance = jl.JLChain(homeconf=np.zeros(6))
+    tgt_poss = []
+    tgt_rotmats = []
+    for jnt_values in np.random.uniform(-1, 1, (2000, 6)):
+        jlinstance.fk(jnt_values=jnt_values)
+        tgt_pos, tgt_rotmat = jlinstance.get_gl_tcp()
+        tgt_poss.append(tgt_pos)
+        tgt_rotmats.append(tgt_rotmat)
+    jlinstance.goto_homeconf()
+    tic = time.time()
+    results = jlinstance.ik_batch(tgt_poss, tgt_rotmats, local_minima="randomrestart")
+    print("ik_batch", time.time() - tic, results[1].sum())
+    with JLChainIKPool(jlinstance, chunk_size=128) as pool:
+        tic = time.time()
+        results = pool.ik(tgt_poss, tgt_rotmats)
+        print("pool", time.time() - tic, results[1].sum())
@@ -0,0 +1,242 @@
+import os
+import math
+import pickle
+import itertools
+import numpy as np
+import basis.trimesh as trm
+
+
+def _estimate_reach(fkt, tcp_loc_pos):
+    """
+    an upper bound of the distance between the base and the tcp
+    :param fkt: robot_sim._kinematics.jlchain_fk.JLChainFK
+    :param tcp_loc_pos:
+    :return:
+    """
+    reach = np.linalg.norm(fkt.loc_homomats[:, :3, 3], axis=1).sum() + np.linalg.norm(tcp_loc_pos)
+    if fkt.pris_ids.size > 0:
+        reach += (np.abs(fkt.motion_rngs[fkt.pris_ids]).max(axis=1) *
+                  np.linalg.norm(fkt.loc_motionaxes[fkt.pris_ids], axis=1)).sum()
+    return reach
+
+
+# offsets of the 27 voxels around (and including) a voxel
+_NEIGHBOR_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+
+def build_reachability_map(jlc_object,
+                           file_name,
+                           nsamples=3000000,
+                           pos_resolution=.05,
+                           icolevel=1,
+                           batch_size=10000,
+                           tcp_jnt_id=None,
+                           tcp_loc_pos=None,
+                           tcp_loc_rotmat=None):
+    """
+    sample random configurations of jlc_object and bucket the resulting tcp poses into a voxel grid with
+    orientation bins, the maps are saved as .npy files in the directory file_name and opened as memmaps
+    the grid is described in the base frame of the jlchain (jlc_object.pos, jlc_object.rotmat), orientations
+    are binned by the z axis of the tcp (the approaching direction) using the vertices of an icosphere
+    the map is sampling based, a reachable cell may never be sampled. Measured on a 6-dof puma-like chain
+    (reach about 1.3m) at pos_resolution=.05 and icolevel=1, with 20000 tcp poses of random configurations:
+        nsamples    exact cell missed    neighborhood missed (see ReachabilityMap.is_reachable_batch)
+        100000      80%                  0.7%
+        300000      59%                  0.005%
+        1000000     29%                  0
+        3000000     7.9%                 0
+    scale nsamples with (.05/pos_resolution)**3 and the number of orientation bins for other settings
+    :param jlc_object: an instance of robot_sim._kinematics.jlchain.JLChain
+    :param file_name: a directory, created if it does not exist
+    :param nsamples: number of random configurations, the default suits the default resolutions
+    :param pos_resolution: edge length of the voxels
+    :param icolevel: level of the icosphere for the orientation bins, 1 = 42 bins
+    :param batch_size: number of configurations in a batched fk
+    :param tcp_jnt_id: the values of jlc_object are used if None
+    :param tcp_loc_pos:
+    :param tcp_loc_rotmat:
+    :return: a ReachabilityMap
+    """
+    if tcp_jnt_id is None:
+        tcp_jnt_id = jlc_object.tcp_jnt_id
+    if tcp_loc_pos is None:
+        tcp_loc_pos = jlc_object.tcp_loc_pos
+    if tcp_loc_rotmat is None:
+        tcp_loc_rotmat = jlc_object.tcp_loc_rotmat
+    fkt = jlc_object._fkt
+    ndof = len(jlc_object.tgtjnts)
+    jnt_mins = jlc_object.jnt_ranges[:, 0]
+    jnt_maxs = jlc_object.jnt_ranges[:, 1]
+    dirs = np.asarray(trm.creation.icosphere(icolevel).vertices)
+    dirs = dirs / np.linalg.norm(dirs, axis=1, keepdims=True)
+    reach = _estimate_reach(fkt, tcp_loc_pos) + pos_resolution
+    origin = -np.full(3, reach)
+    nvoxels = int(math.ceil(2 * reach / pos_resolution))
+    shape = (nvoxels, nvoxels, nvoxels, len(dirs))
+    os.makedirs(file_name, exist_ok=True)
+    counts = np.lib.format.open_memmap(os.path.join(file_name, 'counts.npy'), mode='w+', dtype=np.uint32,
+                                       shape=shape)
+    seeds = np.lib.format.open_memmap(os.path.join(file_name, 'seeds.npy'), mode='w+', dtype=np.float32,
+                                      shape=shape + (ndof,))
+    counts[:] = 0
+    seeds[:] = np.nan
+    counts_flat = counts.reshape(-1)
+    seeds_flat = seeds.reshape(-1, ndof)
+    # the representative of a cell is the sample closest to the center of its voxel
+    best_dists = np.full(counts_flat.size, np.inf, dtype=np.float32)
+    for start in range(0, nsamples, batch_size):
+        jnt_values_array = np.random.uniform(jnt_mins, jnt_maxs, (min(batch_size, nsamples - start), ndof))
+        gl_homomats = fkt.fk_batch(jnt_values_array, base_homomat=np.eye(4))
+        tcp_homomats = fkt.get_gl_tcp_batch(gl_homomats, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat)
+        voxel_ids = np.floor((tcp_homomats[:, :3, 3] - origin) / pos_resolution).astype(int)
+        dir_ids = np.argmax(tcp_homomats[:, :3, 2].dot(dirs.T), axis=1)
+        cell_ids = np.ravel_multi_index((voxel_ids[:, 0], voxel_ids[:, 1], voxel_ids[:, 2], dir_ids), shape)
+        dists = np.linalg.norm(tcp_homomats[:, :3, 3] - (origin + (voxel_ids + .5) * pos_resolution), axis=1)
+        order = np.lexsort((dists, cell_ids))
+        cell_ids, first, cell_counts = np.unique(cell_ids[order], return_index=True, return_counts=True)
+        counts_flat[cell_ids] += cell_counts.astype(np.uint32)
+        order = order[first]
+        selection = dists[order] < best_dists[cell_ids]
+        cell_ids = cell_ids[selection]
+        best_dists[cell_ids] = dists[order][selection]
+        seeds_flat[cell_ids] = jnt_values_array[order][selection]
+    scores = np.lib.format.open_memmap(os.path.join(file_name, 'scores.npy'), mode='w+', dtype=np.float32,
+                                       shape=shape[:3])
+    # the ratio of reached orientation bins in each voxel
+    scores[:] = (counts > 0).mean(axis=3)
+    counts.flush()
+    seeds.flush()
+    scores.flush()
+    meta = {'origin': origin,
+            'pos_resolution': pos_resolution,
+            'dirs': dirs,
+            'nsamples': nsamples,
+            'tcp_jnt_id': tcp_jnt_id,
+            'tcp_loc_pos': np.array(tcp_loc_pos),
+            'tcp_loc_rotmat': np.array(tcp_loc_rotmat)}
+    with open(os.path.join(file_name, 'meta.pickle'), 'wb') as f:
+        pickle.dump(meta, f)
+    del counts, seeds, scores
+    return ReachabilityMap(file_name)
+
+
+class ReachabilityMap(object):
+    """
+    A precomputed reachability map built by build_reachability_map
+    counts[ix, iy, iz, idir] is the number of samples whose tcp fell into the cell, seeds[...] is
+    the representative joint values of the cell, scores[ix, iy, iz] is the ratio of reached orientation bins.
+    The arrays are memory-mapped, a query costs O(number of orientation bins) for finding the bin.
+    NOTE: the map is sampling based, cells that are rarely reached may be missed, see the false negative rates
+    in build_reachability_map. is_reachable_batch thus checks the neighborhood of a pose by default.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: the directory passed to build_reachability_map
+        """
+        with open(os.path.join(file_name, 'meta.pickle'), 'rb') as f:
+            meta = pickle.load(f)
+        self.origin = meta['origin']
+        self.pos_resolution = meta['pos_resolution']
+        self.dirs = meta['dirs']
+        self.nsamples = meta['nsamples']
+        self.tcp_jnt_id = meta['tcp_jnt_id']
+        self.tcp_loc_pos = meta['tcp_loc_pos']
+        self.tcp_loc_rotmat = meta['tcp_loc_rotmat']
+        self.counts = np.load(os.path.join(file_name, 'counts.npy'), mmap_mode='r')
+        self.seeds = np.load(os.path.join(file_name, 'seeds.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(file_name, 'scores.npy'), mmap_mode='r')
+        # the largest angle between an orientation bin and its nearest bin
+        agls = np.arccos(np.clip(self.dirs.dot(self.dirs.T), -1, 1))
+        np.fill_diagonal(agls, np.inf)
+        self._neighbor_agl = agls.min(axis=1).max()
+
+    def is_compatible(self, tcp_jnt_id, tcp_loc_pos, tcp_loc_rotmat):
+        """
+        if the map was built with the given tcp
+        :return:
+        """
+        return (tcp_jnt_id == self.tcp_jnt_id and np.allclose(tcp_loc_pos, self.tcp_loc_pos) and
+                np.allclose(tcp_loc_rotmat, self.tcp_loc_rotmat))
+
+    def _cell_ids(self, tgt_poss, tgt_rotmats, base_pos, base_rotmat):
+        """
+        :return: Nx4 nparray of the cell indices, a 1xN bool nparray indicating if the cells are inside the grid
+        """
+        loc_poss = (tgt_poss - base_pos).dot(base_rotmat)
+        loc_dirs = tgt_rotmats[:, :, 2].dot(base_rotmat)
+        cell_ids = np.empty((len(loc_poss), 4), dtype=int)
+        cell_ids[:, :3] = np.floor((loc_poss - self.origin) / self.pos_resolution)
+        cell_ids[:, 3] = np.argmax(loc_dirs.dot(self.dirs.T), axis=1)
+        is_inside = np.logical_and(cell_ids[:, :3] >= 0, cell_ids[:, :3] < self.counts.shape[:3]).all(axis=1)
+        return cell_ids, is_inside
+
+    def is_reachable_batch(self,
+                           tgt_poss,
+                           tgt_rotmats,
+                           base_pos=np.zeros(3),
+                           base_rotmat=np.eye(3),
+                           min_count=1,
+                           toggle_neighbors=True):
+        """
+        :param tgt_poss: Nx3 nparray
+        :param tgt_rotmats: Nx3x3 nparray
+        :param base_pos: the pos of the jlchain
+        :param base_rotmat: the rotmat of the jlchain
+        :param min_count: cells with fewer samples are considered unreachable
+        :param toggle_neighbors: a pose is reachable if any cell in the 27 voxels around it, with an orientation
+                                 bin within one bin of its approaching direction, is reachable; only its own
+                                 cell is checked if False, which gives much more false negatives
+        :return: 1xN bool nparray
+        """
+        tgt_rotmats = np.asarray(tgt_rotmats).reshape(-1, 3, 3)
+        cell_ids, is_inside = self._cell_ids(np.asarray(tgt_poss).reshape(-1, 3), tgt_rotmats, base_pos, base_rotmat)
+        if not toggle_neighbors:
+            is_reachable = np.zeros(len(cell_ids), dtype=bool)
+            inside_ids = cell_ids[is_inside]
+            is_reachable[is_inside] = self.counts[inside_ids[:, 0], inside_ids[:, 1], inside_ids[:, 2],
+                                                  inside_ids[:, 3]] >= min_count
+            return is_reachable
+        # the voxels outside the grid are never reached, clipping them into the grid keeps the result
+        voxel_ids = np.clip(cell_ids[:, np.newaxis, :3] + _NEIGHBOR_OFFSETS, 0, np.array(self.counts.shape[:3]) - 1)
+        is_near_dir = tgt_rotmats[:, :, 2].dot(base_rotmat).dot(self.dirs.T) >= math.cos(self._neighbor_agl)
+        is_reached = self.counts[voxel_ids[..., 0], voxel_ids[..., 1], voxel_ids[..., 2]] >= min_count
+        is_reachable = (is_reached & is_near_dir[:, np.newaxis]).any(axis=(1, 2))
+        # the grid covers the reach, a pose outside it cannot be within one voxel of a reached cell
+        is_reachable[~is_inside] = False
+        return is_reachable
+
+    def is_reachable(self,
+                     tgt_pos,
+                     tgt_rotmat,
+                     base_pos=np.zeros(3),
+                     base_rotmat=np.eye(3),
+                     min_count=1,
+                     toggle_neighbors=True):
+        return bool(self.is_reachable_batch(tgt_pos, tgt_rotmat, base_pos, base_rotmat, min_count,
+                                            toggle_neighbors)[0])
+
+    def get_seed(self, tgt_pos, tgt_rotmat, base_pos=np.zeros(3), base_rotmat=np.eye(3)):
+        """
+        the representative joint values of the cell of the given pose
+        :return: 1xn nparray, None if the cell was never reached
+        """
+        cell_ids, is_inside = self._cell_ids(np.asarray(tgt_pos).reshape(1, 3),
+                                             np.asarray(tgt_rotmat).reshape(1, 3, 3), base_pos, base_rotmat)
+        if not is_inside[0]:
+            return None
+        seed = np.array(self.seeds[tuple(cell_ids[0])], dtype=float)
+        if np.isnan(seed).any():
+            return None
+        return seed
+
+    def get_score(self, tgt_pos, base_pos=np.zeros(3), base_rotmat=np.eye(3)):
+        """
+        the ratio of reached orientation bins at the voxel of tgt_pos
+        :return:
+        """
+        voxel_id = np.floor(((np.asarray(tgt_pos) - base_pos).dot(base_rotmat) - self.origin) / self.pos_resolution)
+        voxel_id = voxel_id.astype(int)
+        if np.any(voxel_id < 0) or np.any(voxel_id >= self.scores.shape):
+            return 0.0
+        return float(self.scores[tuple(voxel_id)])
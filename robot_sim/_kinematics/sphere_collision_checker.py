@@ -0,0 +1,387 @@
+import numpy as np
+import modeling._sphere_cdhelper as scd
+import modeling.collision_environment as cenv
+
+
+class SphereCollisionChecker(object):
+    """
+    Margin and distance queries of the cd elements of a CollisionChecker, using sphere trees and NumPy only
+    The meshes of the cd elements are covered by the sphere trees of modeling._sphere_cdhelper (the ones of mesh
+    files are cached on disk). The queries take the batched poses of CollisionChecker.get_gl_homomats_batch and
+    descend the trees of all configurations at once, no scene graph is traversed.
+    This is not a faster replacement of CollisionChecker.is_collided_batch: plain collision checks are about as fast
+    when most configurations collide and slower otherwise. Use it for what the traverser cannot answer, i.e.
+    clearances (is_collided_batch with a margin) and signed distances (get_min_distances_batch).
+    The pairs are the ones of the CollisionChecker: its self collision pairs, and its active elements against the
+    obstacles (as oriented boxes around their cd primitives) and the cd elements of other robots (as their own
+    sphere trees). The spheres cover the surfaces of the meshes with a margin of at most max_radius, thus
+    a model fully enclosed by another one is not reported.
+    NOTE: the trees are built from the cd elements at construction, build a new instance after they change
+    """
+
+    def __init__(self, cc, max_radius=.01, cache_dir=None):
+        """
+        :param cc: a robot_sim._kinematics.collision_checker.CollisionChecker
+        :param max_radius: upper bound of the radii of the leaf spheres
+        :param cache_dir: see modeling._sphere_cdhelper.load_sphere_tree
+        """
+        self.cc = cc
+        self.max_radius = max_radius
+        centers = []
+        radii = []
+        children = []
+        element_ids = []
+        root_ids = []
+        nnodes = 0
+        for element_id, cdelement in enumerate(cc.all_cdelements):
+            objcm = cdelement['collision_model']
+            if objcm.objpath is not None:
+                # the trees of the files are unscaled, the radii are scaled by the largest factor
+                scale = np.abs(objcm.get_scale())
+                sphere_tree = scd.load_sphere_tree(objcm.objpath, max_radius=max_radius / scale.max(),
+                                                   cache_dir=cache_dir)
+                centers.append(sphere_tree['centers'] * scale)
+                radii.append(sphere_tree['radii'] * scale.max())
+            else:
+                sphere_tree = scd.gen_sphere_tree(objcm.objtrm.vertices, objcm.objtrm.faces, max_radius=max_radius)
+                centers.append(sphere_tree['centers'])
+                radii.append(sphere_tree['radii'])
+            children.append(np.where(sphere_tree['children'] == -1, -1, sphere_tree['children'] + nnodes))
+            element_ids.append(np.full(len(sphere_tree['radii']), element_id))
+            root_ids.append(nnodes)
+            nnodes += len(sphere_tree['radii'])
+        self._centers = np.concatenate(centers).reshape(-1, 3)  # in the local frames of the cd elements
+        self._radii = np.concatenate(radii) if nnodes > 0 else np.zeros(0)
+        self._children = np.concatenate(children).reshape(-1, 2).astype(int)
+        self._element_ids = np.concatenate(element_ids).astype(int) if nnodes > 0 else np.zeros(0, dtype=int)
+        self._root_ids = np.array(root_ids, dtype=int)
+        # the largest radii of the leaves below the nodes, the children are created after their parents
+        self._leaf_depths = self._radii.copy()
+        for node_id in np.flatnonzero(self._children[:, 0] != -1)[::-1]:
+            self._leaf_depths[node_id] = self._leaf_depths[self._children[node_id]].max()
+        self._active_ids, self._cdpairs = cc._get_cdpairs()
+
+    @property
+    def nspheres(self):
+        """
+        :return: number of leaf spheres
+        """
+        return int((self._children[:, 0] == -1).sum())
+
+    def _get_node_gl_centers(self, gl_homomats_array, conf_ids, node_ids):
+        """
+        :param gl_homomats_array: NxMx4x4 nparray
+        :param conf_ids: 1xk int nparray
+        :param node_ids: 1xk int nparray
+        :return: kx3 nparray
+        """
+        gl_homomats = gl_homomats_array[conf_ids, self._element_ids[node_ids]]
+        return np.einsum('kij,kj->ki', gl_homomats[:, :3, :3], self._centers[node_ids]) + gl_homomats[:, :3, 3]
+
+    def get_gl_spheres(self, gl_homomats=None):
+        """
+        the leaf spheres at one set of poses
+        :param gl_homomats: Mx4x4 nparray, the current poses are used if None, see CollisionChecker.get_gl_homomats
+        :return: centers Lx3 nparray, radii 1xL nparray
+        """
+        if gl_homomats is None:
+            gl_homomats = self.cc.get_gl_homomats()
+        leaf_ids = np.flatnonzero(self._children[:, 0] == -1)
+        return (self._get_node_gl_centers(np.asarray(gl_homomats)[np.newaxis], np.zeros_like(leaf_ids), leaf_ids),
+                self._radii[leaf_ids])
+
+    def _dive(self, gl_homomats_array, conf_ids, node_ids0, node_ids1, distances, distance_fn, radii1, children1,
+              leaf_depths1, min_distances, threshold, toggle_stop, beam_width=4):
+        """
+        descend only the beam_width closest pairs of each configuration down to the leaves; the leaves found are
+        exact candidates of min_distances, so a colliding configuration is usually decided here with a few
+        pairs per level, and the distances found prune the full descent
+        see _descend for the parameters
+        :return:
+        """
+        while len(conf_ids) > 0:
+            if distances is None:
+                distances = distance_fn(conf_ids,
+                                        self._get_node_gl_centers(gl_homomats_array, conf_ids, node_ids0),
+                                        self._radii[node_ids0],
+                                        node_ids1)
+            # the beam_width pairs of each configuration with the smallest upper bounds, among the ones within
+            # threshold; the lower bounds favor large spheres, which seldom lead to the closest leaves
+            upper_bounds = distances + 2 * self._radii[node_ids0] + 2 * radii1[node_ids1]
+            distances = np.maximum(distances, -self._leaf_depths[node_ids0] - leaf_depths1[node_ids1])
+            order = np.lexsort((upper_bounds, conf_ids))
+            sorted_conf_ids = conf_ids[order]
+            ranks = np.arange(len(order)) - np.searchsorted(sorted_conf_ids, sorted_conf_ids)
+            is_kept = (ranks < beam_width) & (distances[order] <= np.minimum(min_distances[sorted_conf_ids], threshold))
+            if toggle_stop:
+                is_kept &= min_distances[sorted_conf_ids] > threshold
+            order = order[is_kept]
+            conf_ids = conf_ids[order]
+            node_ids0 = node_ids0[order]
+            node_ids1 = node_ids1[order]
+            distances = distances[order]
+            is_leaf0 = self._children[node_ids0, 0] == -1
+            is_leaf1 = children1[node_ids1, 0] == -1
+            is_leaf_pair = is_leaf0 & is_leaf1
+            np.minimum.at(min_distances, conf_ids[is_leaf_pair], distances[is_leaf_pair])
+            is_split0 = ~is_leaf0 & (is_leaf1 | (self._radii[node_ids0] >= radii1[node_ids1]))
+            is_split1 = ~is_leaf_pair & ~is_split0
+            conf_ids = np.concatenate([np.repeat(conf_ids[is_split0], 2), np.repeat(conf_ids[is_split1], 2)])
+            node_ids0, node_ids1 = (np.concatenate([self._children[node_ids0[is_split0]].reshape(-1),
+                                                    np.repeat(node_ids0[is_split1], 2)]),
+                                    np.concatenate([np.repeat(node_ids1[is_split0], 2),
+                                                    children1[node_ids1[is_split1]].reshape(-1)]))
+            distances = None
+
+    def _descend(self, gl_homomats_array, conf_ids, node_ids0, node_ids1, distances, distance_fn, radii1, children1,
+                 leaf_depths1, min_distances, threshold, toggle_stop):
+        """
+        descend pairs of trees of all configurations at once, the first trees are the ones of self,
+        the pairs farther than threshold or than the closest leaves found so far are pruned
+        :param gl_homomats_array: NxMx4x4 nparray
+        :param conf_ids: 1xk int nparray
+        :param node_ids0: 1xk int nparray, nodes of self
+        :param node_ids1: 1xk int nparray, nodes of the second trees
+        :param distances: 1xk nparray, the distances of the pairs, computed by distance_fn if None
+        :param distance_fn: callable(conf_ids, gl_centers0, radii0, node_ids1), returns the signed distances
+        :param radii1: radii of the second nodes, 0 for boxes
+        :param children1: children of the second nodes, -1 for leaves
+        :param leaf_depths1: the largest depths of a point inside the leaves below the second nodes, the largest
+                             radii of the leaves for spheres and the smallest half extents for boxes; the lower
+                             bounds of the pairs are raised to minus the sums of the depths of both sides,
+                             which prunes the pairs of large nodes once a deep penetration is found
+        :param min_distances: 1xN nparray, updated in place by the distances between leaves, and by the upper
+                              bounds that are within threshold if toggle_stop is True
+        :param threshold: the pairs farther than threshold are pruned
+        :param toggle_stop: stop descending a configuration once a pair of leaves is within threshold
+        :return:
+        """
+        self._dive(gl_homomats_array, conf_ids, node_ids0, node_ids1, distances, distance_fn, radii1, children1,
+                   leaf_depths1, min_distances, threshold, toggle_stop)
+        # the distance between any leaves of a pair of nodes is at most their lower bound plus the diameters
+        upper_bounds = np.full(len(min_distances), np.inf)
+        while len(conf_ids) > 0:
+            if distances is None:
+                distances = distance_fn(conf_ids,
+                                        self._get_node_gl_centers(gl_homomats_array, conf_ids, node_ids0),
+                                        self._radii[node_ids0],
+                                        node_ids1)
+            np.minimum.at(upper_bounds, conf_ids, distances + 2 * self._radii[node_ids0] + 2 * radii1[node_ids1])
+            distances = np.maximum(distances, -self._leaf_depths[node_ids0] - leaf_depths1[node_ids1])
+            if toggle_stop:
+                # the configurations whose upper bounds are within threshold are collided
+                np.minimum(min_distances, np.where(upper_bounds <= threshold, upper_bounds, np.inf), out=min_distances)
+            is_kept = distances <= np.minimum(np.minimum(min_distances, upper_bounds)[conf_ids], threshold)
+            if toggle_stop:
+                is_kept &= min_distances[conf_ids] > threshold
+            conf_ids = conf_ids[is_kept]
+            node_ids0 = node_ids0[is_kept]
+            node_ids1 = node_ids1[is_kept]
+            distances = distances[is_kept]
+            is_leaf0 = self._children[node_ids0, 0] == -1
+            is_leaf1 = children1[node_ids1, 0] == -1
+            is_leaf_pair = is_leaf0 & is_leaf1
+            np.minimum.at(min_distances, conf_ids[is_leaf_pair], distances[is_leaf_pair])
+            # split the first node if the second one is a leaf or smaller, and the second one otherwise
+            is_split0 = ~is_leaf0 & (is_leaf1 | (self._radii[node_ids0] >= radii1[node_ids1]))
+            is_split1 = ~is_leaf_pair & ~is_split0
+            conf_ids = np.concatenate([np.repeat(conf_ids[is_split0], 2), np.repeat(conf_ids[is_split1], 2)])
+            node_ids0, node_ids1 = (np.concatenate([self._children[node_ids0[is_split0]].reshape(-1),
+                                                    np.repeat(node_ids0[is_split1], 2)]),
+                                    np.concatenate([np.repeat(node_ids1[is_split0], 2),
+                                                    children1[node_ids1[is_split1]].reshape(-1)]))
+            distances = None
+
+    def _get_box_obstacles(self, obstacle_list, root_gl_centers):
+        """
+        the oriented boxes around the cd primitives of the obstacles
+        :param obstacle_list: collision models, or a CollisionEnvironment
+        :param root_gl_centers: NxMx3 nparray, the root spheres used to query a CollisionEnvironment
+        :return: centers Qx3, rotmats Qx3x3, half_extents Qx3
+        """
+        if isinstance(obstacle_list, cenv.CollisionEnvironment):
+            root_radii = self._radii[self._root_ids][:, np.newaxis]
+            obstacle_list = obstacle_list.query(np.array([(root_gl_centers - root_radii).reshape(-1, 3).min(axis=0),
+                                                          (root_gl_centers + root_radii).reshape(-1, 3).max(axis=0)]))
+        centers = np.zeros((len(obstacle_list), 3))
+        rotmats = np.zeros((len(obstacle_list), 3, 3))
+        half_extents = np.zeros((len(obstacle_list), 3))
+        for i, obstacle in enumerate(obstacle_list):
+            local_aabb = obstacle.get_cdprimit_local_aabb()
+            rotmats[i] = obstacle.get_rotmat()
+            centers[i] = rotmats[i].dot((local_aabb[0] + local_aabb[1]) / 2) + obstacle.get_pos()
+            half_extents[i] = (local_aabb[1] - local_aabb[0]) / 2
+        return centers, rotmats, half_extents
+
+    def _get_min_distances(self, gl_homomats_array, obstacle_list, otherrobot_list, threshold, toggle_stop):
+        """
+        the roots of all configurations are compared as dense distance matrices, the trees are only descended
+        from the pairs of roots that are within threshold
+        :return: 1xN nparray, the smallest signed distance between the leaves of each configuration,
+                 inf if no pair is within threshold
+        """
+        gl_homomats_array = np.asarray(gl_homomats_array)
+        min_distances = np.full(len(gl_homomats_array), np.inf)
+        if len(self._root_ids) == 0:
+            return min_distances
+        root_gl_centers = np.einsum('nmij,mj->nmi', gl_homomats_array[:, :, :3, :3], self._centers[self._root_ids]) + \
+                          gl_homomats_array[:, :, :3, 3]
+        root_radii = self._radii[self._root_ids]
+        # self collision pairs
+        if len(self._cdpairs) > 0:
+            root_distances = scd.sphere_sphere_distances(root_gl_centers[:, self._cdpairs[:, 0]],
+                                                         root_radii[self._cdpairs[:, 0]],
+                                                         root_gl_centers[:, self._cdpairs[:, 1]],
+                                                         root_radii[self._cdpairs[:, 1]])
+            conf_ids, pair_ids = np.nonzero(root_distances <= threshold)
+            self._descend(gl_homomats_array,
+                          conf_ids,
+                          self._root_ids[self._cdpairs[pair_ids, 0]],
+                          self._root_ids[self._cdpairs[pair_ids, 1]],
+                          root_distances[conf_ids, pair_ids],
+                          lambda conf_ids, centers0, radii0, node_ids1: scd.sphere_sphere_distances(
+                              centers0, radii0,
+                              self._get_node_gl_centers(gl_homomats_array, conf_ids, node_ids1),
+                              self._radii[node_ids1]),
+                          self._radii, self._children, self._leaf_depths, min_distances, threshold, toggle_stop)
+        if len(self._active_ids) == 0:
+            return min_distances
+        active_gl_centers = root_gl_centers[:, self._active_ids, np.newaxis]
+        active_radii = root_radii[self._active_ids, np.newaxis]
+        # obstacles, the boxes are leaves
+        box_centers, box_rotmats, box_half_extents = self._get_box_obstacles(obstacle_list, root_gl_centers)
+        if len(box_centers) > 0:
+            root_distances = scd.sphere_box_distances(active_gl_centers, active_radii,
+                                                      box_centers, box_rotmats, box_half_extents)
+            conf_ids, active_ids, box_ids = np.nonzero(root_distances <= threshold)
+            self._descend(gl_homomats_array,
+                          conf_ids,
+                          self._root_ids[self._active_ids[active_ids]],
+                          box_ids,
+                          root_distances[conf_ids, active_ids, box_ids],
+                          lambda conf_ids, centers0, radii0, node_ids1: scd.sphere_box_distances(
+                              centers0, radii0,
+                              box_centers[node_ids1], box_rotmats[node_ids1], box_half_extents[node_ids1]),
+                          np.zeros(len(box_centers)), np.full((len(box_centers), 2), -1), box_half_extents.min(axis=1),
+                          min_distances, threshold, toggle_stop)
+        # other robots, all of their cd elements at their current poses
+        for robot_scc in otherrobot_list:
+            if len(robot_scc._root_ids) == 0:
+                continue
+            robot_nodes = np.arange(len(robot_scc._radii))
+            robot_gl_centers = robot_scc._get_node_gl_centers(robot_scc.cc.get_gl_homomats()[np.newaxis],
+                                                              np.zeros_like(robot_nodes), robot_nodes)
+            root_distances = scd.sphere_sphere_distances(active_gl_centers, active_radii,
+                                                         robot_gl_centers[robot_scc._root_ids],
+                                                         robot_scc._radii[robot_scc._root_ids])
+            conf_ids, active_ids, robot_root_ids = np.nonzero(root_distances <= threshold)
+            self._descend(gl_homomats_array,
+                          conf_ids,
+                          self._root_ids[self._active_ids[active_ids]],
+                          robot_scc._root_ids[robot_root_ids],
+                          root_distances[conf_ids, active_ids, robot_root_ids],
+                          lambda conf_ids, centers0, radii0, node_ids1: scd.sphere_sphere_distances(
+                              centers0, radii0, robot_gl_centers[node_ids1], robot_scc._radii[node_ids1]),
+                          robot_scc._radii, robot_scc._children, robot_scc._leaf_depths, min_distances, threshold,
+                          toggle_stop)
+        return min_distances
+
+    def is_collided_homomats_batch(self, gl_homomats_array, obstacle_list=[], otherrobot_list=[], margin=0):
+        """
+        :param gl_homomats_array: NxMx4x4 nparray, see CollisionChecker.get_gl_homomats_batch
+        :param obstacle_list: collision models, or a CollisionEnvironment
+        :param otherrobot_list: SphereCollisionCheckers of the other robots, at the current poses of their cd elements
+        :param margin: the spheres closer than margin are regarded as collided
+        :return: 1xN bool nparray
+        """
+        return self._get_min_distances(gl_homomats_array, obstacle_list, otherrobot_list,
+                                       threshold=margin, toggle_stop=True) <= margin
+
+    def get_min_distances_homomats_batch(self, gl_homomats_array, obstacle_list=[], otherrobot_list=[],
+                                         max_distance=.1):
+        """
+        the smallest signed distances between the spheres of the pairs, negative for penetrations
+        :param gl_homomats_array: see is_collided_homomats_batch
+        :param obstacle_list: see is_collided_homomats_batch
+        :param otherrobot_list: see is_collided_homomats_batch
+        :param max_distance: the pairs farther than max_distance are not considered
+        :return: 1xN nparray, inf if no pair is within max_distance
+        """
+        return self._get_min_distances(gl_homomats_array, obstacle_list, otherrobot_list,
+                                       threshold=max_distance, toggle_stop=False)
+
+    def is_collided_batch(self, jnt_values_array, obstacle_list=[], otherrobot_list=[], jlcobj=None, margin=0):
+        """
+        :param jnt_values_array: see CollisionChecker.is_collided_batch
+        :param obstacle_list: see is_collided_homomats_batch
+        :param otherrobot_list: see is_collided_homomats_batch
+        :param jlcobj: see CollisionChecker.is_collided_batch
+        :param margin: see is_collided_homomats_batch
+        :return: 1xN bool nparray
+        """
+        gl_homomats_array = self.cc.get_gl_homomats_batch(self.cc._get_jnt_values_dict(jnt_values_array, jlcobj))
+        return self.is_collided_homomats_batch(gl_homomats_array, obstacle_list, otherrobot_list, margin=margin)
+
+    def get_min_distances_batch(self, jnt_values_array, obstacle_list=[], otherrobot_list=[], jlcobj=None,
+                                max_distance=.1):
+        """
+        :param jnt_values_array: see CollisionChecker.is_collided_batch
+        :param obstacle_list: see is_collided_homomats_batch
+        :param otherrobot_list: see is_collided_homomats_batch
+        :param jlcobj: see CollisionChecker.is_collided_batch
+        :param max_distance: see get_min_distances_homomats_batch
+        :return: 1xN nparray
+        """
+        gl_homomats_array = self.cc.get_gl_homomats_batch(self.cc._get_jnt_values_dict(jnt_values_array, jlcobj))
+        return self.get_min_distances_homomats_batch(gl_homomats_array, obstacle_list, otherrobot_list,
+                                                     max_distance=max_distance)
+
+
+if __name__ == '__main__':
+    import time
+    import basis.robot_math as rm
+    import modeling.collision_model as cm
+    import modeling.geometric_model as gm
+    import robot_sim.end_effectors.gripper.robotiq85.robotiq85 as rtq85
+    import visualization.panda.world as wd
+
+    base = wd.World(cam_pos=[.5, .5, .5], lookat_pos=[0, 0, .1])
+    gripper = rtq85.Robotiq85()
+    tic = time.time()
+    scc = SphereCollisionChecker(gripper.cc, max_radius=.005)
+    print(f"{scc.nspheres} spheres, built or loaded in {time.time() - tic:.3f}s")
+    obstacle_list = []
+    for pos in np.random.uniform(-.1, .1, (30, 3)):
+        obstacle = cm.gen_box(np.array([.01, .01, .01]))
+        obstacle.set_pos(pos + np.array([0, 0, .12]))
+        obstacle.set_rotmat(rm.rotmat_from_euler(*np.random.uniform(-np.pi, np.pi, 3)))
+        obstacle.attach_to(base)
+        obstacle_list.append(obstacle)
+    other_gripper = rtq85.Robotiq85()
+    other_gripper.fix_to(np.array([0, .25, .15]), rm.rotmat_from_euler(np.pi / 2, 0, 0))
+    other_scc = SphereCollisionChecker(other_gripper.cc, max_radius=.005)
+    motion_vals = np.random.uniform(0, .8, 1000)
+    zeros = np.zeros_like(motion_vals)
+    jnt_values_dict = {gripper.lft_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+                       gripper.lft_inner: motion_vals[:, np.newaxis],
+                       gripper.rgt_outer: np.stack([motion_vals, zeros, -motion_vals, zeros], axis=1),
+                       gripper.rgt_inner: motion_vals[:, np.newaxis]}
+    gl_homomats_array = gripper.cc.get_gl_homomats_batch(jnt_values_dict)
+    tic = time.time()
+    results = gripper.cc.is_collided_homomats_batch(gl_homomats_array, obstacle_list)
+    print("traverser, obstacles", time.time() - tic, results.sum())
+    tic = time.time()
+    results = scc.is_collided_homomats_batch(gl_homomats_array, obstacle_list)
+    print("spheres, obstacles", time.time() - tic, results.sum())
+    tic = time.time()
+    results = scc.is_collided_homomats_batch(gl_homomats_array, obstacle_list, [other_scc], margin=.01)
+    print("spheres, obstacles and a robot, 1cm margin", time.time() - tic, results.sum())
+    tic = time.time()
+    min_distances = scc.get_min_distances_homomats_batch(gl_homomats_array, obstacle_list, [other_scc],
+                                                         max_distance=.02)
+    print("distances within 2cm", time.time() - tic, np.nanmin(min_distances))
+    gripper.gen_meshmodel().attach_to(base)
+    other_gripper.gen_meshmodel().attach_to(base)
+    for center, radius in zip(*scc.get_gl_spheres()):
+        gm.gen_sphere(center, radius, rgba=[0, .7, 1, .3]).attach_to(base)
+    base.run()
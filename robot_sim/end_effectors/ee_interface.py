@@ -1,9 +1,12 @@
 import copy
 import numpy as np
+import basis.robot_math as rm
 import modeling.model_collection as mc
 import robot_sim._kinematics.jlchain as jl
 import robot_sim._kinematics.collision_checker as cc
 import modeling.geometric_model as gm
+import modeling.collision_environment as cenv
+from panda3d.core import BitMask32
 
 
 class EEInterface(object):
@@ -43,25 +46,115 @@ class EEInterface(object):
         return return_val
 
     def is_mesh_collided(self, objcm_list=[], toggle_debug=False):
-        for i, cdelement in enumerate(self.all_cdelements):
-            pos = cdelement['gl_pos']
-            rotmat = cdelement['gl_rotmat']
-            self.cdmesh_collection.cm_list[i].set_pos(pos)
-            self.cdmesh_collection.cm_list[i].set_rotmat(rotmat)
-            iscollided, collided_points = self.cdmesh_collection.cm_list[i].is_mcdwith(objcm_list, True)
+        """
+        check the cdmeshes of the cd elements against the cdmeshes of objcm_list
+        a cd element and an object are sent to ode only if their axis aligned bounds in the world frame overlap
+        :param objcm_list: a list of collision models or a CollisionEnvironment
+        :param toggle_debug: show the first collided cdmesh and its contact points
+        :return:
+        """
+        if len(self.all_cdelements) == 0:
+            return False
+        cm_list = self.cdmesh_collection.cm_list[:len(self.all_cdelements)]
+        if isinstance(objcm_list, cenv.CollisionEnvironment):
+            cdelement_aabbs = rm.transform_aabbs(np.array([cm.get_cdmesh_local_aabb() for cm in cm_list]),
+                                                 np.array([cdelement['gl_pos'] for cdelement in self.all_cdelements]),
+                                                 np.array([cdelement['gl_rotmat'] for cdelement in self.all_cdelements]))
+            objcm_list = objcm_list.query(np.array([cdelement_aabbs[:, 0].min(axis=0),
+                                                    cdelement_aabbs[:, 1].max(axis=0)]))
+        if not isinstance(objcm_list, list):
+            objcm_list = [objcm_list]
+        if len(objcm_list) == 0:
+            return False
+        # the cd elements and the objects are bounded in one call, the first len(cm_list) ones are the cd elements
+        gl_aabbs = rm.transform_aabbs(np.array([cm.get_cdmesh_local_aabb() for cm in cm_list + objcm_list]),
+                                      np.array([cdelement['gl_pos'] for cdelement in self.all_cdelements] +
+                                               [objcm.get_pos() for objcm in objcm_list]),
+                                      np.array([cdelement['gl_rotmat'] for cdelement in self.all_cdelements] +
+                                               [objcm.get_rotmat() for objcm in objcm_list]))
+        cdelement_aabbs = gl_aabbs[:len(cm_list)]
+        objcm_aabbs = gl_aabbs[len(cm_list):]
+        # is_overlapped[i, j] is True if the bounds of cd element i and objcm j overlap
+        is_overlapped = np.all((cdelement_aabbs[:, np.newaxis, 0] <= objcm_aabbs[np.newaxis, :, 1]) &
+                               (cdelement_aabbs[:, np.newaxis, 1] >= objcm_aabbs[np.newaxis, :, 0]), axis=2)
+        for i in np.flatnonzero(is_overlapped.any(axis=1)):
+            cdelement = self.all_cdelements[i]
+            cm_list[i].set_pose(cdelement['gl_pos'], cdelement['gl_rotmat'])
+            candidate_list = [objcm_list[j] for j in np.flatnonzero(is_overlapped[i])]
+            if not toggle_debug:
+                if cm_list[i].is_mcdwith(candidate_list):
+                    return True
+                continue
+            iscollided, collided_points = cm_list[i].is_mcdwith(candidate_list, True)
             if iscollided:
-                if toggle_debug:
-                    print(self.cdmesh_collection.cm_list[i].get_homomat())
-                    self.cdmesh_collection.cm_list[i].show_cdmesh()
-                    for objcm in objcm_list:
-                        objcm.show_cdmesh()
-                    for point in collided_points:
-                        import modeling.geometric_model as gm
-                        gm.gen_sphere(point, radius=.001).attach_to(base)
-                    print("collided")
+                print(cm_list[i].get_homomat())
+                cm_list[i].show_cdmesh()
+                for objcm in objcm_list:
+                    objcm.show_cdmesh()
+                for point in collided_points:
+                    gm.gen_sphere(point, radius=.001).attach_to(base)
+                print("collided")
                 return True
         return False
 
+    def is_mesh_collided_batch(self, gl_poss, gl_rotmats, objcm_list=[]):
+        """
+        check the cdmeshes of the cd elements against the cdmeshes of objcm_list at many poses of the end effector,
+        the cd elements keep their current poses relative to (self.pos, self.rotmat), no fk is computed and
+        the end effector is not moved
+        the oriented bounds of the cdmeshes at all poses are compared with the ones of the objects in one pass,
+        ode is only called for the poses and cd elements whose bounds overlap an object, nearest first
+        :param gl_poss: Nx3 nparray, positions of the end effector, see fix_to
+        :param gl_rotmats: Nx3x3 nparray
+        :param objcm_list: a list of collision models or a CollisionEnvironment
+        :return: 1xN bool nparray
+        """
+        gl_poss = np.asarray(gl_poss).reshape(-1, 3)
+        gl_rotmats = np.asarray(gl_rotmats).reshape(-1, 3, 3)
+        is_collided_array = np.zeros(len(gl_poss), dtype=bool)
+        if len(self.all_cdelements) == 0 or len(gl_poss) == 0:
+            return is_collided_array
+        cm_list = self.cdmesh_collection.cm_list[:len(self.all_cdelements)]
+        local_aabbs = np.array([cm.get_cdmesh_local_aabb() for cm in cm_list])
+        # the poses of the cd elements relative to the end effector, and then at every pose of the end effector
+        rel_rotmats = np.einsum('ji,mjk->mik',
+                                self.rotmat,
+                                np.array([cdelement['gl_rotmat'] for cdelement in self.all_cdelements]))
+        rel_poss = (np.array([cdelement['gl_pos'] for cdelement in self.all_cdelements]) - self.pos).dot(self.rotmat)
+        cdelement_gl_rotmats = np.einsum('nij,mjk->nmik', gl_rotmats, rel_rotmats)
+        cdelement_gl_poss = np.einsum('nij,mj->nmi', gl_rotmats, rel_poss) + gl_poss[:, np.newaxis]
+        if isinstance(objcm_list, cenv.CollisionEnvironment):
+            cdelement_aabbs = rm.transform_aabbs(local_aabbs, cdelement_gl_poss, cdelement_gl_rotmats)
+            objcm_list = objcm_list.query(np.array([cdelement_aabbs[:, :, 0].min(axis=(0, 1)),
+                                                    cdelement_aabbs[:, :, 1].max(axis=(0, 1))]))
+        if not isinstance(objcm_list, list):
+            objcm_list = [objcm_list]
+        if len(objcm_list) == 0:
+            return is_collided_array
+        objcm_local_aabbs = np.array([objcm.get_cdmesh_local_aabb() for objcm in objcm_list])
+        objcm_rotmats = np.array([objcm.get_rotmat() for objcm in objcm_list])
+        cdelement_centers = cdelement_gl_poss + np.einsum('nmij,mj->nmi', cdelement_gl_rotmats,
+                                                          local_aabbs.mean(axis=1))
+        objcm_centers = np.array([objcm.get_pos() for objcm in objcm_list]) + \
+                        np.einsum('kij,kj->ki', objcm_rotmats, objcm_local_aabbs.mean(axis=1))
+        # is_overlapped[n, i, j] is True if the bounds of cd element i at pose n and objcm j overlap
+        is_overlapped = rm.is_obb_overlapped(cdelement_centers[:, :, np.newaxis],
+                                             cdelement_gl_rotmats[:, :, np.newaxis],
+                                             (local_aabbs[:, np.newaxis, 1] - local_aabbs[:, np.newaxis, 0]) / 2,
+                                             objcm_centers,
+                                             objcm_rotmats,
+                                             (objcm_local_aabbs[:, 1] - objcm_local_aabbs[:, 0]) / 2)
+        # the overlapped cd elements of a pose are sent to ode nearest first, a collision is usually found sooner
+        center_distances = np.linalg.norm(cdelement_centers[:, :, np.newaxis] - objcm_centers, axis=3)
+        center_distances = np.where(is_overlapped, center_distances, np.inf).min(axis=2)
+        for n in np.flatnonzero(is_overlapped.any(axis=(1, 2))):
+            for i in np.argsort(center_distances[n])[:is_overlapped[n].any(axis=1).sum()]:
+                cm_list[i].set_pose(cdelement_gl_poss[n, i], cdelement_gl_rotmats[n, i])
+                if cm_list[i].is_mcdwith([objcm_list[j] for j in np.flatnonzero(is_overlapped[n, i])]):
+                    is_collided_array[n] = True
+                    break
+        return is_collided_array
+
     def fix_to(self, pos, rotmat):
         raise NotImplementedError
 
@@ -124,4 +217,11 @@ class EEInterface(object):
         if self.cc is not None:
             for child in self_copy.cc.np.getChildren():
                 self_copy.cc.ctrav.addCollider(child, self_copy.cc.chan)
+            for layer in self_copy.cc._overflow_layers:
+                for child in layer.np.getChildren():
+                    if child.node().getFromCollideMask() != BitMask32.allOff():
+                        layer.ctrav.addCollider(child, layer.chan)
+            # the persistent scene is not deepcopied, register the original obstacles and robots again
+            if self.cc._scene_np is not None:
+                self_copy.cc.set_persistent_scene(self.cc._scene_obstacle_list, self.cc._scene_otherrobot_list)
         return self_copy
\ No newline at end of file
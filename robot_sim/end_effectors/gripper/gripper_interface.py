@@ -66,4 +66,15 @@ class GripperInterface(ei.EEInterface):
         eef_root_rotmat = gl_jaw_center_rotmat.dot(self.jaw_center_rotmat.T)
         eef_root_pos = gl_jaw_center_pos - eef_root_rotmat.dot(self.jaw_center_pos)
         self.fix_to(eef_root_pos, eef_root_rotmat)
-        return [jaw_width, gl_jaw_center_pos, gl_jaw_center_rotmat, eef_root_pos, eef_root_rotmat]
\ No newline at end of file
+        return [jaw_width, gl_jaw_center_pos, gl_jaw_center_rotmat, eef_root_pos, eef_root_rotmat]
+
+    def get_eef_root_poses_batch(self, gl_jaw_center_poss, gl_jaw_center_rotmats):
+        """
+        the vectorized counterpart of the root poses computed by grip_at_with_jcpose, the gripper is not moved
+        :param gl_jaw_center_poss: Nx3 nparray
+        :param gl_jaw_center_rotmats: Nx3x3 nparray
+        :return: eef_root_poss Nx3 nparray, eef_root_rotmats Nx3x3 nparray
+        """
+        eef_root_rotmats = np.asarray(gl_jaw_center_rotmats).dot(self.jaw_center_rotmat.T)
+        eef_root_poss = np.asarray(gl_jaw_center_poss) - eef_root_rotmats.dot(self.jaw_center_pos)
+        return eef_root_poss, eef_root_rotmats